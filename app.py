@@ -1,26 +1,302 @@
-from flask import Flask, jsonify, request
+from flask import Flask, Response, abort, g, has_request_context, jsonify, request, send_file, stream_with_context
+from flask.json.provider import DefaultJSONProvider
+import atexit
+import hashlib
+import json
+import os
 import threading
-from server import is_port_open, open_port, start_server, receive_messages, send_messages, handle_client
-from users_database import create_connection, insert_message, get_user_messages, create_tables
+import time
+from datetime import datetime, timezone
+from server import DEFAULT_STOP_TIMEOUT, SERVER_MODES, ServerController, is_port_open, open_port, receive_messages, send_messages, handle_client
+from cache import TTLCache
+from cluster import CONTROL_SOCKET_ENV, CacheSync, ControlError, MessageFeed, RemoteServerController
+from file_transfer import MEDIA_ROOT, MediaStore, guess_mimetype, is_digest
+from metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, Gauge, Histogram, render as render_metrics
+from message_writer import MessageWriter
+from pubsub import MessageBus
+from stream_server import StreamServer
+from serializers import JSON, RowSet, compress, negotiate
+from upnp_manager import PortMappingManager
+from port_scanner import MAX_TIMEOUT as MAX_PORT_CHECK_TIMEOUT, PortScanner
+from protocol import FrameParser, MSG_TEXT, decode_text, send_text
+from users_database import (
+    create_connection, insert_message, get_user_messages, create_tables, get_pool, open_connection,
+    user_id_cache_stats, get_user_messages_page, iter_user_messages, get_posts_page, iter_posts_by_profile,
+    insert_messages_batch, search_messages, search_posts, enqueue_outbox
+)
+
+class NegotiatingJSONProvider(DefaultJSONProvider):
+    """ jsonify() отвечает в формате из заголовка Accept (JSON, msgpack,
+    CBOR) для любого статуса: данные кодируются один раз, без разбора
+    и перекодирования готового JSON """
+
+    def response(self, *args, **kwargs):
+        if not has_request_context():
+            return super().response(*args, **kwargs)
+        fmt = negotiate(request.accept_mimetypes)
+        if fmt is JSON:
+            response = super().response(*args, **kwargs)
+        else:
+            response = self._app.response_class(fmt.dumps(self._prepare_response_obj(args, kwargs)),
+                                                mimetype=fmt.mimetype)
+        response.vary.add('Accept')
+        return response
 
 app = Flask(__name__)
+app.json = NegotiatingJSONProvider(app)
 
 # Глобальные переменные для управления сервером
-server_thread = None
-server_running = False
 current_port = None
 
+# serve.py передает путь к БД и признак уже выполненной инициализации через окружение
+DB_FILE = os.environ.get('P2P_DB_FILE', "chat_db.sqlite")
+DB_INITIALIZED_ENV = 'P2P_DB_INITIALIZED'
+# Задан в процессах HTTP и SSE под serve.py: TCP-сервер, шина и кэши
+# других процессов доступны только через него и БД (см. cluster.py)
+CONTROL_SOCKET = os.environ.get(CONTROL_SOCKET_ENV)
+
+DEFAULT_PAGE_LIMIT = 100
+MAX_PAGE_LIMIT = 1000
+MAX_BULK_RECORDS = 10000
+MAX_SEARCH_LIMIT = 100
+
+# Push-доставка новых сообщений: SSE и long-poll читают общую шину.
+# Маршруты Flask держат поток Werkzeug на подписчика, поэтому их число
+# ограничено; массовые подписки обслуживает stream_server на STREAM_PORT
+# (один цикл asyncio на все соединения, те же URL и формат).
+STREAM_KEEPALIVE = 15     # секунды между комментариями-пингами в SSE
+MAX_POLL_TIMEOUT = 30     # секунды ожидания в long-poll
+MAX_STREAM_SUBSCRIBERS = 1000
+STREAM_PORT = int(os.environ.get('P2P_STREAM_PORT', 5001))
+message_bus = MessageBus()
+stream_server = StreamServer(message_bus, keepalive=STREAM_KEEPALIVE)
+message_feed = MessageFeed(DB_FILE, message_bus) if CONTROL_SOCKET else None
+
+def publish_messages(records, source):
+    """ Публикует уже зафиксированные сообщения [(username, message[, timestamp])] """
+    if message_feed is not None:
+        # Под serve.py сообщения любого процесса публикует MessageFeed из БД
+        return
+    now = datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+    message_bus.publish_many([{
+        'username': record[0],
+        'text': record[1],
+        'timestamp': (record[2] if len(record) > 2 else None) or now,
+        'source': source
+    } for record in records])
+
+# Сообщения от TCP-клиентов пишутся в БД пачками отдельным потоком
+# и публикуются в шину после фиксации пачки
+message_writer = MessageWriter(DB_FILE, on_commit=lambda batch: publish_messages(batch, 'tcp'))
+
+# Кэши чтения: запись хранит готовое тело ответа, ETag и доп. заголовки.
+# Сбрасываются обработчиками PUT/POST/DELETE после фиксации транзакции,
+# а под serve.py — еще и по журналу изменений из других процессов.
+profile_cache = TTLCache()
+post_cache = TTLCache()
+posts_list_cache = TTLCache()  # ключ: (profile_id, параметры страницы)
+
+# Проброс портов через UPnP выполняется в фоне; правила удаляются при выходе
+port_manager = PortMappingManager(reachability_check=is_port_open)
+atexit.register(port_manager.stop)
+
+# Проверки доступности портов выполняются параллельно на общем пуле
+port_scanner = PortScanner()
+MAX_PORT_CHECK_TARGETS = 1000
+
+HTTP_REQUEST_SECONDS = Histogram('http_request_seconds', 'Время обработки HTTP-запроса до отправки заголовков',
+                                 ('method', 'route', 'status'))
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def observe_request_latency(response):
+    started = g.pop('request_started', None)
+    if started is not None:
+        # Метка — шаблон маршрута, а не путь: /api/open_port/<int:job_id>, а не каждый id
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        HTTP_REQUEST_SECONDS.labels(request.method, route, response.status_code).observe(
+            time.perf_counter() - started)
+    return response
+
+@app.route('/metrics', methods=['GET'])
+def api_metrics():
+    return Response(render_metrics(), content_type=METRICS_CONTENT_TYPE)
+
 # Инициализация базы данных при старте API
 def init_db():
-    conn = create_connection("chat_db.sqlite")
+    conn = create_connection(DB_FILE)
     if conn is not None:
         create_tables(conn)
         conn.close()
 
-# Функция для получения соединения с БД в каждом запросе
+# Соединения с БД берутся из общего пула и возвращаются в него после запроса
 def get_db_connection():
-    conn = create_connection("chat_db.sqlite")
-    return conn
+    return get_pool(DB_FILE).acquire()
+
+def release_db_connection(conn):
+    get_pool(DB_FILE).release(conn)
+
+def parse_page_args():
+    """ Разбирает after_id/before_id/limit; None, если пагинация не запрошена.
+    Нечисловой или отрицательный курсор — ValueError (ответ 400) """
+    args = request.args
+    if not any(name in args for name in ('after_id', 'before_id', 'limit')):
+        return None
+    after_id = parse_id_arg('after_id')
+    before_id = parse_id_arg('before_id')
+    limit = args.get('limit', DEFAULT_PAGE_LIMIT, type=int)
+    if limit is None or limit < 1 or limit > MAX_PAGE_LIMIT:
+        raise ValueError(f'limit must be between 1 and {MAX_PAGE_LIMIT}')
+    return after_id, before_id, limit
+
+def parse_id_arg(name):
+    value = request.args.get(name)
+    if value is None:
+        return None
+    try:
+        value = int(value)
+    except ValueError:
+        raise ValueError(f'{name} must be an integer')
+    if value < 0:
+        raise ValueError(f'{name} must be non-negative')
+    return value
+
+def parse_record_id(value, name):
+    """ id профиля или поста как целое число: '01' и '1' — одна строка
+    SQLite, поэтому и ключ кэша у них должен быть один """
+    if isinstance(value, bool):
+        raise ValueError(f'{name} должен быть целым числом')
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise ValueError(f'{name} должен быть целым числом')
+
+class CacheEntry:
+    """ Закэшированный ответ: данные, доп. заголовки и готовые тела
+    (с ETag) в каждом запрошенном формате """
+
+    __slots__ = ('payload', 'headers', '_encoded')
+
+    def __init__(self, payload, headers=None):
+        self.payload = payload
+        self.headers = headers or {}
+        self._encoded = {}  # имя формата -> (тело, ETag)
+
+    def encoded(self, fmt):
+        encoded = self._encoded.get(fmt.name)
+        if encoded is None:
+            body = app.json.dumps(self.payload).encode('utf-8') if fmt is JSON else fmt.dumps(self.payload)
+            encoded = self._encoded[fmt.name] = (body, hashlib.sha1(body).hexdigest())
+        return encoded
+
+def make_cache_entry(payload, headers=None):
+    entry = CacheEntry(payload, headers)
+    entry.encoded(JSON)
+    return entry
+
+def cached_response(entry):
+    """ Отдает закэшированный ответ в формате из Accept; 304, если клиент
+    уже имеет эту версию. ETag у каждого формата свой: он считается по телу """
+    fmt = negotiate(request.accept_mimetypes)
+    body, etag = entry.encoded(fmt)
+    # Слабое сравнение: сжатые ответы отдаются со слабым ETag
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+    else:
+        response = Response(body, mimetype=fmt.mimetype)
+    response.set_etag(etag)
+    response.vary.add('Accept')
+    response.headers.update(entry.headers)
+    return response
+
+def invalidate_profile_posts(profile_id):
+    key = str(profile_id)
+    posts_list_cache.invalidate_matching(lambda cache_key: cache_key[0] == key)
+
+def clear_caches():
+    for cache in (profile_cache, post_cache, posts_list_cache):
+        cache.clear()
+
+cache_sync = CacheSync(DB_FILE, {
+    'profile': profile_cache.invalidate,
+    'post': post_cache.invalidate,
+    'profile_posts': invalidate_profile_posts
+}, clear_caches) if CONTROL_SOCKET else None
+
+def cache_get(cache, key):
+    """ Запись кэша с учетом изменений, зафиксированных другими процессами """
+    if cache_sync is not None:
+        try:
+            cache_sync.sync()
+        except Exception as e:
+            print(f"[Ошибка] Не удалось прочитать журнал инвалидаций: {e}")
+            return None
+    return cache.get(key)
+
+def api_response(document, status=200):
+    """ Ответ в формате из заголовка Accept (JSON, msgpack, CBOR);
+    значения RowSet кодируются прямо из строк курсора """
+    fmt = negotiate(request.accept_mimetypes)
+    response = Response(fmt.encode_document(document), status=status, mimetype=fmt.mimetype)
+    response.vary.add('Accept')
+    return response
+
+@app.after_request
+def encode_response(response):
+    """ Сжимает крупные тела; формат уже выбран при создании ответа """
+    if response.is_streamed or response.direct_passthrough or response.status_code != 200:
+        return response
+    if 'Content-Encoding' not in response.headers:
+        body, encoding = compress(response.get_data(), request.accept_encodings)
+        if encoding is not None:
+            response.set_data(body)
+            response.headers['Content-Encoding'] = encoding
+            response.vary.add('Accept-Encoding')
+            etag, _ = response.get_etag()
+            if etag is not None:
+                response.set_etag(etag, weak=True)
+    return response
+
+# Каждый поток NDJSON держит свое соединение с БД до конца выдачи
+MAX_NDJSON_STREAMS = 32
+ndjson_streams = threading.BoundedSemaphore(MAX_NDJSON_STREAMS)
+
+def wants_ndjson():
+    return request.args.get('format') == 'ndjson'
+
+def stream_ndjson(rows_factory, to_dict):
+    """ Отдает строки курсора как NDJSON. Поток читает из собственного
+    соединения: пул не ждет, пока медленный клиент дочитает историю """
+    if not ndjson_streams.acquire(blocking=False):
+        return jsonify({'status': 'error', 'message': 'Too many concurrent streams'}), 503
+
+    def generate():
+        conn = open_connection(DB_FILE)
+        try:
+            for row in rows_factory(conn):
+                yield json.dumps(to_dict(row), ensure_ascii=False) + '\n'
+        finally:
+            conn.close()
+    response = Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+    # Вызывается и тогда, когда клиент отключился до начала выдачи
+    response.call_on_close(ndjson_streams.release)
+    return response
+
+def page_ndjson(rows, to_dict, headers):
+    """ Страница (не больше MAX_PAGE_LIMIT строк) как NDJSON; курсоры — в заголовках """
+    return Response((json.dumps(to_dict(row), ensure_ascii=False) + '\n' for row in rows),
+                    mimetype='application/x-ndjson', headers=headers)
+
+def page_cursor_headers(next_after_id, next_before_id):
+    headers = {}
+    if next_after_id is not None:
+        headers['X-Next-After-Id'] = str(next_after_id)
+    if next_before_id is not None:
+        headers['X-Next-Before-Id'] = str(next_before_id)
+    return headers
 
 # Добавляем новый эндпоинт для работы с сообщениями
 @app.route('/api/messages', methods=['GET', 'POST'])
@@ -34,18 +310,22 @@ def save_message():
     data = request.get_json()
     username = data.get('username')
     message = data.get('message')
+    recipient = data.get('recipient')
     
     if not username or not message:
         return jsonify({
             'status': 'error',
             'message': 'Username and message are required'
         }), 400
+    if recipient is not None:
+        return save_direct_message(username, recipient, message)
     
     conn = get_db_connection()
     try:
         success = insert_message(conn, username, message)
         if success:
             conn.commit()
+            publish_messages([(username, message)], 'api')
             return jsonify({
                 'status': 'success',
                 'username': username,
@@ -63,7 +343,176 @@ def save_message():
             'message': str(e)
         }), 500
     finally:
-        conn.close()
+        release_db_connection(conn)
+
+def save_direct_message(username, recipient, message):
+    """ Личное сообщение не попадает в общую ленту: оно ставится в очередь
+    outbox и доставляется получателю по TCP, как только тот подключится """
+    if not isinstance(recipient, str) or not recipient:
+        return jsonify({
+            'status': 'error',
+            'message': 'recipient must be a non-empty string'
+        }), 400
+    conn = get_db_connection()
+    try:
+        outbox_id = enqueue_outbox(conn, recipient, username, message)
+    finally:
+        release_db_connection(conn)
+    if outbox_id is None:
+        return jsonify({
+            'status': 'error',
+            'message': 'Failed to queue message'
+        }), 500
+    # В serve.py TCP-сервер работает в другом процессе и найдет запись сам
+    server_controller.notify_delivery(recipient)
+    return jsonify({
+        'status': 'queued',
+        'outbox_id': outbox_id,
+        'username': username,
+        'recipient': recipient,
+        'message': message
+    }), 202
+
+@app.route('/api/messages/bulk', methods=['POST'])
+def save_messages_bulk():
+    """ Принимает массив JSON или NDJSON из {username, message, timestamp?}
+    и сохраняет все корректные записи одной транзакцией """
+    try:
+        if request.mimetype == 'application/x-ndjson':
+            records = [json.loads(line) for line in request.get_data(as_text=True).splitlines() if line.strip()]
+        else:
+            records = request.get_json()
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': f'Invalid body: {e}'}), 400
+
+    if not isinstance(records, list):
+        return jsonify({
+            'status': 'error',
+            'message': 'Body must be a JSON array or NDJSON'
+        }), 400
+    if len(records) > MAX_BULK_RECORDS:
+        return jsonify({
+            'status': 'error',
+            'message': f'At most {MAX_BULK_RECORDS} records per request'
+        }), 413
+
+    results = []
+    rows = []
+    for index, record in enumerate(records):
+        if not isinstance(record, dict):
+            results.append({'index': index, 'status': 'error', 'message': 'Record must be an object'})
+            continue
+        username = record.get('username')
+        message = record.get('message')
+        timestamp = record.get('timestamp')
+        if not isinstance(username, str) or not username or not isinstance(message, str) or not message:
+            results.append({'index': index, 'status': 'error', 'message': 'Username and message are required'})
+            continue
+        if timestamp is not None and not isinstance(timestamp, str):
+            results.append({'index': index, 'status': 'error', 'message': 'timestamp must be a string'})
+            continue
+        rows.append((username, message, timestamp))
+        results.append({'index': index, 'status': 'success'})
+
+    inserted = 0
+    if rows:
+        conn = get_db_connection()
+        try:
+            if insert_messages_batch(conn, rows):
+                inserted = len(rows)
+                publish_messages(rows, 'api')
+            else:
+                for result in results:
+                    if result['status'] == 'success':
+                        result['status'] = 'error'
+                        result['message'] = 'Failed to save message'
+        finally:
+            release_db_connection(conn)
+
+    if inserted == len(records):
+        status, code = 'success', 200
+    elif inserted:
+        status, code = 'partial', 207
+    else:
+        status, code = 'error', 400 if not rows else 500
+    return jsonify({
+        'status': status,
+        'inserted': inserted,
+        'results': results
+    }), code
+
+def parse_stream_cursor():
+    """ Курсор подписки: Last-Event-ID (переподключение SSE) или ?after;
+    без курсора подписка начинается с текущего момента """
+    cursor = request.headers.get('Last-Event-ID') or request.args.get('after')
+    if cursor is None:
+        return message_bus.last_id()
+    cursor = int(cursor)
+    if cursor < 0:
+        raise ValueError('after must be non-negative')
+    return cursor
+
+def message_filter():
+    username = request.args.get('username')
+    if not username:
+        return None
+    return lambda event: event['username'] == username
+
+def event_to_dict(event_id, event):
+    return dict(event, id=event_id)
+
+@app.route('/api/messages/stream', methods=['GET'])
+def stream_messages():
+    """ Server-Sent Events с новыми сообщениями (опционально ?username=) """
+    try:
+        cursor = parse_stream_cursor()
+    except ValueError:
+        return jsonify({'status': 'error', 'message': 'Invalid event id'}), 400
+    if message_bus.subscriber_count() >= MAX_STREAM_SUBSCRIBERS:
+        return jsonify({
+            'status': 'error',
+            'message': f'Too many subscribers, use the stream server on port {STREAM_PORT}'
+        }), 503
+    predicate = message_filter()
+
+    def generate(cursor):
+        with message_bus.subscribe():
+            # Подсказка браузеру, через сколько переподключаться после обрыва
+            yield 'retry: 3000\n\n'
+            while not message_bus.closed():
+                events, cursor, missed = message_bus.wait(cursor, STREAM_KEEPALIVE, predicate)
+                if missed:
+                    yield 'event: reset\ndata: {}\n\n'
+                if not events:
+                    # Пинг удерживает соединение и обнаруживает отключившихся клиентов
+                    yield ': keepalive\n\n'
+                    continue
+                yield ''.join(
+                    f"id: {event_id}\nevent: message\ndata: {json.dumps(event_to_dict(event_id, event))}\n\n"
+                    for event_id, event in events
+                )
+
+    return Response(generate(cursor), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+@app.route('/api/messages/poll', methods=['GET'])
+def poll_messages():
+    """ Long-poll: ждет новые сообщения после ?after до ?timeout секунд """
+    try:
+        cursor = parse_stream_cursor()
+        timeout = min(max(request.args.get('timeout', MAX_POLL_TIMEOUT, type=float), 0), MAX_POLL_TIMEOUT)
+    except ValueError:
+        return jsonify({'status': 'error', 'message': 'Invalid cursor'}), 400
+    with message_bus.subscribe():
+        events, cursor, missed = message_bus.wait(cursor, timeout, message_filter())
+    return jsonify({
+        'status': 'success',
+        'messages': [event_to_dict(event_id, event) for event_id, event in events],
+        'next_after': cursor,
+        'missed': missed
+    })
 
 def get_messages():
     username = request.args.get('username')
@@ -73,18 +522,48 @@ def get_messages():
             'status': 'error',
             'message': 'Username parameter is required'
         }), 400
-    
+
+    try:
+        page = parse_page_args()
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+
+    def message_to_dict(msg):
+        return {'id': msg[0], 'text': msg[1], 'timestamp': msg[2]}
+
+    if wants_ndjson() and page is None:
+        return stream_ndjson(lambda conn: iter_user_messages(conn, username), message_to_dict)
+
     conn = get_db_connection()
     try:
+        if page is not None:
+            after_id, before_id, limit = page
+            messages = get_user_messages_page(conn, username, after_id, before_id, limit)
+            if messages is None:
+                return jsonify({
+                    'status': 'error',
+                    'message': 'Failed to retrieve messages'
+                }), 500
+            # Курсор вперед есть всегда, когда есть строки: короткая страница
+            # значит лишь, что новых пока нет, и клиент продолжит с нее
+            next_after_id = messages[-1][0] if messages else after_id
+            next_before_id = messages[0][0] if messages else None
+            if wants_ndjson():
+                return page_ndjson(messages, message_to_dict, page_cursor_headers(next_after_id, next_before_id))
+            return api_response({
+                'status': 'success',
+                'username': username,
+                'messages': RowSet(('id', 'text', 'timestamp'), messages),
+                'next_after_id': next_after_id,
+                'next_before_id': next_before_id
+            })
+
         messages = get_user_messages(conn, username)
         if messages is not None:
-            return jsonify({
+            return api_response({
                 'status': 'success',
                 'username': username,
-                'messages': [{
-                    'text': msg[0],
-                    'timestamp': msg[1]
-                } for msg in messages]
+                'messages': RowSet(('text', 'timestamp'), messages)
             })
         else:
             return jsonify({
@@ -97,23 +576,60 @@ def get_messages():
             'message': str(e)
         }), 500
     finally:
-        conn.close()
+        release_db_connection(conn)
+
+@app.route('/api/search', methods=['GET'])
+def api_search():
+    query = request.args.get('q', '').strip()
+    search_type = request.args.get('type', 'all')
+    sort = request.args.get('sort', 'rank')
+    limit = request.args.get('limit', 20, type=int)
+    offset = request.args.get('offset', 0, type=int)
+
+    if not query:
+        return jsonify({'status': 'error', 'message': 'q parameter is required'}), 400
+    if search_type not in ('all', 'messages', 'posts') or sort not in ('rank', 'recent'):
+        return jsonify({
+            'status': 'error',
+            'message': "type must be all/messages/posts, sort must be rank/recent"
+        }), 400
+    if limit < 1 or limit > MAX_SEARCH_LIMIT or offset < 0:
+        return jsonify({
+            'status': 'error',
+            'message': f'limit must be between 1 and {MAX_SEARCH_LIMIT}, offset >= 0'
+        }), 400
+
+    conn = get_db_connection()
+    try:
+        result = {'status': 'success', 'q': query, 'limit': limit, 'offset': offset}
+        if search_type in ('all', 'messages'):
+            rows = search_messages(conn, query, limit, offset, sort)
+            if rows is None:
+                return jsonify({'status': 'error', 'message': 'Search failed'}), 500
+            result['messages'] = RowSet(('id', 'username', 'timestamp', 'snippet', 'rank'), rows)
+        if search_type in ('all', 'posts'):
+            rows = search_posts(conn, query, limit, offset, sort)
+            if rows is None:
+                return jsonify({'status': 'error', 'message': 'Search failed'}), 500
+            result['posts'] = RowSet(('post_id', 'profile_id', 'created_at', 'snippet', 'rank'), rows)
+        return api_response(result)
+    except Exception as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+    finally:
+        release_db_connection(conn)
+
+# Ставит сообщение от TCP-клиента в очередь записи (используется обоими серверами).
+# Блокируется, если очередь заполнена, — чтение из сокета приостанавливается.
+def save_client_message(addr, message):
+    username = f"client_{addr[0]}"  # Генерируем имя пользователя из IP
+    message_writer.submit(username, message)
 
 # Модифицируем функцию handle_client для сохранения сообщений в БД
 def modified_handle_client(client_socket, addr):
     print(f"[Инфо] Подключился клиент: {addr}")
     
     def save_received_message(message):
-        username = f"client_{addr[0]}"  # Генерируем имя пользователя из IP
-        conn = get_db_connection()
-        try:
-            insert_message(conn, username, message)
-            conn.commit()
-        except Exception as e:
-            print(f"Ошибка при сохранении сообщения: {e}")
-            conn.rollback()
-        finally:
-            conn.close()
+        save_client_message(addr, message)
     
     recv_thread = threading.Thread(
         target=receive_messages_wrapper,
@@ -132,15 +648,18 @@ def modified_handle_client(client_socket, addr):
     send_thread.join()
 
 def receive_messages_wrapper(client_socket, addr, callback):
+    parser = FrameParser()
     try:
         while True:
-            data = client_socket.recv(1024)
-            if not data:
+            if not parser.recv_into(client_socket):
                 print(f"[Инфо] Клиент {addr} отключился.")
                 break
-            message = data.decode('utf-8', errors='ignore')
-            print(f"\n[Сообщение от {addr}]: {message}")
-            callback(message)  # Сохраняем сообщение в БД
+            for msg_type, payload in parser.frames():
+                if msg_type != MSG_TEXT:
+                    continue
+                message = decode_text(payload)
+                print(f"\n[Сообщение от {addr}]: {message}")
+                callback(message)  # Сохраняем сообщение в БД
     except Exception as e:
         print(f"[Ошибка] Ошибка при получении данных от {addr}: {e}")
     finally:
@@ -152,14 +671,42 @@ def send_messages_wrapper(client_socket, addr):
             message = input("Введите ответ клиенту: ")
             if not message:
                 continue
-            client_socket.sendall(message.encode('utf-8'))
+            send_text(client_socket, message)
     except Exception as e:
         print(f"[Ошибка] Ошибка при отправке данных клиенту {addr}: {e}")
     finally:
         client_socket.close()
 
-# Инициализируем базу данных при старте
-init_db()
+# Фоновый TCP-сервер; при остановке принятые сообщения дописываются в БД
+# Файлы, присланные по TCP, доступны по /media/<sha256> (ссылка для posts.photo_url)
+media_store = MediaStore(MEDIA_ROOT)
+if CONTROL_SOCKET:
+    # Под serve.py TCP-сервер живет в процессе tcp; управляем им через сокет
+    server_controller = RemoteServerController(CONTROL_SOCKET, DEFAULT_STOP_TIMEOUT)
+else:
+    server_controller = ServerController(on_message=save_client_message, message_writer=message_writer,
+                                         media_store=media_store, outbox_db=DB_FILE, compression_db=DB_FILE)
+    atexit.register(server_controller.stop)
+
+# Инициализируем базу данных при старте; в рабочих процессах serve.py
+# схему и миграции уже применил мастер
+if os.environ.get(DB_INITIALIZED_ENV) != '1':
+    init_db()
+message_writer.start()
+if message_feed is not None:
+    message_feed.start()
+    atexit.register(message_feed.stop)
+
+Gauge('tcp_active_connections', 'Открытые TCP-подключения', lambda: server_controller.stats.active)
+Gauge('message_writer_queue_depth', 'Сообщения в очереди записи в БД', message_writer.queue_depth)
+Gauge('message_stream_subscribers', 'Открытые SSE и long-poll подписки', message_bus.subscriber_count)
+Gauge('message_stream_evented_subscribers', 'Подписки SSE-сервера на asyncio', stream_server.subscriber_count)
+atexit.register(message_bus.close)
+atexit.register(stream_server.stop)
+
+@app.errorhandler(ControlError)
+def control_unavailable(e):
+    return jsonify({'status': 'error', 'message': str(e)}), 503
 
 @app.route('/api/check_port', methods=['GET'])
 def api_check_port():
@@ -180,59 +727,142 @@ def api_check_port():
             'message': str(e)
         }), 500
 
+@app.route('/api/check_port', methods=['POST'])
+def api_check_ports():
+    """ Параллельно проверяет список целей {"targets": [{"host", "port"}, ...]}.
+
+    timeout — секунды на одну проверку; stream=true отдает NDJSON
+    по мере завершения проверок.
+    """
+    data = request.get_json()
+    targets = data.get('targets')
+    timeout = data.get('timeout', 2.0)
+
+    if not isinstance(targets, list) or not targets:
+        return jsonify({'status': 'error', 'message': 'targets must be a non-empty list'}), 400
+    if len(targets) > MAX_PORT_CHECK_TARGETS:
+        return jsonify({
+            'status': 'error',
+            'message': f'At most {MAX_PORT_CHECK_TARGETS} targets per request'
+        }), 413
+    try:
+        timeout = float(timeout)
+        if not 0 < timeout <= MAX_PORT_CHECK_TIMEOUT:
+            raise ValueError(f'timeout must be in (0, {MAX_PORT_CHECK_TIMEOUT}]')
+        pairs = [(str(target['host']), int(target['port'])) for target in targets]
+        if not all(0 < port < 65536 for _, port in pairs):
+            raise ValueError('port must be in 1..65535')
+    except (KeyError, TypeError, ValueError) as e:
+        return jsonify({'status': 'error', 'message': f'Invalid request: {e}'}), 400
+
+    if data.get('stream'):
+        def generate():
+            for result in port_scanner.scan(pairs, timeout):
+                yield json.dumps(result) + '\n'
+        return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+    return jsonify({'status': 'success', 'results': list(port_scanner.scan(pairs, timeout))})
+
+def port_job_response(job):
+    if job['status'] == 'error':
+        return jsonify({'status': 'error', 'message': job['error'], 'job': job}), 400
+    if job['status'] == 'success':
+        return jsonify({'status': 'success', 'job': job})
+    return jsonify({'status': 'accepted', 'job': job}), 202
+
 @app.route('/api/open_port', methods=['POST'])
 def api_open_port():
-    global current_port
-    
+    """ Ставит открытие порта в очередь и сразу возвращает задание.
+
+    Необязательный параметр wait (секунды) позволяет дождаться результата.
+    """
     data = request.get_json()
     external_port = data.get('external_port', 15001)
     internal_port = data.get('internal_port', 15001)
     protocol = data.get('protocol', 'TCP')
     description = data.get('description', 'Flask UPnP Port')
+    wait = data.get('wait', 0)
+
+    def on_opened(result):
+        global current_port
+        current_port = result['internal_port']
     
     try:
-        result = open_port(external_port, internal_port, protocol, description)
-        if result:
-            current_port = internal_port
-            return jsonify({
-                'status': 'success',
-                'external_port': external_port,
-                'internal_port': internal_port,
-                'protocol': protocol,
-                'description': description
-            })
-        else:
-            return jsonify({
-                'status': 'error',
-                'message': 'Failed to open port'
-            }), 400
-    except Exception as e:
+        job_id = port_manager.submit_open(external_port, internal_port, protocol, description, on_opened)
+        if str(protocol).upper() == 'TCP' and server_controller.udp:
+            # UDP-вход чата слушает тот же номер порта
+            port_manager.submit_open(external_port, internal_port, 'UDP', description)
+        job = port_manager.wait(job_id, timeout=float(wait)) if wait else port_manager.job_status(job_id)
+        return port_job_response(job)
+    except (TypeError, ValueError) as e:
         return jsonify({
             'status': 'error',
             'message': str(e)
-        }), 500
+        }), 400
+
+@app.route('/api/open_port', methods=['DELETE'])
+def api_close_port():
+    external_port = request.args.get('external_port', type=int)
+    protocol = request.args.get('protocol', 'TCP')
+    if external_port is None:
+        return jsonify({'status': 'error', 'message': 'external_port is required'}), 400
+    job_id = port_manager.submit_close(external_port, protocol)
+    if protocol.upper() == 'TCP' and server_controller.udp:
+        port_manager.submit_close(external_port, 'UDP')
+    return port_job_response(port_manager.job_status(job_id))
+
+@app.route('/api/open_port/<int:job_id>', methods=['GET'])
+def api_port_job_status(job_id):
+    job = port_manager.job_status(job_id)
+    if job is None:
+        return jsonify({'status': 'error', 'message': 'Job not found'}), 404
+    return port_job_response(job)
+
+@app.route('/api/port_mappings', methods=['GET'])
+def api_port_mappings():
+    return jsonify({'status': 'success', 'mappings': port_manager.mappings()})
+
+def parse_server_args(data):
+    """ Разбирает port/mode/backlog из тела запроса; ValueError при ошибке """
+    mode = data.get('mode')
+    if mode is not None and mode not in SERVER_MODES:
+        raise ValueError("mode must be 'threads' or 'async'")
+    port = data.get('port')
+    backlog = data.get('backlog')
+    try:
+        port = int(port) if port is not None else None
+        backlog = int(backlog) if backlog is not None else None
+    except (TypeError, ValueError):
+        raise ValueError('port and backlog must be integers')
+    if port is not None and not 0 < port < 65536:
+        raise ValueError('port must be in 1..65535')
+    if backlog is not None and backlog < 1:
+        raise ValueError('backlog must be positive')
+    return port, mode, backlog
 
 @app.route('/api/start_server', methods=['POST'])
 def api_start_server():
-    global server_thread, server_running, current_port
-    
-    if server_running:
+    if server_controller.is_running():
         return jsonify({
             'status': 'error',
             'message': 'Server is already running'
         }), 400
     
-    data = request.get_json()
-    port = data.get('port', current_port or 15001)
+    data = request.get_json(silent=True) or {}
+    try:
+        port, mode, backlog = parse_server_args(data)
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    port = port or current_port or 15001
+    mode = mode or 'threads'
     
     try:
-        server_thread = threading.Thread(target=start_server, args=(port,), daemon=True)
-        server_thread.start()
-        server_running = True
-        
+        server_controller.start(port, mode, backlog)
         return jsonify({
             'status': 'success',
             'port': port,
+            'mode': mode,
+            'backlog': server_controller.backlog,
             'message': 'Server started successfully'
         })
     except Exception as e:
@@ -243,21 +873,55 @@ def api_start_server():
 
 @app.route('/api/stop_server', methods=['POST'])
 def api_stop_server():
-    global server_running
+    if not server_controller.is_running():
+        return jsonify({
+            'status': 'error',
+            'message': 'Server is not running'
+        }), 400
 
-    server_running = False
-    
+    drained = server_controller.stop()
     return jsonify({
         'status': 'success',
-        'message': 'Server stop requested (may take a moment)'
+        'drained': drained,
+        'message': 'Server stopped' if drained else 'Server stopped, some messages may still be pending'
     })
 
+@app.route('/api/restart_server', methods=['POST'])
+def api_restart_server():
+    data = request.get_json(silent=True) or {}
+    try:
+        port, mode, backlog = parse_server_args(data)
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    if server_controller.port is None and port is None:
+        port = current_port or 15001
+
+    try:
+        server_controller.restart(port, mode, backlog)
+        return jsonify({
+            'status': 'success',
+            'port': server_controller.port,
+            'mode': server_controller.mode,
+            'backlog': server_controller.backlog,
+            'message': 'Server restarted successfully'
+        })
+    except Exception as e:
+        return jsonify({
+            'status': 'error',
+            'message': str(e)
+        }), 500
+
 @app.route('/api/server_status', methods=['GET'])
 def api_server_status():
     return jsonify({
         'status': 'success',
-        'server_running': server_running,
-        'current_port': current_port
+        'server_running': server_controller.is_running(),
+        'current_port': current_port,
+        'server': server_controller.status(),
+        'user_id_cache': user_id_cache_stats(),
+        'profile_cache': profile_cache.stats(),
+        'post_cache': post_cache.stats(),
+        'posts_list_cache': posts_list_cache.stats()
     })
 
 @app.route('/api/profile', methods=['GET'])
@@ -265,20 +929,31 @@ def api_get_profile():
     profile_id = request.args.get('profile_id')
     if not profile_id:
         return jsonify({'status': 'error', 'message': 'profile_id обязателен'}), 400
+    try:
+        profile_id = parse_record_id(profile_id, 'profile_id')
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
 
+    entry = cache_get(profile_cache, str(profile_id))
+    if entry is not None:
+        return cached_response(entry)
+
+    generation = profile_cache.generation()
     conn = get_db_connection()
     try:
         cursor = conn.cursor()
         cursor.execute("SELECT * FROM user_profiles WHERE profile_id = ?", (profile_id,))
         profile = cursor.fetchone()
         if profile:
-            return jsonify(dict(profile))
+            entry = make_cache_entry(dict(profile))
+            profile_cache.put(str(profile_id), entry, generation)
+            return cached_response(entry)
         else:
             return jsonify({'status': 'error', 'message': 'Профиль не найден'}), 404
     except Exception as e:
         return jsonify({'status': 'error', 'message': str(e)}), 500
     finally:
-        conn.close()
+        release_db_connection(conn)
 
 @app.route('/api/profile', methods=['POST'])
 def api_create_profile():
@@ -294,7 +969,7 @@ def api_create_profile():
     except Exception as e:
         return jsonify({'status': 'error', 'message': str(e)}), 500
     finally:
-        conn.close()
+        release_db_connection(conn)
 
 
 @app.route('/api/profile', methods=['PUT'])
@@ -305,30 +980,43 @@ def api_update_profile():
 
     if not profile_id or bio is None:
         return jsonify({'status': 'error', 'message': 'profile_id и bio обязательны'}), 400
+    try:
+        profile_id = parse_record_id(profile_id, 'profile_id')
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
 
     conn = get_db_connection()
     try:
         cursor = conn.cursor()
         cursor.execute("UPDATE user_profiles SET bio = ? WHERE profile_id = ?", (bio, profile_id))
         conn.commit()
+        profile_cache.invalidate(str(profile_id))
         if cursor.rowcount == 0:
             return jsonify({'status': 'error', 'message': 'Профиль не найден'}), 404
         return jsonify({'status': 'success'})
     except Exception as e:
         return jsonify({'status': 'error', 'message': str(e)}), 500
     finally:
-        conn.close()
+        release_db_connection(conn)
 
 @app.route('/api/profile', methods=['DELETE'])
 def api_delete_profile():
     profile_id = request.args.get('profile_id')
     if not profile_id:
         return jsonify({'status': 'error', 'message': 'profile_id обязателен'}), 400
+    try:
+        profile_id = parse_record_id(profile_id, 'profile_id')
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
 
     conn = get_db_connection()
     try:
         cursor = conn.cursor()
 
+        # Запоминаем посты профиля, чтобы сбросить их из кэша
+        cursor.execute("SELECT post_id FROM posts WHERE profile_id = ?", (profile_id,))
+        post_ids = [str(row[0]) for row in cursor.fetchall()]
+
         # Удаляем все посты, связанные с этим профилем
         cursor.execute("DELETE FROM posts WHERE profile_id = ?", (profile_id,))
 
@@ -336,6 +1024,10 @@ def api_delete_profile():
         cursor.execute("DELETE FROM user_profiles WHERE profile_id = ?", (profile_id,))
         conn.commit()
 
+        profile_cache.invalidate(str(profile_id))
+        post_cache.invalidate(*post_ids)
+        invalidate_profile_posts(profile_id)
+
         if cursor.rowcount == 0:
             return jsonify({'status': 'error', 'message': 'Профиль не найден'}), 404
 
@@ -343,37 +1035,71 @@ def api_delete_profile():
     except Exception as e:
         return jsonify({'status': 'error', 'message': str(e)}), 500
     finally:
-        conn.close()
+        release_db_connection(conn)
+
+@app.route('/media/<digest>', methods=['GET'])
+def get_media(digest):
+    if not is_digest(digest) or not media_store.exists(digest):
+        abort(404)
+    path = media_store.path_for(digest)
+    # Содержимое по адресу не меняется — кэшировать можно бессрочно
+    response = send_file(path, mimetype=guess_mimetype(path), etag=digest, conditional=True, max_age=31536000)
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
+
+def resolve_photo_url(data, default=None):
+    """ photo_sha256 из тела запроса превращается в ссылку на файл в хранилище """
+    digest = data.get('photo_sha256')
+    if digest is None:
+        return data.get('photo_url', default)
+    if not is_digest(digest) or not media_store.exists(digest):
+        raise ValueError('photo_sha256 не найден в хранилище')
+    return media_store.url_for(digest)
 
 @app.route('/api/post', methods=['GET'])
 def api_get_post():
     post_id = request.args.get('post_id')
     if not post_id:
         return jsonify({'status': 'error', 'message': 'post_id обязателен'}), 400
+    try:
+        post_id = parse_record_id(post_id, 'post_id')
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+
+    entry = cache_get(post_cache, str(post_id))
+    if entry is not None:
+        return cached_response(entry)
 
+    generation = post_cache.generation()
     conn = get_db_connection()
     try:
         cursor = conn.cursor()
         cursor.execute("SELECT * FROM posts WHERE post_id = ?", (post_id,))
         post = cursor.fetchone()
         if post:
-            return jsonify(dict(post))
+            entry = make_cache_entry(dict(post))
+            post_cache.put(str(post_id), entry, generation)
+            return cached_response(entry)
         else:
             return jsonify({'status': 'error', 'message': 'Пост не найден'}), 404
     except Exception as e:
         return jsonify({'status': 'error', 'message': str(e)}), 500
     finally:
-        conn.close()
+        release_db_connection(conn)
 
 @app.route('/api/post', methods=['POST'])
 def api_create_post():
     data = request.get_json()
     profile_id = data.get('profile_id')
     content = data.get('content', '')
-    photo_url = data.get('photo_url', '')
 
     if not profile_id:
         return jsonify({'status': 'error', 'message': 'profile_id обязателен'}), 400
+    try:
+        profile_id = parse_record_id(profile_id, 'profile_id')
+        photo_url = resolve_photo_url(data, '')
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
 
     conn = get_db_connection()
     try:
@@ -383,56 +1109,75 @@ def api_create_post():
             VALUES (?, ?, ?)
         """, (profile_id, content, photo_url))
         conn.commit()
+        invalidate_profile_posts(profile_id)
         return jsonify({'status': 'success', 'post_id': cursor.lastrowid})
     except Exception as e:
         return jsonify({'status': 'error', 'message': str(e)}), 500
     finally:
-        conn.close()
+        release_db_connection(conn)
 
 @app.route('/api/post', methods=['PUT'])
 def api_update_post():
     data = request.get_json()
     post_id = data.get('post_id')
     content = data.get('content')
-    photo_url = data.get('photo_url')
 
     if not post_id:
         return jsonify({'status': 'error', 'message': 'post_id обязателен'}), 400
+    try:
+        post_id = parse_record_id(post_id, 'post_id')
+        photo_url = resolve_photo_url(data)
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
 
     conn = get_db_connection()
     try:
         cursor = conn.cursor()
+        cursor.execute("SELECT profile_id FROM posts WHERE post_id = ?", (post_id,))
+        owner = cursor.fetchone()
         cursor.execute("""
             UPDATE posts SET content = ?, photo_url = ?
             WHERE post_id = ?
         """, (content, photo_url, post_id))
         conn.commit()
+        post_cache.invalidate(str(post_id))
+        if owner is not None:
+            invalidate_profile_posts(owner[0])
         if cursor.rowcount == 0:
             return jsonify({'status': 'error', 'message': 'Пост не найден'}), 404
         return jsonify({'status': 'success'})
     except Exception as e:
         return jsonify({'status': 'error', 'message': str(e)}), 500
     finally:
-        conn.close()
+        release_db_connection(conn)
 
 @app.route('/api/post', methods=['DELETE'])
 def api_delete_post():
     post_id = request.args.get('post_id')
     if not post_id:
         return jsonify({'status': 'error', 'message': 'post_id обязателен'}), 400
+    try:
+        post_id = parse_record_id(post_id, 'post_id')
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
 
     conn = get_db_connection()
     try:
         cursor = conn.cursor()
+        cursor.execute("SELECT profile_id FROM posts WHERE post_id = ?", (post_id,))
+        owner = cursor.fetchone()
         cursor.execute("DELETE FROM posts WHERE post_id = ?", (post_id,))
         conn.commit()
+        post_cache.invalidate(str(post_id))
+        if owner is not None:
+            invalidate_profile_posts(owner[0])
         if cursor.rowcount == 0:
             return jsonify({'status': 'error', 'message': 'Пост не найден'}), 404
         return jsonify({'status': 'success'})
     except Exception as e:
         return jsonify({'status': 'error', 'message': str(e)}), 500
     finally:
-        conn.close()
+        release_db_connection(conn)
 
 @app.route('/api/posts', methods=['GET'])
 def api_get_posts_by_profile():
@@ -440,21 +1185,65 @@ def api_get_posts_by_profile():
     if not profile_id:
         return jsonify({'status': 'error', 'message': 'profile_id обязателен'}), 400
 
+    try:
+        profile_id = parse_record_id(profile_id, 'profile_id')
+        page = parse_page_args()
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+
+    if wants_ndjson():
+        if page is None:
+            return stream_ndjson(lambda conn: iter_posts_by_profile(conn, profile_id), dict)
+        after_id, before_id, limit = page
+        conn = get_db_connection()
+        try:
+            posts = get_posts_page(conn, profile_id, after_id, before_id, limit)
+        finally:
+            release_db_connection(conn)
+        if posts is None:
+            return jsonify({'status': 'error', 'message': 'Не удалось получить посты'}), 500
+        return page_ndjson(posts, dict, page_cursor_headers(
+            None, posts[-1]['post_id'] if len(posts) == limit else None))
+
+    cache_key = (str(profile_id), page)
+    entry = cache_get(posts_list_cache, cache_key)
+    if entry is not None:
+        return cached_response(entry)
+
+    generation = posts_list_cache.generation()
     conn = get_db_connection()
     try:
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT * FROM posts
-            WHERE profile_id = ?
-            ORDER BY created_at DESC
-        """, (profile_id,))
-        posts = cursor.fetchall()
-        return jsonify([dict(row) for row in posts])
+        if page is not None:
+            # Тело остается списком; курсор следующей (более старой) страницы — в заголовке
+            after_id, before_id, limit = page
+            posts = get_posts_page(conn, profile_id, after_id, before_id, limit)
+            if posts is None:
+                return jsonify({'status': 'error', 'message': 'Не удалось получить посты'}), 500
+            headers = {}
+            if len(posts) == limit:
+                headers['X-Next-Before-Id'] = str(posts[-1]['post_id'])
+            entry = make_cache_entry([dict(row) for row in posts], headers)
+        else:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT * FROM posts
+                WHERE profile_id = ?
+                ORDER BY created_at DESC
+            """, (profile_id,))
+            posts = cursor.fetchall()
+            entry = make_cache_entry([dict(row) for row in posts])
+        posts_list_cache.put(cache_key, entry, generation)
+        return cached_response(entry)
     except Exception as e:
         return jsonify({'status': 'error', 'message': str(e)}), 500
     finally:
-        conn.close()
+        release_db_connection(conn)
 
 
 if __name__ == '__main__':
+    # Отладочный однопроцессный сервер; для нескольких процессов — python serve.py.
+    # В режиме debug модуль выполняет и процесс перезагрузчика: SSE-сервер
+    # запускаем только в процессе, который обслуживает запросы
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        stream_server.start('0.0.0.0', STREAM_PORT)
     app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
@@ -0,0 +1,380 @@
+import asyncio
+import inspect
+import json
+import random
+from collections import deque
+from compression import ClientCompression, decode_frame
+from outbox import decode_deliver, encode_delivery_ack
+from protocol import (
+    MSG_COMPRESS, MSG_DELIVER, MSG_DIRECT, MSG_HELLO, MSG_JOIN, MSG_LEAVE, MSG_TEXT, MSG_UDP_BIND,
+    FrameError, FrameParser, decode_text, encode_frame
+)
+from udp_transport import BIND_ATTEMPTS, BIND_RETRY, PACKET_BIND, PACKET_CHALLENGE, UdpTransport
+
+READ_SIZE = 64 * 1024
+DEFAULT_MAX_PENDING = 10000   # кадров в очереди отправки
+DEFAULT_MAX_INBOX = 10000     # входящих сообщений, ожидающих чтения итератором
+MAX_WRITE_BATCH = 512         # кадров за один writelines
+BACKOFF_INITIAL = 0.5         # секунды
+BACKOFF_MAX = 30.0
+DELIVERED_IDS_KEPT = 10000    # номеров личных сообщений для отсева повторов
+
+_CLOSED = object()
+
+
+class ClientClosedError(Exception):
+    """ Клиент закрыт или не смог подключиться без переподключений """
+
+
+class AsyncClient:
+    """ Асинхронный клиент чата с конвейерной отправкой.
+
+    Отправка и прием идут независимыми задачами: send() только ставит
+    кадр в очередь и не ждет ответа, задача записи сбрасывает накопленные
+    кадры одним writelines. При обрыве клиент переподключается с
+    экспоненциальной задержкой, заново входит в свои комнаты и досылает
+    кадры, запись которых не завершилась (они могут прийти дважды).
+
+    С username клиент представляется серверу (MSG_HELLO) после каждого
+    подключения и получает личные сообщения из очереди outbox, в том
+    числе отправленные, пока он был офлайн. Каждое такое сообщение
+    подтверждается (MSG_DELIVERY_ACK), повторы отбрасываются по номеру.
+
+    compression=True предлагает серверу сжатие кадров (см. compression.py);
+    полученные словари запоминаются и при переподключении не передаются.
+
+    udp=True после каждого подключения привязывает к TCP-сессии UDP-адрес
+    клиента (см. UdpChatEndpoint): короткие сообщения send() и входящие
+    короткие сообщения идут датаграммами, длинные и недоставленные по
+    UDP — по TCP. Сервер без UDP-входа отказывает, и клиент остается на TCP.
+
+    Входящие сообщения доставляются в on_message(text) (функция или
+    корутина) либо, если обработчик не задан, через async for:
+
+        async with AsyncClient(host, port) as client:
+            await client.send('привет')
+            async for message in client:
+                print(message)
+    """
+
+    def __init__(self, host, port, on_message=None, on_frame=None, reconnect=True,
+                 max_pending=DEFAULT_MAX_PENDING, max_inbox=DEFAULT_MAX_INBOX,
+                 backoff_initial=BACKOFF_INITIAL, backoff_max=BACKOFF_MAX, username=None,
+                 compression=False, udp=False):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.on_message = on_message
+        self.on_frame = on_frame  # кадры других типов: on_frame(msg_type, payload)
+        self.reconnect = reconnect
+        self.backoff_initial = backoff_initial
+        self.backoff_max = backoff_max
+        self.rooms = set()
+        self.left_rooms = set()  # покинутые комнаты (например, lobby) — повторяем после переподключения
+        self.connected = asyncio.Event()
+        self.reconnects = 0
+        self.frames_sent = 0
+        self.messages_received = 0
+        self._outbox = asyncio.Queue(maxsize=max_pending)
+        self._inbox = asyncio.Queue(maxsize=max_inbox)
+        self._retry = []  # кадры, запись которых прервал обрыв соединения
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._closed = False
+        self._task = None
+        self._connect_error = None
+        self._delivered_ids = set()
+        self._delivered_order = deque()
+        self._compression = ClientCompression() if compression else None
+        self._codec = None  # WireCodec текущего соединения после ответа сервера
+        self.udp = udp
+        self.udp_bound = False  # UDP-адрес привязан к текущему соединению
+        self._udp = None        # UdpTransport, создается при первой привязке
+        self._server_addr = None
+        self._bind_task = None
+
+    # --- жизненный цикл ---
+
+    async def connect(self, timeout=None):
+        """ Подключается и запускает фоновые задачи; ждет первого подключения
+        (с переподключениями — до timeout секунд, без них — одну попытку) """
+        if self._task is None or self._task.done():
+            # Прошлый запуск завершился (например, неудачное подключение без переподключений)
+            self._closed = False
+            self._task = asyncio.create_task(self._run())
+        waiter = asyncio.create_task(self.connected.wait())
+        done, _ = await asyncio.wait((waiter, self._task), timeout=timeout,
+                                     return_when=asyncio.FIRST_COMPLETED)
+        if waiter not in done:
+            waiter.cancel()
+            if self._task.done():
+                # Исключение задачи уже отражено в _connect_error
+                self._task.exception()
+                self._task = None
+            else:
+                await self.close(flush=False)
+            raise ClientClosedError(f"Не удалось подключиться к {self.host}:{self.port}: {self._connect_error}")
+        return self
+
+    async def close(self, flush=True, timeout=5.0):
+        """ Закрывает клиент; по умолчанию сначала дожидается отправки очереди """
+        if flush and self.connected.is_set():
+            try:
+                await asyncio.wait_for(self.drain(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            if self._udp is not None:
+                await self._udp.drain(timeout)
+        self._closed = True
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except (asyncio.CancelledError, Exception):
+                pass
+            self._task = None
+        self.connected.clear()
+        if self._udp is not None:
+            self._udp.close()
+            self._udp = None
+        self._wake_iterators()
+
+    async def __aenter__(self):
+        return await self.connect()
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    # --- отправка ---
+
+    async def send_frame(self, msg_type, payload):
+        """ Ставит кадр в очередь; ждет только при переполненной очереди """
+        if self._closed:
+            raise ClientClosedError("Клиент закрыт")
+        self._idle.clear()
+        await self._outbox.put(encode_frame(msg_type, payload))
+
+    async def send(self, text):
+        if self.udp_bound and self.connected.is_set():
+            # Не поместится в датаграмму или не дойдет — транспорт вернет сообщение в _send_stream
+            self._udp.send(self._server_addr, text)
+            return
+        await self._send_stream(text)
+
+    async def _send_stream(self, text):
+        await self.send_frame(MSG_TEXT, text.encode('utf-8'))
+
+    async def send_direct(self, peer_id, text):
+        await self.send_frame(MSG_DIRECT, f"{peer_id}\0{text}".encode('utf-8'))
+
+    async def join(self, room):
+        self.rooms.add(room)
+        self.left_rooms.discard(room)
+        await self.send_frame(MSG_JOIN, room.encode('utf-8'))
+
+    async def leave(self, room):
+        self.rooms.discard(room)
+        self.left_rooms.add(room)
+        await self.send_frame(MSG_LEAVE, room.encode('utf-8'))
+
+    async def drain(self):
+        """ Ждет, пока все поставленные кадры будут переданы в сокет """
+        while self._outbox.qsize() or self._retry:
+            self._idle.clear()
+            await self._idle.wait()
+
+    def pending(self):
+        return self._outbox.qsize() + len(self._retry)
+
+    # --- прием ---
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._closed and self._inbox.empty():
+            raise StopAsyncIteration
+        message = await self._inbox.get()
+        if message is _CLOSED:
+            raise StopAsyncIteration
+        return message
+
+    def _wake_iterators(self):
+        try:
+            self._inbox.put_nowait(_CLOSED)
+        except asyncio.QueueFull:
+            pass
+
+    async def _deliver(self, message):
+        self.messages_received += 1
+        if self.on_message is None:
+            # Читатель не успевает — перестаем читать сокет, давление уходит серверу
+            await self._inbox.put(message)
+            return
+        result = self.on_message(message)
+        if inspect.isawaitable(result):
+            await result
+
+    # --- соединение ---
+
+    async def _run(self):
+        backoff = self.backoff_initial
+        try:
+            while not self._closed:
+                try:
+                    reader, writer = await asyncio.open_connection(self.host, self.port)
+                except OSError as e:
+                    self._connect_error = e
+                    if not self.reconnect:
+                        raise
+                else:
+                    backoff = self.backoff_initial
+                    await self._session(reader, writer)
+                    if not self.reconnect:
+                        break
+                    self.reconnects += 1
+                if self._closed:
+                    break
+                # Случайная добавка не дает всем клиентам переподключаться одновременно
+                await asyncio.sleep(backoff * (0.5 + random.random() / 2))
+                backoff = min(backoff * 2, self.backoff_max)
+        finally:
+            self._closed = True
+            self._wake_iterators()
+
+    async def _session(self, reader, writer):
+        # Приветствие и комнаты восстанавливаем раньше неотправленных кадров
+        rejoin = [encode_frame(MSG_HELLO, self.username.encode('utf-8'))] if self.username else []
+        rejoin += [encode_frame(MSG_JOIN, room.encode('utf-8')) for room in sorted(self.rooms)]
+        rejoin += [encode_frame(MSG_LEAVE, room.encode('utf-8')) for room in sorted(self.left_rooms)]
+        self._codec = None
+        if self._compression is not None:
+            rejoin.insert(0, self._compression.offer_frame())
+        self._server_addr = writer.get_extra_info('peername')[:2]
+        if self.udp:
+            # Привязка действует только для этого соединения
+            rejoin.append(encode_frame(MSG_UDP_BIND, b''))
+        self._retry[:0] = rejoin
+        self.connected.set()
+        tasks = [asyncio.create_task(self._write_loop(writer)),
+                 asyncio.create_task(self._read_loop(reader))]
+        try:
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            self.connected.clear()
+            self.udp_bound = False
+            if self._bind_task is not None:
+                self._bind_task.cancel()
+                self._bind_task = None
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except (ConnectionError, OSError):
+                pass
+
+    async def _write_loop(self, writer):
+        while True:
+            if not self._retry:
+                self._idle.set()
+                self._retry.append(await self._outbox.get())
+            # Забираем все, что накопилось, — один системный вызов на пачку
+            while len(self._retry) < MAX_WRITE_BATCH:
+                try:
+                    self._retry.append(self._outbox.get_nowait())
+                except asyncio.QueueEmpty:
+                    break
+            batch = self._retry
+            # В _retry кадры остаются несжатыми: после обрыва у нового соединения свой контекст
+            codec = self._codec
+            try:
+                writer.writelines(batch if codec is None else [codec.encode(frame) for frame in batch])
+                await writer.drain()
+            except (ConnectionError, OSError):
+                return
+            self._retry = []
+            self.frames_sent += len(batch)
+
+    async def _read_loop(self, reader):
+        parser = FrameParser()
+        try:
+            while True:
+                data = await reader.read(READ_SIZE)
+                if not data:
+                    return
+                parser.feed(data)
+                acks = []
+                for msg_type, payload in parser.frames():
+                    msg_type, payload = decode_frame(self._codec, msg_type, payload)
+                    if msg_type == MSG_TEXT:
+                        await self._deliver(decode_text(payload))
+                    elif msg_type == MSG_COMPRESS:
+                        if self._compression is not None:
+                            self._codec = self._compression.accept_reply(payload)
+                    elif msg_type == MSG_UDP_BIND:
+                        await self._on_udp_bind(payload)
+                    elif msg_type == MSG_DELIVER:
+                        outbox_id, sender, text = decode_deliver(payload)
+                        if self._remember_delivered(outbox_id):
+                            await self._deliver(f"{sender} (лично): {text}")
+                        # Повтор тоже подтверждаем: прошлое подтверждение могло потеряться
+                        acks.append(outbox_id)
+                    elif self.on_frame is not None:
+                        self.on_frame(msg_type, bytes(payload))
+                if acks:
+                    # Одно подтверждение на все сообщения из прочитанного блока
+                    self._idle.clear()
+                    await self._outbox.put(encode_delivery_ack(acks))
+        except (ConnectionError, OSError, FrameError):
+            return
+
+    # --- UDP ---
+
+    async def _on_udp_bind(self, payload):
+        try:
+            reply = json.loads(decode_text(payload))
+        except ValueError:
+            return
+        if not self.udp or not isinstance(reply, dict):
+            return
+        if reply.get('token'):
+            if self._udp is None:
+                self._udp = await UdpTransport.create(
+                    '0.0.0.0', 0, on_message=lambda addr, text: self._deliver(text),
+                    fallback=lambda addr, text: self._send_stream(text),
+                    admit=lambda addr: addr == self._server_addr, on_control=self._udp_control)
+            if self._bind_task is not None:
+                self._bind_task.cancel()
+            self._bind_task = asyncio.create_task(self._send_bind(bytes.fromhex(reply['token'])))
+        elif reply.get('bound'):
+            self.udp_bound = True
+            if self._bind_task is not None:
+                self._bind_task.cancel()
+                self._bind_task = None
+
+    async def _send_bind(self, token):
+        # Датаграмма или ответ на нее могут потеряться — повторяем, пока сервер не подтвердит
+        for _ in range(BIND_ATTEMPTS):
+            self._udp.send_control(self._server_addr, PACKET_BIND, token)
+            await asyncio.sleep(BIND_RETRY)
+
+    def _udp_control(self, addr, kind, body):
+        if kind == PACKET_CHALLENGE and addr == self._server_addr and self.connected.is_set():
+            # Проверка адреса возвращается по TCP: так сервер знает, что адрес наш
+            self._idle.clear()
+            try:
+                self._outbox.put_nowait(encode_frame(MSG_UDP_BIND, json.dumps({'challenge': body.hex()}).encode('utf-8')))
+            except asyncio.QueueFull:
+                pass
+
+    def _remember_delivered(self, outbox_id):
+        """ False, если сообщение с этим номером уже доставлялось """
+        if outbox_id in self._delivered_ids:
+            return False
+        self._delivered_ids.add(outbox_id)
+        self._delivered_order.append(outbox_id)
+        if len(self._delivered_order) > DELIVERED_IDS_KEPT:
+            self._delivered_ids.discard(self._delivered_order.popleft())
+        return True
@@ -0,0 +1,192 @@
+import asyncio
+import os
+import socket
+import time
+from file_transfer import FILE_FRAME_TYPES, STATUS_ERROR, FileReceiver, encode_ack
+from compression import decode_frame, handle_compress_offer
+from logs import get_logger
+from outbox import DELIVERY_FRAME_TYPES
+from protocol import MSG_COMPRESS, MSG_UDP_BIND, FrameParser, FrameError
+from router import (
+    MESSAGE_HANDLE_SECONDS, TCP_CONNECTIONS_ACCEPTED, TCP_RECV_BYTES,
+    AsyncPeer, MessageRouter, peer_id_for
+)
+from udp_transport import handle_udp_bind
+
+log = get_logger('tcp')
+
+READ_SIZE = 64 * 1024
+DEFAULT_BACKLOG = 1024
+
+# Реестр клиентов своего процесса (у каждого рабочего процесса — свой)
+router = MessageRouter()
+
+
+async def handle_connection(reader, writer, on_message, stats=None, media_store=None, delivery=None,
+                            compression=None, udp=None):
+    """ Обслуживает одно соединение в цикле событий (без отдельных потоков) """
+    addr = writer.get_extra_info('peername')
+    log.info("Подключился клиент %s", addr)
+    loop = asyncio.get_running_loop()
+    parser = FrameParser()
+    peer = AsyncPeer(peer_id_for(addr), writer, loop)
+    router.register(peer)
+    TCP_CONNECTIONS_ACCEPTED.labels('async').inc()
+    recv_bytes = TCP_RECV_BYTES.labels('async')
+    handle_seconds = MESSAGE_HANDLE_SECONDS.labels('async')
+    if stats is not None:
+        stats.opened()
+    files = FileReceiver(media_store) if media_store is not None else None
+    try:
+        while True:
+            data = await reader.read(READ_SIZE)
+            if not data:
+                log.info("Клиент %s отключился", addr)
+                break
+            recv_bytes.observe(len(data))
+            if stats is not None:
+                stats.received(len(data))
+            parser.feed(data)
+            for msg_type, payload in parser.frames():
+                msg_type, payload = decode_frame(peer.codec, msg_type, payload)
+                if msg_type == MSG_COMPRESS:
+                    handle_compress_offer(peer, compression, payload)
+                    continue
+                if msg_type == MSG_UDP_BIND:
+                    handle_udp_bind(peer, udp, addr, payload)
+                    continue
+                if msg_type in FILE_FRAME_TYPES:
+                    if files is None:
+                        replies = [encode_ack(None, STATUS_ERROR, message='file transfer is disabled')]
+                    else:
+                        # Запись на диск и хэш — в пуле потоков; буфер парсера
+                        # не меняется, пока не прочитаны следующие данные
+                        replies = await loop.run_in_executor(None, files.handle, msg_type, payload)
+                    for reply in replies:
+                        peer.enqueue(reply)
+                    continue
+                if delivery is not None and msg_type in DELIVERY_FRAME_TYPES:
+                    # Очередь доставки работает с БД — тоже в пуле потоков
+                    await loop.run_in_executor(None, delivery.handle_frame, peer, msg_type, payload)
+                    continue
+                started = time.perf_counter()
+                message = router.handle_frame(peer, msg_type, payload)
+                if message is None:
+                    continue
+                if stats is not None:
+                    stats.received(0, messages=1)
+                log.debug("Сообщение от %s: %s", addr, message)
+                if on_message is not None:
+                    # Сохранение в БД блокирующее, поэтому уводим его в пул потоков.
+                    # Пока обработчик не вернулся, новые данные из сокета не читаются.
+                    await loop.run_in_executor(None, on_message, addr, message)
+                handle_seconds.observe(time.perf_counter() - started)
+    except (ConnectionError, OSError, FrameError) as e:
+        log.warning("Ошибка при получении данных от %s: %s", addr, e)
+    finally:
+        if files is not None:
+            files.close()
+        if delivery is not None:
+            delivery.disconnect(peer)
+        if udp is not None:
+            udp.unbind(peer)
+        router.unregister(peer)
+        if stats is not None:
+            stats.closed(peer)
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except (ConnectionError, OSError):
+            pass
+
+
+def create_listen_socket(port, backlog=DEFAULT_BACKLOG, reuse_port=False):
+    """ Создает неблокирующий слушающий сокет """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        # Несколько процессов слушают один порт, ядро распределяет подключения
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind(('', port))
+    sock.listen(backlog)
+    sock.setblocking(False)
+    return sock
+
+
+async def serve(sock, on_message=None, stats=None):
+    """ Принимает подключения на готовом сокете до отмены задачи """
+    server = await asyncio.start_server(
+        lambda reader, writer: handle_connection(reader, writer, on_message, stats),
+        sock=sock
+    )
+    async with server:
+        await server.serve_forever()
+
+
+async def serve_until(sock, stop_event, on_message=None, stats=None, drain_timeout=5.0, media_store=None,
+                      delivery=None, compression=None, udp=None):
+    """ Принимает подключения, пока не выставлен stop_event (asyncio.Event),
+    затем закрывает соединения и дает обработчикам до drain_timeout секунд
+    на завершение начатой записи сообщений """
+    server = await asyncio.start_server(
+        lambda reader, writer: handle_connection(reader, writer, on_message, stats, media_store, delivery,
+                                                 compression, udp),
+        sock=sock
+    )
+    await stop_event.wait()
+    server.close()
+    # Закрытие транспорта дает обработчикам EOF: уже принятые сообщения
+    # успевают уйти в on_message до выхода из цикла чтения
+    for peer in router.peers():
+        router.unregister(peer)
+    current = asyncio.current_task()
+    handlers = [task for task in asyncio.all_tasks() if task is not current]
+    if handlers:
+        _, pending = await asyncio.wait(handlers, timeout=drain_timeout)
+        for task in pending:
+            task.cancel()
+    await server.wait_closed()
+
+
+def _run_worker(port, on_message, backlog, reuse_port):
+    sock = create_listen_socket(port, backlog, reuse_port)
+    print(f"[Инфо] Асинхронный сервер (pid {os.getpid()}) слушает порт {port}")
+    try:
+        asyncio.run(serve(sock, on_message))
+    except KeyboardInterrupt:
+        print("\n[Инфо] Работа сервера остановлена пользователем.")
+    finally:
+        sock.close()
+
+
+def start_async_server(port, on_message=None, workers=1, backlog=DEFAULT_BACKLOG):
+    """ Запускает asyncio-сервер: один цикл событий на процесс.
+
+    При workers > 1 запускаются дочерние процессы с SO_REUSEPORT
+    (по одному циклу событий на ядро). Вызов блокирующий.
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers > 1 and not (hasattr(socket, 'SO_REUSEPORT') and hasattr(os, 'fork')):
+        print("[Предупреждение] SO_REUSEPORT недоступен, запускается один процесс.")
+        workers = 1
+
+    reuse_port = workers > 1
+    children = []
+    for _ in range(workers - 1):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                _run_worker(port, on_message, backlog, reuse_port)
+            finally:
+                os._exit(0)
+        children.append(pid)
+
+    try:
+        _run_worker(port, on_message, backlog, reuse_port)
+    finally:
+        for pid in children:
+            try:
+                os.waitpid(pid, 0)
+            except (ChildProcessError, KeyboardInterrupt):
+                pass
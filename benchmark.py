@@ -0,0 +1,363 @@
+""" Нагрузочные тесты TCP-сервера и REST API.
+
+Примеры:
+    python benchmark.py tcp --clients 500 --messages 20 --size 256 --fanout 10
+    python benchmark.py api --requests 2000 --concurrency 16
+    python benchmark.py all --output results.json
+
+Результаты печатаются в формате JSON, чтобы прогоны можно было сравнивать.
+"""
+import argparse
+import asyncio
+import http.client
+import json
+import multiprocessing
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from protocol import (
+    HEADER, MSG_JOIN, MSG_LEAVE, MSG_TEXT, FrameParser, decode_text, encode_frame, encode_text
+)
+from router import DEFAULT_ROOM
+
+
+def percentiles(samples):
+    """ p50/p99/p999 и максимум в миллисекундах """
+    if not samples:
+        return {'p50_ms': None, 'p99_ms': None, 'p999_ms': None, 'max_ms': None}
+    ordered = sorted(samples)
+    last = len(ordered) - 1
+
+    def pick(fraction):
+        return round(ordered[min(last, int(fraction * len(ordered)))] * 1000, 3)
+
+    return {
+        'p50_ms': pick(0.50),
+        'p99_ms': pick(0.99),
+        'p999_ms': pick(0.999),
+        'max_ms': round(ordered[-1] * 1000, 3)
+    }
+
+
+def rss_bytes(pid=None):
+    """ Текущий RSS процесса из /proc (None, если недоступно) """
+    path = f"/proc/{pid or 'self'}/status"
+    try:
+        with open(path) as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        return None
+    return None
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.5):
+                return True
+        except OSError:
+            time.sleep(0.05)
+    return False
+
+
+# --- TCP ---
+
+def _run_tcp_server(port, server_mode):
+    # Вывод сервера (по строке на сообщение) исказил бы замеры
+    sys.stdout = open(os.devnull, 'w')
+    if server_mode == 'async':
+        from async_server import start_async_server
+        start_async_server(port)
+    else:
+        # Без шага UPnP из server.main
+        from server import start_server
+        start_server(port)
+
+
+async def _tcp_client(index, port, args, state):
+    """ Синтетический клиент по образцу Client.start_client, но без ожидания ответа """
+    try:
+        await _tcp_client_session(index, port, args, state)
+    except (ConnectionError, OSError):
+        state['errors'] += 1
+    finally:
+        if not state['start'].is_set():
+            state['ready'] += 1
+
+
+async def _tcp_client_session(index, port, args, state):
+    started = time.perf_counter()
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    state['connect_times'].append(time.perf_counter() - started)
+
+    # Клиенты делятся на комнаты по fanout участников
+    room = f"bench-{index // args.fanout}".encode('utf-8')
+    writer.write(encode_frame(MSG_JOIN, room) + encode_frame(MSG_LEAVE, DEFAULT_ROOM.encode('utf-8')))
+    await writer.drain()
+    state['ready'] += 1
+    await state['start'].wait()
+
+    async def receive():
+        parser = FrameParser()
+        while True:
+            try:
+                data = await reader.read(64 * 1024)
+            except (ConnectionError, OSError):
+                state['errors'] += 1
+                break
+            if not data:
+                break
+            parser.feed(data)
+            now = time.perf_counter()
+            for msg_type, payload in parser.frames():
+                if msg_type != MSG_TEXT:
+                    continue
+                # Формат доставки: "<отправитель>: <отметка времени>|<заполнитель>"
+                text = decode_text(payload)
+                sent_at = float(text.split(': ', 1)[1].split('|', 1)[0])
+                state['latencies'].append(now - sent_at)
+                state['received'] += 1
+                state['received_bytes'] += HEADER.size + len(payload)
+                if state['received'] >= state['expected']:
+                    state['done'].set()
+
+    receiver = asyncio.create_task(receive())
+    padding = 'x' * max(0, args.size - 20)
+    for _ in range(args.messages):
+        writer.write(encode_text(f"{time.perf_counter():.9f}|{padding}"))
+        state['sent'] += 1
+        await writer.drain()
+    await state['done'].wait()
+    receiver.cancel()
+    writer.close()
+
+
+async def _tcp_benchmark(port, args):
+    loop = asyncio.get_running_loop()
+    state = {
+        'connect_times': [], 'latencies': [], 'ready': 0, 'sent': 0, 'errors': 0,
+        'received': 0, 'received_bytes': 0,
+        'start': asyncio.Event(), 'done': asyncio.Event()
+    }
+    rooms_full, remainder = divmod(args.clients, args.fanout)
+    room_sizes = [args.fanout] * rooms_full + ([remainder] if remainder else [])
+    state['expected'] = sum(size * (size - 1) for size in room_sizes) * args.messages
+    if state['expected'] == 0:
+        state['done'].set()
+
+    connect_started = loop.time()
+    tasks = [asyncio.create_task(_tcp_client(i, port, args, state)) for i in range(args.clients)]
+    while state['ready'] < args.clients:
+        await asyncio.sleep(0.01)
+    connect_elapsed = loop.time() - connect_started
+
+    # Даем серверу обработать JOIN/LEAVE до начала рассылки
+    await asyncio.sleep(0.2)
+    send_started = loop.time()
+    state['start'].set()
+    try:
+        await asyncio.wait_for(state['done'].wait(), args.timeout)
+    except asyncio.TimeoutError:
+        state['done'].set()
+    elapsed = loop.time() - send_started
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+    return {
+        'connections': args.clients,
+        'connect_seconds': round(connect_elapsed, 4),
+        'connections_per_sec': round(args.clients / connect_elapsed, 1) if connect_elapsed else None,
+        'connect_latency': percentiles(state['connect_times']),
+        'messages_sent': state['sent'],
+        'messages_expected': state['expected'],
+        'messages_delivered': state['received'],
+        'delivery_seconds': round(elapsed, 4),
+        'messages_per_sec': round(state['received'] / elapsed, 1) if elapsed else None,
+        'delivered_bytes_per_sec': round(state['received_bytes'] / elapsed, 1) if elapsed else None,
+        'latency': percentiles(state['latencies']),
+        'connection_errors': state['errors'],
+    }
+
+
+def run_tcp(args):
+    port = free_port()
+    context = multiprocessing.get_context('fork' if hasattr(os, 'fork') else 'spawn')
+    process = context.Process(target=_run_tcp_server, args=(port, args.server_mode), daemon=True)
+    process.start()
+    try:
+        if not wait_for_port(port):
+            raise RuntimeError(f"TCP-сервер не запустился на порту {port}")
+        rss_before = rss_bytes(process.pid)
+        result = asyncio.run(_tcp_benchmark(port, args))
+        result.update({
+            'server_mode': args.server_mode,
+            'message_size': args.size,
+            'fanout': args.fanout,
+            'server_rss_before': rss_before,
+            'server_rss_after': rss_bytes(process.pid),
+        })
+        return result
+    finally:
+        process.terminate()
+        process.join(5)
+
+
+# --- REST API ---
+
+def _start_api(db_file):
+    # Замеры идут на отдельной временной БД: app при импорте создает схему,
+    # применяет миграции и запускает запись сообщений по пути из P2P_DB_FILE
+    if 'app' in sys.modules:
+        raise RuntimeError("app уже импортирован, БД для замеров не подменить")
+    os.environ['P2P_DB_FILE'] = db_file
+    os.environ.pop('P2P_DB_INITIALIZED', None)
+    os.environ.pop('P2P_CONTROL_SOCKET', None)
+    import app as app_module
+    from werkzeug.serving import make_server
+
+    server = make_server('127.0.0.1', 0, app_module.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def _request(connection, method, path, body=None):
+    headers = {'Content-Type': 'application/json'} if body is not None else {}
+    connection.request(method, path, body=json.dumps(body) if body is not None else None, headers=headers)
+    response = connection.getresponse()
+    data = response.read()
+    return response.status, data
+
+
+def _bench_endpoint(port, method, path_factory, body_factory, requests, concurrency):
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+    per_worker = max(1, requests // concurrency)
+
+    def worker(worker_index):
+        nonlocal errors
+        connection = http.client.HTTPConnection('127.0.0.1', port)
+        local = []
+        local_errors = 0
+        for i in range(per_worker):
+            n = worker_index * per_worker + i
+            started = time.perf_counter()
+            try:
+                status, _ = _request(connection, method, path_factory(n), body_factory(n) if body_factory else None)
+                if status >= 400:
+                    local_errors += 1
+            except (OSError, http.client.HTTPException):
+                local_errors += 1
+                connection.close()
+                connection = http.client.HTTPConnection('127.0.0.1', port)
+            local.append(time.perf_counter() - started)
+        connection.close()
+        with lock:
+            latencies.extend(local)
+            errors += local_errors
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(worker, range(concurrency)))
+    elapsed = time.perf_counter() - started
+    total = per_worker * concurrency
+    return {
+        'requests': total,
+        'errors': errors,
+        'seconds': round(elapsed, 4),
+        'requests_per_sec': round(total / elapsed, 1) if elapsed else None,
+        'latency': percentiles(latencies),
+    }
+
+
+def run_api(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        server = _start_api(os.path.join(tmp, 'bench.sqlite'))
+        port = server.server_port
+        try:
+            # Подготовка данных: профиль с постами и пользователь с историей
+            connection = http.client.HTTPConnection('127.0.0.1', port)
+            _, body = _request(connection, 'POST', '/api/profile', {'bio': 'benchmark'})
+            profile_id = json.loads(body)['profile_id']
+            for i in range(args.posts):
+                _request(connection, 'POST', '/api/post', {'profile_id': profile_id, 'content': f'post {i}'})
+            _request(connection, 'POST', '/api/messages/bulk', [
+                {'username': 'bench', 'message': f'history {i}'} for i in range(args.history)
+            ])
+            connection.close()
+
+            results = {
+                'POST /api/messages': _bench_endpoint(
+                    port, 'POST', lambda n: '/api/messages',
+                    lambda n: {'username': f'user{n % 100}', 'message': 'x' * args.size},
+                    args.requests, args.concurrency),
+                'GET /api/messages': _bench_endpoint(
+                    port, 'GET', lambda n: f'/api/messages?username=bench&limit={args.page}',
+                    None, args.requests, args.concurrency),
+                'GET /api/profile': _bench_endpoint(
+                    port, 'GET', lambda n: f'/api/profile?profile_id={profile_id}',
+                    None, args.requests, args.concurrency),
+                'GET /api/posts': _bench_endpoint(
+                    port, 'GET', lambda n: f'/api/posts?profile_id={profile_id}',
+                    None, args.requests, args.concurrency),
+            }
+            return {
+                'concurrency': args.concurrency,
+                'endpoints': results,
+                'rss': rss_bytes(),
+            }
+        finally:
+            server.shutdown()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Нагрузочные тесты TCP-сервера и REST API")
+    parser.add_argument('target', choices=('tcp', 'api', 'all'))
+    parser.add_argument('--server-mode', choices=('threads', 'async'), default='async')
+    parser.add_argument('--clients', type=int, default=100, help="число TCP-клиентов")
+    parser.add_argument('--messages', type=int, default=10, help="сообщений от каждого клиента")
+    parser.add_argument('--size', type=int, default=128, help="размер сообщения, байт")
+    parser.add_argument('--fanout', type=int, default=10, help="участников в комнате")
+    parser.add_argument('--timeout', type=float, default=60, help="ожидание доставки, сек")
+    parser.add_argument('--requests', type=int, default=1000, help="запросов на эндпоинт")
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--posts', type=int, default=50, help="постов в тестовом профиле")
+    parser.add_argument('--history', type=int, default=1000, help="сообщений в тестовой истории")
+    parser.add_argument('--page', type=int, default=100, help="limit для GET /api/messages")
+    parser.add_argument('--output', help="файл для JSON с результатами")
+    args = parser.parse_args(argv)
+    if args.fanout < 1:
+        parser.error("--fanout должен быть >= 1")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    results = {'timestamp': time.time(), 'argv': sys.argv[1:] if argv is None else argv}
+    if args.target in ('tcp', 'all'):
+        results['tcp'] = run_tcp(args)
+    if args.target in ('api', 'all'):
+        results['api'] = run_api(args)
+
+    output = json.dumps(results, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    print(output)
+
+
+if __name__ == '__main__':
+    main()
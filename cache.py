@@ -0,0 +1,78 @@
+import threading
+import time
+from collections import OrderedDict
+
+DEFAULT_MAX_SIZE = 1024
+DEFAULT_TTL = 30.0  # секунды
+
+
+class TTLCache:
+    """ Потокобезопасный LRU-кэш с ограничением времени жизни записей.
+
+    Защита от гонки чтения и записи: читатель запоминает generation()
+    до обращения к БД и передает его в put(); если за это время была
+    инвалидация, устаревшее значение в кэш не попадет.
+    """
+
+    def __init__(self, max_size=DEFAULT_MAX_SIZE, ttl=DEFAULT_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def generation(self):
+        return self._generation
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value, generation=None):
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return False
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+            return True
+
+    def invalidate(self, *keys):
+        with self._lock:
+            self._generation += 1
+            for key in keys:
+                self._data.pop(key, None)
+
+    def invalidate_matching(self, predicate):
+        """ Удаляет все записи, ключ которых удовлетворяет predicate """
+        with self._lock:
+            self._generation += 1
+            for key in [key for key in self._data if predicate(key)]:
+                del self._data[key]
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self._data),
+                'max_size': self.max_size,
+                'ttl': self.ttl
+            }
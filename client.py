@@ -1,22 +1,76 @@
+import asyncio
 import socket
+from async_client import AsyncClient, ClientClosedError
+from file_transfer import FileTransferError, send_file
+from protocol import MSG_TEXT, decode_text
 
 class Client:
-    def start_client(server_ip, port):
-        """Starts the client to connect to the server."""
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as client_socket:
-            client_socket.connect((server_ip, port))  # Connect to the server
-            print(f'Connected to server at {server_ip}:{port}')
+    def start_client(server_ip, port, username=None):
+        """Starts the interactive client: typing and incoming messages run independently."""
+        try:
+            asyncio.run(Client.run_interactive(server_ip, port, username))
+        except KeyboardInterrupt:
+            print("Exiting chat.")
 
+    async def run_interactive(server_ip, port, username=None):
+        """Reads lines from stdin and sends them without waiting for replies.
+        With a username, direct messages sent while offline arrive on connect.
+        Frame compression and a UDP path for short messages are offered;
+        a server without them simply declines and the client stays on TCP."""
+        loop = asyncio.get_running_loop()
+        client = AsyncClient(server_ip, port, on_message=lambda text: print(f'Received from server: {text}'),
+                             username=username, compression=True, udp=True)
+        try:
+            await client.connect(timeout=10)
+        except ClientClosedError as e:
+            print(e)
+            return
+        print(f'Connected to server at {server_ip}:{port}')
+        try:
             while True:
-                message = input("Enter message (or 'exit' to quit): ")
+                # input() блокирующий — читаем его в пуле потоков, прием не останавливается
+                message = await loop.run_in_executor(
+                    None, input, "Enter message, '/to <user> <text>', '/file <path>' to upload, or 'exit' to quit: ")
                 if message.lower() == 'exit':
                     print("Exiting chat.")
                     break
-                client_socket.sendall(message.encode())  # Send message to server
-                response = client_socket.recv(1024)  # Wait for response from server
-                print(f'Received from server: {response.decode()}')
+                if message.startswith('/file '):
+                    path = message[len('/file '):].strip()
+                    await loop.run_in_executor(None, Client.upload_file, server_ip, port, path)
+                    continue
+                if message.startswith('/to '):
+                    recipient, _, text = message[len('/to '):].strip().partition(' ')
+                    if recipient and text:
+                        await client.send_direct(recipient, text)
+                    continue
+                if message:
+                    await client.send(message)
+        except (EOFError, ClientClosedError):
+            pass
+        finally:
+            await client.close()
+
+    def upload_file(server_ip, port, path):
+        """Sends a file over a separate connection; prints the link to use as a post photo_url."""
+        try:
+            with socket.create_connection((server_ip, port)) as sock:
+                ack = send_file(sock, path)
+        except (OSError, FileTransferError) as e:
+            print(f'File transfer failed: {e}')
+            return
+        print(f"File stored as {ack['sha256']} ({ack['status']}): {ack.get('url')}")
+
+    def receive_message(client_socket, parser):
+        """Reads from the socket until one complete text frame is available."""
+        while True:
+            for msg_type, payload in parser.frames():
+                if msg_type == MSG_TEXT:
+                    return decode_text(payload)
+            if not parser.recv_into(client_socket):
+                return None
 
 if __name__ == '__main__':
     server_ip = input("Enter the server IP address: ")  # Get server IP address from user
+    username = input("Enter your username (empty to stay anonymous): ").strip() or None
     port = 7777  # Port must match the server's port
-    Client.start_client(server_ip, port)
+    Client.start_client(server_ip, port, username)
@@ -0,0 +1,302 @@
+""" Связь процессов serve.py.
+
+HTTP-процессы не владеют TCP-сервером и не видят шины и кэшей друг
+друга, поэтому:
+
+- управление TCP-сервером идет через unix-сокет процесса tcp
+  (ControlServer в нем, RemoteServerController в HTTP-процессах);
+- новые сообщения каждый процесс читает из БД (MessageFeed) и
+  публикует в свою шину с id = message_id, так что Last-Event-ID
+  одинаков во всех процессах;
+- изменения профилей и постов триггеры пишут в журнал
+  cache_invalidations, и CacheSync применяет его перед каждым
+  чтением из кэша.
+"""
+import json
+import os
+import socket
+import socketserver
+import threading
+from contextlib import contextmanager
+from types import SimpleNamespace
+from logs import get_logger
+from users_database import (
+    get_cache_invalidation_bounds, get_cache_invalidations, get_max_message_id, get_messages_since, get_pool
+)
+
+log = get_logger('cluster')
+
+CONTROL_SOCKET_ENV = 'P2P_CONTROL_SOCKET'
+CONTROL_TIMEOUT = 5.0      # секунды на ответ, кроме остановки сервера
+MAX_CONTROL_MESSAGE = 64 * 1024
+FEED_INTERVAL = 0.1        # секунды между опросами новых сообщений
+FEED_BATCH = 500
+
+
+@contextmanager
+def _pooled(db_file):
+    pool = get_pool(db_file)
+    conn = pool.acquire()
+    try:
+        yield conn
+    finally:
+        pool.release(conn)
+
+
+# --- управление TCP-сервером ---
+
+class ControlError(ConnectionError):
+    """ Процесс TCP-сервера недоступен """
+
+
+class ControlServer:
+    """ Принимает команды для ServerController по unix-сокету.
+
+    Запрос и ответ — одна строка JSON: {"command": ..., "args": {...}} и
+    {"ok": true, "result": ...} либо {"ok": false, "error": тип, "message": ...}.
+    """
+
+    def __init__(self, controller, path):
+        self.controller = controller
+        self.path = path
+        self._server = None
+        self._thread = None
+
+    def start(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        controller = self.controller
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                line = self.rfile.readline(MAX_CONTROL_MESSAGE)
+                try:
+                    request = json.loads(line)
+                    reply = {'ok': True, 'result': dispatch(controller, request['command'], request.get('args', {}))}
+                except Exception as e:
+                    reply = {'ok': False, 'error': type(e).__name__, 'message': str(e)}
+                self.wfile.write(json.dumps(reply).encode('utf-8') + b'\n')
+
+        self._server = socketserver.ThreadingUnixStreamServer(self.path, Handler)
+        self._server.daemon_threads = True
+        os.chmod(self.path, 0o600)
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        log.info("Управление TCP-сервером на %s", self.path)
+        return self
+
+    def stop(self):
+        if self._server is None:
+            return
+        self._server.shutdown()
+        self._server.server_close()
+        self._server = None
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def _state(controller):
+    return {
+        'running': controller.is_running(),
+        'port': controller.port,
+        'mode': controller.mode,
+        'backlog': controller.backlog,
+        'udp': bool(controller.udp),
+        'active': controller.stats.active
+    }
+
+
+def dispatch(controller, command, args):
+    if command == 'state':
+        return _state(controller)
+    if command == 'status':
+        return controller.status()
+    if command == 'start':
+        controller.start(args['port'], args.get('mode') or 'threads', args.get('backlog'))
+        return _state(controller)
+    if command == 'stop':
+        return controller.stop()
+    if command == 'restart':
+        controller.restart(args.get('port'), args.get('mode'), args.get('backlog'))
+        return _state(controller)
+    if command == 'notify_delivery':
+        controller.notify_delivery(args['recipient'])
+        return None
+    raise ValueError(f"Неизвестная команда: {command}")
+
+
+class RemoteServerController:
+    """ ServerController процесса tcp, доступный из HTTP-процессов.
+
+    Повторяет используемую API часть интерфейса ServerController;
+    ошибки start/restart приходят тем же типом (ValueError, RuntimeError,
+    OSError), недоступный процесс — ControlError.
+    """
+
+    ERRORS = {'ValueError': ValueError, 'RuntimeError': RuntimeError, 'OSError': OSError}
+
+    def __init__(self, path, stop_timeout):
+        self.path = path
+        self.stop_timeout = stop_timeout
+
+    def _call(self, command, timeout=CONTROL_TIMEOUT, **args):
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                sock.settimeout(timeout)
+                sock.connect(self.path)
+                sock.sendall(json.dumps({'command': command, 'args': args}).encode('utf-8') + b'\n')
+                with sock.makefile('rb') as reader:
+                    line = reader.readline(MAX_CONTROL_MESSAGE)
+        except OSError as e:
+            raise ControlError(f"TCP server process is not available: {e}") from e
+        if not line:
+            raise ControlError("TCP server process closed the control connection")
+        reply = json.loads(line)
+        if not reply['ok']:
+            raise self.ERRORS.get(reply['error'], RuntimeError)(reply['message'])
+        return reply['result']
+
+    def _state(self):
+        return self._call('state')
+
+    def is_running(self):
+        return self._state()['running']
+
+    @property
+    def port(self):
+        return self._state()['port']
+
+    @property
+    def mode(self):
+        return self._state()['mode']
+
+    @property
+    def backlog(self):
+        return self._state()['backlog']
+
+    @property
+    def udp(self):
+        return self._state()['udp']
+
+    @property
+    def stats(self):
+        return SimpleNamespace(active=self._state()['active'])
+
+    def start(self, port, mode='threads', backlog=None):
+        self._call('start', port=port, mode=mode, backlog=backlog)
+
+    def stop(self, timeout=None):
+        return self._call('stop', timeout=(timeout or self.stop_timeout) + CONTROL_TIMEOUT)
+
+    def restart(self, port=None, mode=None, backlog=None):
+        self._call('restart', timeout=self.stop_timeout + CONTROL_TIMEOUT, port=port, mode=mode, backlog=backlog)
+
+    def status(self):
+        return self._call('status')
+
+    def notify_delivery(self, recipient):
+        # Процесс tcp и сам подхватит запись из outbox при очередном обходе
+        try:
+            self._call('notify_delivery', recipient=recipient)
+        except (ControlError, RuntimeError) as e:
+            log.debug("Уведомление о доставке не передано: %s", e)
+
+
+# --- новые сообщения ---
+
+class MessageFeed:
+    """ Публикует в шину процесса сообщения, записанные любым процессом.
+
+    Опрашивает messages раз в interval секунд по курсору message_id
+    (в WAL зафиксированные строки видны сразу, а id растут в порядке
+    фиксации, так что курсор ничего не пропускает).
+    """
+
+    def __init__(self, db_file, bus, interval=FEED_INTERVAL, batch=FEED_BATCH):
+        self.db_file = db_file
+        self.bus = bus
+        self.interval = interval
+        self.batch = batch
+        self._stop = threading.Event()
+        self._thread = None
+        self._last_id = 0
+
+    def start(self):
+        with _pooled(self.db_file) as conn:
+            self._last_id = get_max_message_id(conn)
+        self.bus.seek(self._last_id)
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self, timeout=5):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def poll(self):
+        """ Публикует сообщения после курсора; возвращает их число """
+        with _pooled(self.db_file) as conn:
+            rows = get_messages_since(conn, self._last_id, self.batch) or []
+        if rows:
+            self._last_id = rows[-1][0]
+            self.bus.publish_many([{
+                'username': username,
+                'text': text,
+                'timestamp': timestamp,
+                'source': 'db'
+            } for _, username, text, timestamp in rows], ids=[row[0] for row in rows])
+        return len(rows)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                # Полная пачка — вероятно, есть еще: читаем без паузы
+                if self.poll() >= self.batch:
+                    continue
+            except Exception as e:
+                log.error("Ошибка чтения новых сообщений: %s", e)
+            self._stop.wait(self.interval)
+
+
+# --- инвалидация кэшей ---
+
+class CacheSync:
+    """ Применяет журнал cache_invalidations к кэшам своего процесса.
+
+    handlers: имя кэша в журнале -> функция(ключ) сброса записи.
+    sync() вызывается перед чтением из кэша: запрос по первичному
+    ключу журнала дешевле промаха кэша, а изменение, зафиксированное
+    другим процессом, становится видно сразу, а не через TTL. Если
+    процесс отстал больше, чем хранит журнал, кэши очищаются целиком.
+    """
+
+    def __init__(self, db_file, handlers, clear):
+        self.db_file = db_file
+        self.handlers = handlers
+        self.clear = clear
+        self._last_id = None
+        self._lock = threading.Lock()
+
+    def sync(self):
+        with self._lock, _pooled(self.db_file) as conn:
+            if self._last_id is None:
+                self._last_id = get_cache_invalidation_bounds(conn)[1]
+                return
+            while True:
+                rows = get_cache_invalidations(conn, self._last_id)
+                if not rows:
+                    return
+                if rows[0][0] > self._last_id + 1:
+                    # id журнала идут подряд: пропуск значит, что часть уже удалена
+                    self.clear()
+                else:
+                    for _, cache, key in rows:
+                        handler = self.handlers.get(cache)
+                        if handler is not None:
+                            handler(key)
+                self._last_id = rows[-1][0]
@@ -0,0 +1,271 @@
+""" Сжатие сообщений на TCP-соединении чата.
+
+Клиент после подключения отправляет MSG_COMPRESS с JSON
+{"codecs": [...], "dicts": [...]} — поддерживаемые кодеки и id уже
+известных ему словарей. Сервер отвечает MSG_COMPRESS: JSON
+{"codec", "dict", "threshold"}, затем байт \\0 и сам словарь, если
+клиент его еще не знает. После ответа обе стороны могут сжимать кадры
+не короче threshold байт и помечают их битом FLAG_COMPRESSED в типе.
+
+Контекст сжатия живет все соединение: каждое сообщение сбрасывается
+через Z_SYNC_FLUSH (zstd — FLUSH_BLOCK), поэтому следующее может
+ссылаться на предыдущие и на словарь, обученный на messages.message_text.
+Короткие повторяющиеся реплики чата сжимаются в несколько байт, а
+сжатие одного сообщения занимает микросекунды. Распакованный кадр,
+как и обычный, не может быть длиннее MAX_FRAME_SIZE.
+"""
+import hashlib
+import json
+import zlib
+from collections import Counter
+from protocol import (
+    FLAG_COMPRESSED, HEADER, HEADER_SIZE, MAX_FRAME_SIZE, MSG_COMPRESS, MSG_DELIVER, MSG_DIRECT,
+    MSG_TEXT, FrameError, decode_text, encode_frame
+)
+from metrics import Counter as MetricCounter
+from users_database import get_message_samples, get_pool
+
+# Необязательная зависимость: без нее предлагается только zlib
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+DECOMPRESS_ERRORS = (zlib.error, ValueError) + ((zstandard.ZstdError,) if zstandard is not None else ())
+
+CODEC_ZSTD = 'zstd'
+CODEC_ZLIB = 'zlib'
+
+COMPRESSIBLE_TYPES = frozenset((MSG_TEXT, MSG_DIRECT, MSG_DELIVER))
+DEFAULT_THRESHOLD = 48      # байт полезной нагрузки: короче — выигрыш меньше заголовка
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 3
+# Окно 16 КБ и memLevel 6: около 100 КБ на соединение вместо 256 КБ по умолчанию
+ZLIB_WBITS = 14
+ZLIB_MEM_LEVEL = 6
+DICT_SIZE = 1 << ZLIB_WBITS  # больший словарь zlib все равно не увидит
+DICT_SAMPLES = 5000
+SYNC_MARKER = b'\x00\x00\xff\xff'  # хвост каждого Z_SYNC_FLUSH; не передаем
+# decompressobj() zstd не ограничивает вывод, поэтому сжатые данные подаются
+# шагами: из 64 байт получается не больше нескольких блоков по 128 КБ
+ZSTD_INPUT_STEP = 64
+
+# stage: raw — байты до сжатия, wire — после
+WIRE_COMPRESSION_BYTES = MetricCounter('wire_compression_bytes_total', 'Полезная нагрузка сжатых кадров', ('stage',))
+_RAW_BYTES = WIRE_COMPRESSION_BYTES.labels('raw')
+_WIRE_BYTES = WIRE_COMPRESSION_BYTES.labels('wire')
+
+
+def available_codecs():
+    return (CODEC_ZSTD, CODEC_ZLIB) if zstandard is not None else (CODEC_ZLIB,)
+
+
+def dictionary_id(codec, dictionary):
+    return hashlib.sha256(codec.encode('ascii') + dictionary).hexdigest()[:16]
+
+
+def train_raw_dictionary(samples, size=DICT_SIZE):
+    """ Словарь-заготовка для zlib: частые сообщения, фразы до трех слов и слова.
+
+    Чем полезнее строка (частота × длина), тем ближе к концу словаря она
+    стоит — на близкие строки deflate ссылается короче.
+    """
+    counts = Counter()
+    for text in samples:
+        if len(text) <= 200:
+            counts[text] += 1
+        words = text.split()
+        for size_in_words in (1, 2, 3):
+            for index in range(len(words) - size_in_words + 1):
+                phrase = ' '.join(words[index:index + size_in_words])
+                if len(phrase) > 3:
+                    counts[phrase + ' '] += 1
+    pieces = []
+    total = 0
+    for piece, count in sorted(counts.items(), key=lambda item: item[1] * len(item[0]), reverse=True):
+        if count < 2:
+            continue
+        data = piece.encode('utf-8')
+        if total + len(data) > size:
+            continue
+        pieces.append(data)
+        total += len(data)
+    return b''.join(reversed(pieces))
+
+
+def train_dictionary(codec, samples, size=DICT_SIZE):
+    if codec == CODEC_ZSTD:
+        try:
+            return zstandard.train_dictionary(size, [text.encode('utf-8') for text in samples]).as_bytes()
+        except zstandard.ZstdError:
+            # Слишком мало примеров для обучения — словарь из частых строк
+            pass
+    return train_raw_dictionary(samples, size)
+
+
+class WireCodec:
+    """ Сжатие одного соединения в обе стороны.
+
+    encode() вызывается на стороне отправки строго в порядке кадров
+    (Peer._take_all, AsyncClient._write_loop); до прохождения ответа
+    MSG_COMPRESS кадры уходят как есть, если active=False.
+    """
+
+    def __init__(self, codec, dictionary=b'', threshold=DEFAULT_THRESHOLD, active=False,
+                 max_frame_size=MAX_FRAME_SIZE):
+        self.codec = codec
+        self.threshold = threshold
+        self.active = active
+        self.max_frame_size = max_frame_size
+        if codec == CODEC_ZSTD:
+            zdict = zstandard.ZstdCompressionDict(dictionary) if dictionary else None
+            self._compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL, dict_data=zdict).compressobj()
+            self._decompressor = zstandard.ZstdDecompressor(dict_data=zdict).decompressobj()
+        elif codec == CODEC_ZLIB:
+            options = {'zdict': dictionary} if dictionary else {}
+            self._compressor = zlib.compressobj(ZLIB_LEVEL, zlib.DEFLATED, -ZLIB_WBITS, ZLIB_MEM_LEVEL, **options)
+            self._decompressor = zlib.decompressobj(-ZLIB_WBITS, **options)
+        else:
+            raise ValueError(f"Неизвестный кодек: {codec}")
+
+    def encode(self, frame):
+        """ Готовый кадр -> кадр для передачи (сжатый, если подходит) """
+        size, msg_type = HEADER.unpack_from(frame)
+        if msg_type == MSG_COMPRESS:
+            # Ответ на согласование ушел — все следующие кадры можно сжимать
+            self.active = True
+            return frame
+        if not self.active or size < self.threshold or msg_type not in COMPRESSIBLE_TYPES:
+            return frame
+        data = self.compress(memoryview(frame)[HEADER_SIZE:])
+        _RAW_BYTES.inc(size)
+        _WIRE_BYTES.inc(len(data))
+        return HEADER.pack(len(data), msg_type | FLAG_COMPRESSED) + data
+
+    def compress(self, data):
+        if self.codec == CODEC_ZSTD:
+            return self._compressor.compress(data) + self._compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+        return (self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH))[:-len(SYNC_MARKER)]
+
+    def decode(self, msg_type, payload):
+        """ (тип с флагом, сжатая нагрузка) -> (тип, исходная нагрузка) """
+        try:
+            if self.codec == CODEC_ZSTD:
+                data = self._decompress_zstd(bytes(payload))
+            else:
+                data = self._decompressor.decompress(bytes(payload) + SYNC_MARKER, self.max_frame_size + 1)
+                if len(data) > self.max_frame_size or self._decompressor.unconsumed_tail:
+                    raise FrameError(f"Распакованный кадр больше {self.max_frame_size} байт")
+        except DECOMPRESS_ERRORS as e:
+            raise FrameError(f"Не удалось распаковать кадр: {e}")
+        return msg_type & ~FLAG_COMPRESSED, data
+
+    def _decompress_zstd(self, payload):
+        chunks, size = [], 0
+        for offset in range(0, len(payload), ZSTD_INPUT_STEP):
+            chunk = self._decompressor.decompress(payload[offset:offset + ZSTD_INPUT_STEP])
+            size += len(chunk)
+            if size > self.max_frame_size:
+                raise FrameError(f"Распакованный кадр больше {self.max_frame_size} байт")
+            chunks.append(chunk)
+        return b''.join(chunks)
+
+
+def decode_frame(codec, msg_type, payload):
+    """ Распаковывает кадр с FLAG_COMPRESSED; остальные возвращает как есть """
+    if not msg_type & FLAG_COMPRESSED:
+        return msg_type, payload
+    if codec is None:
+        raise FrameError("Сжатый кадр без согласованного сжатия")
+    return codec.decode(msg_type, payload)
+
+
+class WireCompression:
+    """ Настройки сжатия сервера: словари по кодекам и порог.
+
+    Словари обучаются один раз (from_database) и отдаются клиентам при
+    согласовании; для каждого соединения accept() создает свой WireCodec.
+    """
+
+    def __init__(self, dictionaries=None, codecs=None, threshold=DEFAULT_THRESHOLD):
+        self.codecs = tuple(codecs or available_codecs())
+        self.dictionaries = dictionaries or {}
+        self.dictionary_ids = {codec: dictionary_id(codec, data) for codec, data in self.dictionaries.items()}
+        self.threshold = threshold
+
+    @classmethod
+    def from_database(cls, db_file, samples=DICT_SAMPLES, **kwargs):
+        pool = get_pool(db_file)
+        conn = pool.acquire()
+        try:
+            texts = get_message_samples(conn, samples)
+        finally:
+            pool.release(conn)
+        codecs = tuple(kwargs.pop('codecs', None) or available_codecs())
+        dictionaries = {codec: train_dictionary(codec, texts) for codec in codecs} if texts else {}
+        print(f"[Инфо] Словари сжатия обучены на {len(texts)} сообщениях: "
+              + (', '.join(f"{codec} {len(data)} Б" for codec, data in dictionaries.items()) or 'нет'))
+        return cls(dictionaries, codecs, **kwargs)
+
+    def accept(self, offer_payload):
+        """ Обрабатывает предложение клиента; возвращает (WireCodec или None, кадр ответа) """
+        try:
+            offer = json.loads(decode_text(offer_payload))
+            offered = offer.get('codecs') or ()
+            known = set(offer.get('dicts') or ())
+        except (ValueError, AttributeError):
+            offered, known = (), set()
+        codec = next((name for name in self.codecs if name in offered), None)
+        if codec is None:
+            return None, encode_frame(MSG_COMPRESS, json.dumps({'codec': None}).encode('utf-8'))
+        dictionary = self.dictionaries.get(codec, b'')
+        dict_id = self.dictionary_ids.get(codec)
+        reply = json.dumps({'codec': codec, 'dict': dict_id, 'threshold': self.threshold}).encode('utf-8')
+        # Словарь передаем, только если у клиента его нет
+        attached = dictionary if dict_id and dict_id not in known else b''
+        return WireCodec(codec, dictionary, self.threshold), encode_frame(MSG_COMPRESS, reply + b'\0' + attached)
+
+
+def handle_compress_offer(peer, compression, payload):
+    """ Согласование на стороне сервера: ответ уходит в очередь участника,
+    кодек включается, когда ответ пройдет через отправку """
+    if compression is None:
+        peer.enqueue(encode_frame(MSG_COMPRESS, json.dumps({'codec': None}).encode('utf-8')))
+        return
+    codec, reply = compression.accept(payload)
+    # Кодек ставим до ответа: кадры, стоящие в очереди раньше ответа, уйдут несжатыми
+    peer.codec = codec
+    peer.enqueue(reply)
+
+
+class ClientCompression:
+    """ Сторона клиента: предложение, разбор ответа и кэш словарей по id """
+
+    def __init__(self, codecs=None):
+        self.codecs = tuple(codecs or available_codecs())
+        self.dictionaries = {}
+
+    def offer_frame(self):
+        offer = {'codecs': list(self.codecs), 'dicts': list(self.dictionaries)}
+        return encode_frame(MSG_COMPRESS, json.dumps(offer).encode('utf-8'))
+
+    def accept_reply(self, payload):
+        """ Ответ сервера -> активный WireCodec или None """
+        data = bytes(payload)
+        header, _, attached = data.partition(b'\0')
+        try:
+            reply = json.loads(header)
+        except ValueError as e:
+            raise FrameError(f"Некорректный ответ на согласование сжатия: {e}")
+        codec = reply.get('codec')
+        if codec is None:
+            return None
+        dict_id = reply.get('dict')
+        if dict_id and attached:
+            if dictionary_id(codec, attached) != dict_id:
+                raise FrameError("Словарь сжатия не совпадает с объявленным id")
+            self.dictionaries[dict_id] = attached
+        dictionary = self.dictionaries.get(dict_id, b'') if dict_id else b''
+        if dict_id and not dictionary:
+            raise FrameError(f"Сервер не передал словарь {dict_id}")
+        return WireCodec(codec, dictionary, reply.get('threshold', DEFAULT_THRESHOLD), active=True)
@@ -0,0 +1,375 @@
+import hashlib
+import json
+import os
+import re
+import struct
+import threading
+from protocol import (
+    HEADER, MSG_FILE_ACK, MSG_FILE_CHUNK, MSG_FILE_OFFER,
+    FrameParser, encode_frame, send_frame
+)
+
+MEDIA_ROOT = 'media'
+MAX_MEDIA_SIZE = 512 * 1024 * 1024
+MAX_STORE_SIZE = 20 * 1024 * 1024 * 1024     # всего в хранилище, включая недокачанные
+MAX_CONNECTION_UPLOAD = 1024 * 1024 * 1024  # байт от одного соединения
+MAX_CONNECTION_TRANSFERS = 4                 # одновременных приемов на соединение
+CHUNK_SIZE = 256 * 1024
+HASH_READ_SIZE = 1024 * 1024
+
+# Префикс кадра MSG_FILE_CHUNK: sha256 файла и смещение данных
+CHUNK_PREFIX = struct.Struct('!32sQ')
+
+FILE_FRAME_TYPES = (MSG_FILE_OFFER, MSG_FILE_CHUNK, MSG_FILE_ACK)
+
+# Статусы в MSG_FILE_ACK
+STATUS_ACCEPTED = 'accepted'  # можно слать части начиная с offset
+STATUS_EXISTS = 'exists'      # файл уже есть в хранилище
+STATUS_COMPLETE = 'complete'  # файл принят и проверен
+STATUS_BUSY = 'busy'          # этот файл сейчас принимается по другому соединению
+STATUS_ERROR = 'error'
+
+_DIGEST_RE = re.compile(r'[0-9a-f]{64}')
+
+# Сигнатуры для Content-Type при раздаче через /media
+_MAGIC = (
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+)
+
+
+class FileTransferError(Exception):
+    """ Передача файла отклонена получателем или прервана """
+
+
+def is_digest(value):
+    return isinstance(value, str) and _DIGEST_RE.fullmatch(value) is not None
+
+
+def file_digest(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(HASH_READ_SIZE)
+            if not block:
+                break
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def guess_mimetype(path):
+    with open(path, 'rb') as f:
+        head = f.read(16)
+    for magic, mimetype in _MAGIC:
+        if head.startswith(magic):
+            return mimetype
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'image/webp'
+    return 'application/octet-stream'
+
+
+class MediaStore:
+    """ Хранилище файлов с адресацией по содержимому.
+
+    Файл лежит по пути root/<2 символа sha256>/<sha256>, поэтому одинаковые
+    файлы хранятся один раз, а ссылка /media/<sha256> (её можно записать в
+    posts.photo_url) никогда не меняет содержимого. Недокачанные файлы
+    хранятся в root/.partial и дописываются при повторной передаче.
+
+    Объем хранилища ограничен max_store_size: прием резервирует место
+    под недостающую часть файла при предложении и отказывает, если
+    квота уже занята файлами и идущими приемами.
+    """
+
+    def __init__(self, root=MEDIA_ROOT, max_file_size=MAX_MEDIA_SIZE, max_store_size=MAX_STORE_SIZE):
+        self.root = root
+        self.max_file_size = max_file_size
+        self.max_store_size = max_store_size
+        self._active = set()
+        self._lock = threading.Lock()
+        self._used = None  # байт на диске; считается при первом резервировании
+        self._reserved = 0
+
+    def path_for(self, digest):
+        return os.path.join(self.root, digest[:2], digest)
+
+    def partial_path(self, digest):
+        return os.path.join(self.root, '.partial', digest + '.part')
+
+    def exists(self, digest):
+        return os.path.isfile(self.path_for(digest))
+
+    def url_for(self, digest):
+        return f'/media/{digest}'
+
+    def claim(self, digest):
+        """ Закрепляет прием файла за одним соединением """
+        with self._lock:
+            if digest in self._active:
+                return False
+            self._active.add(digest)
+            return True
+
+    def release(self, digest):
+        with self._lock:
+            self._active.discard(digest)
+
+    def _disk_usage(self):
+        total = 0
+        for dirpath, _, filenames in os.walk(self.root):
+            for name in filenames:
+                try:
+                    total += os.path.getsize(os.path.join(dirpath, name))
+                except OSError:
+                    pass
+        return total
+
+    def reserve(self, nbytes):
+        """ Резервирует место под принимаемые байты; False, если квота исчерпана """
+        with self._lock:
+            if self._used is None:
+                self._used = self._disk_usage()
+            if self._used + self._reserved + nbytes > self.max_store_size:
+                return False
+            self._reserved += nbytes
+            return True
+
+    def settle(self, reserved, written):
+        """ Снимает резерв после приема: written байт остались на диске
+        (отрицательное значение — удаленный недокачанный файл) """
+        with self._lock:
+            self._reserved -= reserved
+            if self._used is not None:
+                self._used += written
+
+    def usage(self):
+        with self._lock:
+            return {'used': self._used, 'reserved': self._reserved, 'max': self.max_store_size}
+
+    def commit(self, digest):
+        """ Переносит проверенный файл из .partial в хранилище """
+        path = self.path_for(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(self.partial_path(digest), path)
+        return path
+
+
+class IncomingTransfer:
+    """ Прием одного файла: запись частей в .partial и хэш по мере записи """
+
+    def __init__(self, store, digest, size):
+        self.store = store
+        self.digest = digest
+        self.size = size
+        self.sha = hashlib.sha256()
+        path = store.partial_path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.file = open(path, 'a+b')
+        self.offset = self.file.seek(0, os.SEEK_END)
+        if self.offset > size:
+            self.file.truncate(0)
+            self.offset = 0
+        self.initial_offset = self.offset
+        self.reserved = 0  # место, зарезервированное в хранилище под этот прием
+        if self.offset:
+            # Продолжение после обрыва: хэш уже записанной части считаем один раз
+            self.file.seek(0)
+            remaining = self.offset
+            while remaining:
+                block = self.file.read(min(HASH_READ_SIZE, remaining))
+                self.sha.update(block)
+                remaining -= len(block)
+
+    def write(self, offset, data):
+        if offset != self.offset:
+            raise FileTransferError(f'ожидалось смещение {self.offset}, получено {offset}')
+        if self.offset + len(data) > self.size:
+            raise FileTransferError('данных больше заявленного размера')
+        # data — memoryview из буфера парсера: пишется на диск без копирования
+        self.file.write(data)
+        self.sha.update(data)
+        self.offset += len(data)
+
+    def complete(self):
+        return self.offset == self.size
+
+    def finish(self):
+        """ Проверяет хэш и переносит файл в хранилище; False при несовпадении """
+        self.file.close()
+        if self.sha.hexdigest() != self.digest:
+            os.remove(self.store.partial_path(self.digest))
+            self.store.settle(self.reserved, -self.initial_offset)
+            return False
+        self.store.commit(self.digest)
+        self.store.settle(self.reserved, self.offset - self.initial_offset)
+        return True
+
+    def close(self):
+        # Недокачанный файл остается в .partial для продолжения
+        self.file.close()
+        self.store.settle(self.reserved, self.offset - self.initial_offset)
+
+
+def encode_ack(digest, status, **fields):
+    return encode_frame(MSG_FILE_ACK, json.dumps(dict(fields, sha256=digest, status=status)).encode('utf-8'))
+
+
+class FileReceiver:
+    """ Принимающая сторона протокола файлов для одного соединения.
+
+    handle() получает кадр MSG_FILE_OFFER/MSG_FILE_CHUNK и возвращает
+    список готовых кадров-ответов, которые транспорт ставит в очередь
+    отправки клиенту.
+
+    Одно соединение может принимать не больше max_transfers файлов
+    одновременно и передать не больше max_upload байт за все время.
+    """
+
+    def __init__(self, store, max_upload=MAX_CONNECTION_UPLOAD, max_transfers=MAX_CONNECTION_TRANSFERS):
+        self.store = store
+        self.max_upload = max_upload
+        self.max_transfers = max_transfers
+        self.committed = 0  # байт, обещанных этому соединению по принятым предложениям
+        self._transfers = {}  # sha256 (bytes) -> IncomingTransfer
+
+    def handle(self, msg_type, payload):
+        if msg_type == MSG_FILE_OFFER:
+            return [self._offer(payload)]
+        if msg_type == MSG_FILE_CHUNK:
+            reply = self._chunk(payload)
+            return [reply] if reply is not None else []
+        return []
+
+    def _offer(self, payload):
+        try:
+            offer = json.loads(str(payload, 'utf-8'))
+            digest = offer['sha256']
+            size = int(offer['size'])
+        except (ValueError, KeyError, TypeError):
+            return encode_ack(None, STATUS_ERROR, message='invalid offer')
+        if not is_digest(digest):
+            return encode_ack(None, STATUS_ERROR, message='invalid sha256')
+        if size < 0 or size > self.store.max_file_size:
+            return encode_ack(digest, STATUS_ERROR, message='file too large')
+        if self.store.exists(digest):
+            return encode_ack(digest, STATUS_EXISTS, offset=size, url=self.store.url_for(digest))
+
+        key = bytes.fromhex(digest)
+        transfer = self._transfers.get(key)
+        if transfer is None:
+            if len(self._transfers) >= self.max_transfers:
+                return encode_ack(digest, STATUS_ERROR, message='too many concurrent transfers')
+            if not self.store.claim(digest):
+                return encode_ack(digest, STATUS_BUSY)
+            try:
+                transfer = IncomingTransfer(self.store, digest, size)
+            except OSError as e:
+                self.store.release(digest)
+                return encode_ack(digest, STATUS_ERROR, message=str(e))
+            need = size - transfer.offset
+            if self.committed + need > self.max_upload:
+                message = 'connection upload quota exceeded'
+            elif not self.store.reserve(need):
+                message = 'media storage quota exceeded'
+            else:
+                message = None
+            if message is not None:
+                transfer.close()
+                self.store.release(digest)
+                return encode_ack(digest, STATUS_ERROR, message=message)
+            transfer.reserved = need
+            self.committed += need
+            self._transfers[key] = transfer
+        if transfer.complete():
+            return self._finish(key, transfer)
+        return encode_ack(digest, STATUS_ACCEPTED, offset=transfer.offset)
+
+    def _chunk(self, payload):
+        if len(payload) < CHUNK_PREFIX.size:
+            return encode_ack(None, STATUS_ERROR, message='invalid chunk')
+        key, offset = CHUNK_PREFIX.unpack_from(payload)
+        transfer = self._transfers.get(key)
+        if transfer is None:
+            return encode_ack(key.hex(), STATUS_ERROR, message='no offer for this file')
+        try:
+            transfer.write(offset, payload[CHUNK_PREFIX.size:])
+        except (FileTransferError, OSError) as e:
+            self._drop(key, transfer)
+            return encode_ack(transfer.digest, STATUS_ERROR, message=str(e), offset=transfer.offset)
+        if transfer.complete():
+            return self._finish(key, transfer)
+        # Промежуточные части не подтверждаются: отправитель шлет поток без ожидания
+        return None
+
+    def _finish(self, key, transfer):
+        del self._transfers[key]
+        try:
+            ok = transfer.finish()
+        finally:
+            self.store.release(transfer.digest)
+        if not ok:
+            return encode_ack(transfer.digest, STATUS_ERROR, message='sha256 mismatch')
+        return encode_ack(transfer.digest, STATUS_COMPLETE, offset=transfer.size,
+                          url=self.store.url_for(transfer.digest))
+
+    def _drop(self, key, transfer):
+        self._transfers.pop(key, None)
+        transfer.close()
+        self.store.release(transfer.digest)
+
+    def close(self):
+        for key, transfer in list(self._transfers.items()):
+            self._drop(key, transfer)
+
+
+def _wait_ack(sock, parser, digest, on_frame=None):
+    """ Читает кадры до ответа по нашему файлу; прочие кадры отдает on_frame """
+    while True:
+        for msg_type, payload in parser.frames():
+            if msg_type == MSG_FILE_ACK:
+                ack = json.loads(str(payload, 'utf-8'))
+                if ack.get('sha256') in (digest, None):
+                    return ack
+            elif on_frame is not None:
+                on_frame(msg_type, payload)
+        if not parser.recv_into(sock):
+            raise FileTransferError('соединение закрыто до ответа получателя')
+
+
+def send_file(sock, path, parser=None, on_frame=None, chunk_size=CHUNK_SIZE):
+    """ Передает файл по соединению с сервером (блокирующий сокет).
+
+    Данные частей уходят через socket.sendfile (os.sendfile) прямо из
+    кэша страниц без копирования в пространство процесса. Если получатель
+    уже имеет начало файла, передача продолжается с его смещения.
+    Возвращает последний ответ получателя (status complete или exists).
+    """
+    parser = parser or FrameParser()
+    digest = file_digest(path)
+    size = os.path.getsize(path)
+    offer = {'sha256': digest, 'size': size, 'name': os.path.basename(path)}
+    send_frame(sock, MSG_FILE_OFFER, json.dumps(offer).encode('utf-8'))
+
+    ack = _wait_ack(sock, parser, digest, on_frame)
+    if ack['status'] in (STATUS_EXISTS, STATUS_COMPLETE):
+        return ack
+    if ack['status'] != STATUS_ACCEPTED:
+        raise FileTransferError(ack.get('message') or ack['status'])
+
+    key = bytes.fromhex(digest)
+    offset = ack['offset']
+    with open(path, 'rb') as f:
+        while offset < size:
+            count = min(chunk_size, size - offset)
+            prefix = CHUNK_PREFIX.pack(key, offset)
+            sock.sendall(HEADER.pack(CHUNK_PREFIX.size + count, MSG_FILE_CHUNK) + prefix)
+            if sock.sendfile(f, offset, count) != count:
+                raise FileTransferError('файл изменился во время передачи')
+            offset += count
+
+    ack = _wait_ack(sock, parser, digest, on_frame)
+    if ack['status'] != STATUS_COMPLETE:
+        raise FileTransferError(ack.get('message') or ack['status'])
+    return ack
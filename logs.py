@@ -0,0 +1,71 @@
+import logging
+import os
+import threading
+import time
+
+LOG_LEVEL_ENV = 'P2P_LOG_LEVEL'
+LOG_FORMAT = '%(asctime)s %(levelname)s %(name)s: %(message)s'
+RATE_LIMIT_PERIOD = 10.0  # секунды
+RATE_LIMIT_BURST = 5      # записей одного шаблона за период
+
+
+class RateLimitFilter(logging.Filter):
+    """ Пропускает не больше burst записей одного шаблона за period секунд.
+
+    Шаблон — это исходная строка формата (record.msg), поэтому сообщения
+    нужно логировать с аргументами, а не f-строками. Число подавленных
+    записей дописывается к первой записи следующего периода.
+    """
+
+    def __init__(self, period=RATE_LIMIT_PERIOD, burst=RATE_LIMIT_BURST):
+        super().__init__()
+        self.period = period
+        self.burst = burst
+        self._windows = {}  # (логгер, шаблон) -> [начало периода, пропущено, подавлено]
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        key = (record.name, record.msg)
+        now = time.monotonic()
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None or now - window[0] >= self.period:
+                suppressed = window[2] if window is not None else 0
+                self._windows[key] = [now, 1, 0]
+                if len(self._windows) > 10000:
+                    self._windows.clear()
+                if suppressed:
+                    record.msg = f"{record.msg} (подавлено похожих: {suppressed})"
+                return True
+            if window[1] < self.burst:
+                window[1] += 1
+                return True
+            window[2] += 1
+            return False
+
+
+_configured = False
+_configure_lock = threading.Lock()
+
+
+def configure_logging(level=None):
+    """ Настраивает корневой обработчик один раз на процесс; уровень
+    берется из P2P_LOG_LEVEL (по умолчанию INFO) """
+    global _configured
+    with _configure_lock:
+        if _configured:
+            return
+        level = level or os.environ.get(LOG_LEVEL_ENV, 'INFO')
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter(LOG_FORMAT))
+        handler.addFilter(RateLimitFilter())
+        root = logging.getLogger('p2p')
+        root.addHandler(handler)
+        root.setLevel(level.upper() if isinstance(level, str) else level)
+        root.propagate = False
+        _configured = True
+
+
+def get_logger(name):
+    configure_logging()
+    return logging.getLogger(f'p2p.{name}')
@@ -0,0 +1,475 @@
+""" Mesh-сеть узлов чата: обнаружение участников через gossip и
+рассылка сообщений по соседям вместо одного центрального сервера.
+
+Каждый узел держит ограниченное число долгоживущих соединений с
+другими узлами (не меньше min_peers, не больше max_peers) и раз в
+gossip_interval отправляет нескольким соседям список известных ему
+участников с их счетчиками heartbeat. Участник, чей heartbeat не рос
+дольше fail_timeout, забывается; его адрес еще 2×fail_timeout хранится
+как надгробие, чтобы устаревшие списки соседей не вернули его обратно.
+Сообщения расходятся по соседям с
+ограничением TTL, повторы отсекаются по id сообщения.
+
+Клиенты чата подключаются к любому узлу (--chat-port), поэтому
+нагрузка распределяется между узлами:
+
+    python mesh.py --port 16000 --chat-port 15001
+    python mesh.py --port 16001 --seed 127.0.0.1:16000 --chat-port 15002
+
+Проверка на localhost с множеством узлов в одном процессе:
+
+    python mesh.py --simulate 50 --port 17000
+"""
+import argparse
+import asyncio
+import json
+import random
+import statistics
+import struct
+import time
+import uuid
+from collections import OrderedDict
+from async_server import create_listen_socket
+from logs import configure_logging, get_logger
+from metrics import Counter
+from protocol import (
+    MSG_GOSSIP, MSG_MESH, MSG_PEER_HELLO,
+    FrameError, FrameParser, decode_text, encode_frame, encode_text
+)
+from router import DEFAULT_ROOM, AsyncPeer
+
+log = get_logger('mesh')
+
+# event: published, delivered, forwarded, duplicate, expired
+MESH_MESSAGES = Counter('mesh_messages_total', 'Сообщения mesh-сети по результату обработки', ('event',))
+
+DEFAULT_MIN_PEERS = 4
+DEFAULT_MAX_PEERS = 8
+DEFAULT_FANOUT = 3          # соседей, получающих список участников за один раунд
+DEFAULT_TTL = 8
+GOSSIP_INTERVAL = 1.0       # секунды
+FAIL_TIMEOUT = 10.0         # секунды без роста heartbeat до исключения участника
+HANDSHAKE_TIMEOUT = 5.0
+MAX_DIGEST = 256            # участников в одном кадре MSG_GOSSIP
+MAX_MEMBERS = 4096          # известных участников на узел
+MAX_ADDR_LENGTH = 64
+SEEN_IDS_KEPT = 65536       # id сообщений для отсева повторов
+READ_SIZE = 64 * 1024
+
+ROUTE_HEADER = struct.Struct('!16sB')  # id сообщения + оставшийся TTL
+
+
+def encode_mesh(msg_id, ttl, origin, dest, text):
+    return encode_frame(MSG_MESH, ROUTE_HEADER.pack(msg_id, ttl) + f"{origin}\0{dest}\0{text}".encode('utf-8'))
+
+
+def decode_mesh(payload):
+    """ (id, ttl, узел-источник, адресат или '', текст) из MSG_MESH """
+    if len(payload) < ROUTE_HEADER.size:
+        raise FrameError("Слишком короткий кадр MSG_MESH")
+    msg_id, ttl = ROUTE_HEADER.unpack_from(payload)
+    parts = decode_text(payload[ROUTE_HEADER.size:]).split('\0', 2)
+    if len(parts) != 3:
+        raise FrameError("Некорректный кадр MSG_MESH")
+    origin, dest, text = parts
+    return msg_id, ttl, origin, dest, text
+
+
+def split_addr(addr):
+    host, _, port = addr.rpartition(':')
+    return host, int(port)
+
+
+class MeshNode:
+    """ Узел mesh-сети в цикле событий asyncio.
+
+    Входящие сообщения передаются в on_message(origin, text) и, если
+    задан router (MessageRouter TCP-сервера чата), рассылаются локальным
+    клиентам в комнату lobby. publish() отправляет сообщение всем узлам
+    (или одному адресату dest), publish_threadsafe() — то же из других
+    потоков, например из обработчика ServerController.
+    """
+
+    def __init__(self, port, host='127.0.0.1', seeds=(), min_peers=DEFAULT_MIN_PEERS,
+                 max_peers=DEFAULT_MAX_PEERS, fanout=DEFAULT_FANOUT, ttl=DEFAULT_TTL,
+                 gossip_interval=GOSSIP_INTERVAL, fail_timeout=FAIL_TIMEOUT,
+                 on_message=None, router=None):
+        self.port = port
+        self.addr = f"{host}:{port}"
+        self.seeds = [seed for seed in seeds if seed != self.addr]
+        self.min_peers = min_peers
+        self.max_peers = max(max_peers, min_peers)
+        self.fanout = fanout
+        self.ttl = ttl
+        self.gossip_interval = gossip_interval
+        self.fail_timeout = fail_timeout
+        self.on_message = on_message
+        self.router = router
+        self.heartbeat = 0
+        self.members = {}      # адрес -> [heartbeat, время последнего роста]
+        self.tombstones = {}   # адрес -> (последний heartbeat, время исключения)
+        self.neighbours = {}   # адрес -> AsyncPeer
+        self.delivered = 0
+        self.forwarded = 0
+        self.duplicates = 0
+        self._dialing = set()
+        self._failed = {}      # адрес -> время неудачного подключения
+        self._seen = OrderedDict()
+        self._server = None
+        self._tasks = set()
+        self._loop = None
+
+    # --- жизненный цикл ---
+
+    async def start(self):
+        self._loop = asyncio.get_running_loop()
+        sock = create_listen_socket(self.port)
+        self._server = await asyncio.start_server(self._accept, sock=sock)
+        self._spawn(self._maintain())
+        log.info("Узел %s запущен, начальные узлы: %s", self.addr, ', '.join(self.seeds) or 'нет')
+        return self
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+        for peer in list(self.neighbours.values()):
+            peer.close()
+        tasks = list(self._tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if self._server is not None:
+            await self._server.wait_closed()
+            self._server = None
+        self.neighbours.clear()
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    def stats(self):
+        return {
+            'addr': self.addr,
+            'neighbours': sorted(self.neighbours),
+            'members': len(self.members),
+            'tombstones': len(self.tombstones),
+            'delivered': self.delivered,
+            'forwarded': self.forwarded,
+            'duplicates': self.duplicates,
+        }
+
+    # --- соединения ---
+
+    async def _accept(self, reader, writer):
+        parser = FrameParser()
+        try:
+            addr = await asyncio.wait_for(self._read_hello(reader, parser), HANDSHAKE_TIMEOUT)
+        except (asyncio.TimeoutError, ConnectionError, OSError, FrameError, ValueError):
+            addr = None
+        if not addr or addr == self.addr:
+            writer.close()
+            return
+        if len(self.neighbours) >= self.max_peers and addr not in self.neighbours:
+            # Мест нет, но список участников поможет найти других соседей
+            writer.write(self._digest_frame())
+            writer.close()
+            return
+        await self._run_link(addr, reader, writer, parser, outbound=False)
+
+    @staticmethod
+    async def _read_hello(reader, parser):
+        while True:
+            for msg_type, payload in parser.frames():
+                if msg_type != MSG_PEER_HELLO or len(payload) > MAX_ADDR_LENGTH:
+                    return None
+                # Адрес соседа попадает в списки участников: принимаем только host:port
+                addr = bytes(payload).decode('utf-8')
+                host, port = split_addr(addr)
+                if not host or not 0 < port < 65536:
+                    return None
+                return addr
+            data = await reader.read(READ_SIZE)
+            if not data:
+                return None
+            parser.feed(data)
+
+    async def _dial(self, addr):
+        self._dialing.add(addr)
+        try:
+            host, port = split_addr(addr)
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), HANDSHAKE_TIMEOUT)
+        except (asyncio.TimeoutError, ConnectionError, OSError, ValueError) as e:
+            log.debug("Узел %s: не удалось подключиться к %s: %s", self.addr, addr, e)
+            self._failed[addr] = time.monotonic()
+            return
+        finally:
+            self._dialing.discard(addr)
+        writer.write(encode_frame(MSG_PEER_HELLO, self.addr.encode('utf-8')))
+        await self._run_link(addr, reader, writer, FrameParser(), outbound=True)
+
+    async def _run_link(self, addr, reader, writer, parser, outbound):
+        existing = self.neighbours.get(addr)
+        if existing is not None:
+            # Узлы подключились друг к другу одновременно: обе стороны оставляют
+            # соединение, открытое узлом с меньшим адресом
+            dialer = self.addr if outbound else addr
+            if dialer != min(self.addr, addr):
+                writer.close()
+                return
+            existing.close()
+        peer = AsyncPeer(addr, writer, self._loop)
+        self.neighbours[addr] = peer
+        self._failed.pop(addr, None)
+        log.debug("Узел %s: сосед %s (%s)", self.addr, addr, 'исходящее' if outbound else 'входящее')
+        peer.enqueue(self._digest_frame())
+        try:
+            while True:
+                for msg_type, payload in parser.frames():
+                    self._handle_frame(peer, msg_type, payload)
+                data = await reader.read(READ_SIZE)
+                if not data:
+                    break
+                parser.feed(data)
+        except (ConnectionError, OSError, FrameError, ValueError, struct.error) as e:
+            log.debug("Узел %s: соединение с %s прервано: %s", self.addr, addr, e)
+        finally:
+            if self.neighbours.get(addr) is peer:
+                del self.neighbours[addr]
+            peer.close()
+
+    def _handle_frame(self, peer, msg_type, payload):
+        if msg_type == MSG_GOSSIP:
+            self._merge(json.loads(decode_text(payload)))
+        elif msg_type == MSG_MESH:
+            self._on_mesh(peer, payload)
+
+    # --- участники ---
+
+    def _merge(self, digest):
+        if not isinstance(digest, dict) or len(digest) > MAX_DIGEST:
+            raise ValueError("Некорректный список участников")
+        now = time.monotonic()
+        for addr, heartbeat in digest.items():
+            if (addr == self.addr or len(addr) > MAX_ADDR_LENGTH
+                    or type(heartbeat) is not int or heartbeat < 0):
+                continue
+            member = self.members.get(addr)
+            if member is not None:
+                if heartbeat > member[0]:
+                    member[0], member[1] = heartbeat, now
+                continue
+            tombstone = self.tombstones.get(addr)
+            if tombstone is not None:
+                if heartbeat <= tombstone[0]:
+                    # Устаревшие сведения об уже исключенном участнике
+                    continue
+                del self.tombstones[addr]
+            if len(self.members) < MAX_MEMBERS:
+                self.members[addr] = [heartbeat, now]
+
+    def _digest_frame(self):
+        addrs = list(self.members)
+        if len(addrs) > MAX_DIGEST - 1:
+            addrs = random.sample(addrs, MAX_DIGEST - 1)
+        digest = {addr: self.members[addr][0] for addr in addrs}
+        digest[self.addr] = self.heartbeat
+        return encode_frame(MSG_GOSSIP, json.dumps(digest).encode('utf-8'))
+
+    async def _maintain(self):
+        while True:
+            try:
+                self._gossip_round()
+            except Exception as e:
+                log.error("Узел %s: ошибка обслуживания mesh-сети: %s", self.addr, e)
+            await asyncio.sleep(self.gossip_interval * (0.75 + random.random() / 2))
+
+    def _gossip_round(self):
+        now = time.monotonic()
+        self.heartbeat += 1
+        for addr, (heartbeat, updated_at) in list(self.members.items()):
+            if now - updated_at > self.fail_timeout and addr not in self.neighbours:
+                del self.members[addr]
+                self.tombstones[addr] = (heartbeat, now)
+                log.info("Узел %s: участник %s исключен по таймауту", self.addr, addr)
+        for addr, (_, removed_at) in list(self.tombstones.items()):
+            if now - removed_at > 2 * self.fail_timeout:
+                del self.tombstones[addr]
+        for addr, failed_at in list(self._failed.items()):
+            if now - failed_at > self.fail_timeout and addr not in self.members:
+                del self._failed[addr]
+
+        missing = self.min_peers - len(self.neighbours) - len(self._dialing)
+        if missing > 0:
+            candidates = [addr for addr in self.members
+                          if addr not in self.neighbours and addr not in self._dialing
+                          and now - self._failed.get(addr, -self.fail_timeout) >= self.fail_timeout]
+            if not candidates and not self.neighbours:
+                candidates = [seed for seed in self.seeds if seed not in self._dialing]
+            for addr in random.sample(candidates, min(missing, len(candidates))):
+                self._spawn(self._dial(addr))
+
+        # Лишние соединения (после одновременных подключений) закрываем
+        extra = len(self.neighbours) - self.max_peers
+        if extra > 0:
+            for addr in random.sample(list(self.neighbours), extra):
+                self.neighbours[addr].close()
+
+        if self.neighbours:
+            frame = self._digest_frame()
+            for peer in random.sample(list(self.neighbours.values()), min(self.fanout, len(self.neighbours))):
+                peer.enqueue(frame)
+
+    # --- сообщения ---
+
+    def publish(self, text, dest=''):
+        """ Отправляет сообщение всем узлам или узлу dest; возвращает id сообщения """
+        msg_id = uuid.uuid4().bytes
+        self._remember(msg_id)
+        frame = encode_mesh(msg_id, self.ttl, self.addr, dest, text)
+        targets = [self.neighbours[dest]] if dest in self.neighbours else list(self.neighbours.values())
+        for peer in targets:
+            peer.enqueue(frame)
+        MESH_MESSAGES.labels('published').inc()
+        return msg_id.hex()
+
+    def publish_threadsafe(self, text, dest=''):
+        self._loop.call_soon_threadsafe(self.publish, text, dest)
+
+    def _remember(self, msg_id):
+        """ False, если сообщение уже проходило через узел """
+        if msg_id in self._seen:
+            return False
+        self._seen[msg_id] = None
+        if len(self._seen) > SEEN_IDS_KEPT:
+            self._seen.popitem(last=False)
+        return True
+
+    def _on_mesh(self, source, payload):
+        msg_id, ttl, origin, dest, text = decode_mesh(payload)
+        if not self._remember(msg_id):
+            self.duplicates += 1
+            MESH_MESSAGES.labels('duplicate').inc()
+            return
+        if not dest or dest == self.addr:
+            self._deliver(origin, text)
+            if dest:
+                return
+        if ttl <= 1:
+            MESH_MESSAGES.labels('expired').inc()
+            return
+        # TTL меняется, остальная нагрузка копируется без разбора
+        frame = encode_frame(MSG_MESH, ROUTE_HEADER.pack(msg_id, ttl - 1) + bytes(payload[ROUTE_HEADER.size:]))
+        if dest in self.neighbours:
+            targets = [self.neighbours[dest]]
+        else:
+            targets = [peer for addr, peer in self.neighbours.items() if peer is not source]
+        for peer in targets:
+            if peer.enqueue(frame):
+                self.forwarded += 1
+        MESH_MESSAGES.labels('forwarded').inc(len(targets))
+
+    def _deliver(self, origin, text):
+        self.delivered += 1
+        MESH_MESSAGES.labels('delivered').inc()
+        if self.router is not None:
+            self.router.broadcast((DEFAULT_ROOM,), encode_text(f"{origin}: {text}"))
+        if self.on_message is not None:
+            self.on_message(origin, text)
+
+
+# --- запуск ---
+
+async def run_node(args):
+    from server import ServerController
+    import async_server
+
+    node = MeshNode(args.port, host=args.host, seeds=args.seed, min_peers=args.min_peers,
+                    max_peers=args.max_peers, fanout=args.fanout, ttl=args.ttl,
+                    gossip_interval=args.gossip_interval)
+    controller = None
+    if args.chat_port:
+        # Сообщения локальных клиентов уходят в mesh, чужие — локальным клиентам
+        node.router = async_server.router
+        controller = ServerController(on_message=lambda addr, message: node.publish_threadsafe(message))
+    await node.start()
+    if controller is not None:
+        controller.start(args.chat_port, 'async')
+    try:
+        while True:
+            await asyncio.sleep(args.status_interval)
+            log.info("Узел %s: %s", node.addr, node.stats())
+    finally:
+        if controller is not None:
+            controller.stop()
+        await node.stop()
+
+
+async def simulate(args):
+    """ Запускает args.simulate узлов на соседних портах и проверяет
+    сходимость списка участников и охват рассылки """
+    count = args.simulate
+    received = [0] * count
+    nodes = []
+    for index in range(count):
+        def on_message(origin, text, index=index):
+            received[index] += 1
+        seeds = [f"{args.host}:{args.port}"] if index else []
+        nodes.append(MeshNode(args.port + index, host=args.host, seeds=seeds, min_peers=args.min_peers,
+                              max_peers=args.max_peers, fanout=args.fanout, ttl=args.ttl,
+                              gossip_interval=args.gossip_interval, on_message=on_message))
+    for node in nodes:
+        await node.start()
+    started = time.monotonic()
+    try:
+        while time.monotonic() - started < args.timeout:
+            if all(len(node.members) >= count - 1 for node in nodes):
+                break
+            await asyncio.sleep(0.1)
+        converged = time.monotonic() - started
+        degrees = [len(node.neighbours) for node in nodes]
+        print(f"Участники: {min(len(node.members) for node in nodes)}..{max(len(node.members) for node in nodes)}"
+              f" из {count - 1} за {converged:.1f} с; соседей на узел: {min(degrees)}..{max(degrees)}"
+              f" (среднее {statistics.mean(degrees):.1f})")
+
+        for index in range(args.messages):
+            random.choice(nodes).publish(f"сообщение {index}")
+        expected = args.messages * (count - 1)
+        deadline = time.monotonic() + args.timeout
+        while sum(received) < expected and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        duplicates = sum(node.duplicates for node in nodes)
+        print(f"Доставлено {sum(received)} из {expected} ({100 * sum(received) / max(expected, 1):.1f}%),"
+              f" повторов на доставку: {duplicates / max(sum(received), 1):.2f}")
+    finally:
+        for node in nodes:
+            await node.stop()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Узел mesh-сети чата")
+    parser.add_argument('--host', default='127.0.0.1', help="адрес, который узел сообщает другим")
+    parser.add_argument('--port', type=int, default=16000, help="порт mesh-соединений")
+    parser.add_argument('--seed', action='append', default=[], help="известный узел host:port (можно несколько)")
+    parser.add_argument('--chat-port', type=int, help="порт TCP-сервера чата для клиентов этого узла")
+    parser.add_argument('--min-peers', type=int, default=DEFAULT_MIN_PEERS)
+    parser.add_argument('--max-peers', type=int, default=DEFAULT_MAX_PEERS)
+    parser.add_argument('--fanout', type=int, default=DEFAULT_FANOUT)
+    parser.add_argument('--ttl', type=int, default=DEFAULT_TTL)
+    parser.add_argument('--gossip-interval', type=float, default=GOSSIP_INTERVAL)
+    parser.add_argument('--status-interval', type=float, default=30.0)
+    parser.add_argument('--simulate', type=int, metavar='N', help="запустить N узлов на портах начиная с --port")
+    parser.add_argument('--messages', type=int, default=100, help="сообщений в режиме --simulate")
+    parser.add_argument('--timeout', type=float, default=30.0)
+    args = parser.parse_args(argv)
+
+    configure_logging()
+    try:
+        asyncio.run(simulate(args) if args.simulate else run_node(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,200 @@
+import queue
+import threading
+import time
+from logs import get_logger
+from metrics import Counter, Histogram
+from users_database import insert_messages_batch, open_connection
+
+log = get_logger('message_writer')
+
+DEFAULT_MAX_BATCH_SIZE = 500
+DEFAULT_MAX_LATENCY = 0.05  # секунды ожидания до фиксации неполной пачки
+DEFAULT_MAX_QUEUE_SIZE = 10000
+WRITE_RETRIES = 3           # повторы пачки после неудачной записи
+RETRY_DELAY = 0.1           # секунды до первого повтора, дальше вдвое больше
+MAX_CONNECT_DELAY = 5.0     # предел паузы между попытками подключиться к БД
+SUBMIT_CHECK_INTERVAL = 0.5  # как часто submit() проверяет, жив ли поток записи
+
+WRITER_BATCH_SIZE = Histogram('message_writer_batch_size', 'Число сообщений в одной транзакции записи',
+                              buckets=(1, 5, 10, 50, 100, 250, 500, 1000))
+WRITER_DROPPED = Counter('message_writer_dropped_total', 'Сообщения, которые не удалось записать в БД')
+
+_STOP = object()
+
+
+class _Flush:
+    """ Маркер в очереди: событие выставляется, когда все сообщения
+    перед ним зафиксированы """
+
+    def __init__(self):
+        self.done = threading.Event()
+
+
+class MessageWriter:
+    """ Отдельный поток записи входящих сообщений в БД.
+
+    Получатели кладут сообщения в ограниченную очередь, поток записи
+    забирает их пачками и фиксирует каждую пачку одной транзакцией.
+    Если очередь заполнена, submit() блокируется — сокет получателя
+    перестает читаться, и давление передается отправителю.
+
+    Неудачная пачка повторяется с растущей паузой (например, после
+    database is locked), затем пишется по одному сообщению, так что
+    теряются только сообщения, которые не записываются сами по себе.
+    """
+
+    def __init__(self, db_file, max_batch_size=DEFAULT_MAX_BATCH_SIZE,
+                 max_latency=DEFAULT_MAX_LATENCY, max_queue_size=DEFAULT_MAX_QUEUE_SIZE,
+                 on_commit=None):
+        self.db_file = db_file
+        self.on_commit = on_commit  # вызывается с пачкой [(username, message)] после фиксации
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+
+    def start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stopping.clear()
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+    def submit(self, username, message, timeout=None):
+        """ Ставит сообщение в очередь; блокируется, пока в очереди нет места.
+
+        RuntimeError, если поток записи был запущен и завершился: иначе
+        получатели ждали бы места в очереди вечно.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            thread = self._thread
+            if thread is not None and not thread.is_alive():
+                raise RuntimeError("Поток записи сообщений не работает")
+            wait = SUBMIT_CHECK_INTERVAL
+            if deadline is not None:
+                wait = min(wait, max(0, deadline - time.monotonic()))
+            try:
+                self._queue.put((username, message), timeout=wait)
+                return
+            except queue.Full:
+                if deadline is not None and time.monotonic() >= deadline:
+                    raise
+
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def flush(self, timeout=None):
+        """ Ждет, пока все уже поставленные сообщения будут записаны в БД;
+        False, если поток записи не успел за timeout или не запущен """
+        with self._lock:
+            running = self._thread is not None and self._thread.is_alive()
+        if not running:
+            return self._queue.empty()
+        marker = _Flush()
+        try:
+            self._queue.put(marker, timeout=timeout)
+        except queue.Full:
+            return False
+        return marker.done.wait(timeout)
+
+    def stop(self, timeout=None):
+        """ Дописывает все уже поставленные сообщения и останавливает поток """
+        with self._lock:
+            thread = self._thread
+            self._thread = None
+        if thread is None:
+            return
+        self._stopping.set()
+        # Поток, так и не подключившийся к БД, очередь не разбирает
+        while thread.is_alive():
+            try:
+                self._queue.put(_STOP, timeout=SUBMIT_CHECK_INTERVAL)
+                break
+            except queue.Full:
+                pass
+        thread.join(timeout)
+
+    def _next_batch(self):
+        """ Ждет первое сообщение, затем добирает пачку до размера или таймаута """
+        item = self._queue.get()
+        if item is _STOP:
+            return None, True, None
+        if isinstance(item, _Flush):
+            return None, False, item
+        batch = [item]
+        deadline = time.monotonic() + self.max_latency
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is _STOP:
+                return batch, True, None
+            if isinstance(item, _Flush):
+                return batch, False, item
+            batch.append(item)
+        return batch, False, None
+
+    def _committed(self, batch):
+        if self.on_commit is None:
+            return
+        try:
+            self.on_commit(batch)
+        except Exception as e:
+            log.error("Обработчик записанной пачки завершился с ошибкой: %s", e)
+
+    def _connect(self):
+        """ Подключается к БД, повторяя попытки до успеха или stop() """
+        delay = RETRY_DELAY
+        while True:
+            try:
+                return open_connection(self.db_file)
+            except Exception as e:
+                log.error("Поток записи сообщений не смог подключиться к БД: %s", e)
+            if self._stopping.wait(delay):
+                return None
+            delay = min(delay * 2, MAX_CONNECT_DELAY)
+
+    def _write(self, conn, batch):
+        """ Записывает пачку; возвращает записанные сообщения """
+        delay = RETRY_DELAY
+        for attempt in range(WRITE_RETRIES + 1):
+            if insert_messages_batch(conn, batch):
+                return batch
+            if attempt < WRITE_RETRIES:
+                time.sleep(delay)
+                delay *= 2
+        # Пачка так и не записалась: по одному, чтобы потерять только плохие сообщения
+        written = [record for record in batch if insert_messages_batch(conn, [record])]
+        dropped = len(batch) - len(written)
+        if dropped:
+            WRITER_DROPPED.inc(dropped)
+            log.error("Не удалось сохранить %d из %d сообщений пачки", dropped, len(batch))
+        return written
+
+    def _run(self):
+        # Собственное соединение: поток держит его все время работы,
+        # и место в пуле остается HTTP-запросам
+        conn = self._connect()
+        if conn is None:
+            dropped = self._queue.qsize()
+            if dropped:
+                log.error("Поток записи остановлен без подключения к БД, не записано сообщений: %d", dropped)
+            return
+        try:
+            stopping = False
+            while not stopping:
+                batch, stopping, flush = self._next_batch()
+                if batch:
+                    WRITER_BATCH_SIZE.observe(len(batch))
+                    written = self._write(conn, batch)
+                    if written:
+                        self._committed(written)
+                if flush is not None:
+                    flush.done.set()
+        finally:
+            conn.close()
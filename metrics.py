@@ -0,0 +1,252 @@
+import threading
+import time
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# Границы по умолчанию: от сотен микросекунд (кэш, SQLite) до секунд
+DEFAULT_LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                           0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+DEFAULT_SIZE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Registry:
+    """ Набор метрик, отдаваемых одним /metrics """
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Метрика {metric.name} уже зарегистрирована")
+            self._metrics[metric.name] = metric
+
+    def unregister(self, name):
+        with self._lock:
+            self._metrics.pop(name, None)
+
+    def render(self):
+        """ Текстовый формат экспозиции Prometheus """
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra is not None:
+        pairs.append(f'{extra[0]}="{extra[1]}"')
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Child:
+    """ Метрика с зафиксированными значениями меток """
+
+    __slots__ = ('_metric', '_key')
+
+    def __init__(self, metric, key):
+        self._metric = metric
+        self._key = key
+
+    def inc(self, amount=1):
+        self._metric._inc(self._key, amount)
+
+    def observe(self, value):
+        self._metric._observe(self._key, value)
+
+    @contextmanager
+    def time(self):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._metric._observe(self._key, time.perf_counter() - started)
+
+
+class _Metric(ABC):
+    """ Основа счетчиков и гистограмм с агрегацией по потокам.
+
+    Каждый поток пишет только в свой шард без блокировок; при чтении
+    шарды суммируются. Шарды завершившихся потоков сливаются в общий
+    итог при регистрации нового шарда и при чтении, поэтому
+    поток-на-клиента не раздувает список и без опроса /metrics.
+    """
+
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._local = threading.local()
+        self._shards = []   # [(поток, шард)]
+        self._retired = {}  # итог шардов завершившихся потоков
+        self._children = {}
+        self._lock = threading.Lock()
+        if registry is not None:
+            registry.register(self)
+
+    def labels(self, *values):
+        if len(values) != len(self.labelnames):
+            raise ValueError(f"{self.name}: ожидаются метки {self.labelnames}")
+        key = tuple(str(value) for value in values)
+        child = self._children.get(key)
+        if child is None:
+            child = self._children.setdefault(key, _Child(self, key))
+        return child
+
+    def _shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = {}
+            with self._lock:
+                self._retire_dead()
+                self._shards.append((threading.current_thread(), shard))
+            return shard
+
+    def _retire_dead(self):
+        """ Сливает шарды завершившихся потоков в итог (под self._lock) """
+        alive = []
+        for thread, shard in self._shards:
+            if thread.is_alive():
+                alive.append((thread, shard))
+            else:
+                for key, value in list(shard.items()):
+                    self._merge(self._retired, key, value)
+        self._shards = alive
+        return alive
+
+    @abstractmethod
+    def _merge(self, total, key, value):
+        """ Добавляет значение шарда к итогу total """
+
+    @abstractmethod
+    def render(self):
+        """ Строки экспозиции Prometheus """
+
+    def _collect(self):
+        """ Суммарные значения по всем потокам: {значения меток: значение} """
+        with self._lock:
+            alive = self._retire_dead()
+            total = {}
+            for key, value in self._retired.items():
+                self._merge(total, key, value)
+        # Живые шарды читаем без блокировки: list() по словарю атомарен под GIL
+        for _, shard in alive:
+            for key, value in list(shard.items()):
+                self._merge(total, key, value)
+        return total
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1):
+        self._inc((), amount)
+
+    def _inc(self, key, amount):
+        shard = self._shard()
+        shard[key] = shard.get(key, 0) + amount
+
+    def _merge(self, total, key, value):
+        total[key] = total.get(key, 0) + value
+
+    def render(self):
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+                for key, value in sorted(self._collect().items())]
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_LATENCY_BUCKETS,
+                 registry=REGISTRY):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames, registry)
+
+    def observe(self, value):
+        self._observe((), value)
+
+    def time(self):
+        return _Child(self, ()).time()
+
+    def _observe(self, key, value):
+        shard = self._shard()
+        row = shard.get(key)
+        if row is None:
+            # Счетчики по корзинам (последняя — +Inf) и сумма; количество
+            # выводится из корзин, поэтому при чтении всегда согласовано
+            row = shard[key] = [0] * (len(self.buckets) + 1) + [0.0]
+        row[bisect_left(self.buckets, value)] += 1
+        row[-1] += value
+
+    def _merge(self, total, key, value):
+        row = total.get(key)
+        if row is None:
+            total[key] = list(value)
+        else:
+            for i, item in enumerate(value):
+                row[i] += item
+
+    def render(self):
+        lines = []
+        bounds = self.buckets + (float('inf'),)
+        for key, row in sorted(self._collect().items()):
+            cumulative = 0
+            for bound, count in zip(bounds, row):
+                cumulative += count
+                labels = _format_labels(self.labelnames, key, ('le', _format_value(bound)))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(row[-1])}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Gauge:
+    """ Значение, вычисляемое при каждом чтении /metrics (глубина очереди и т.п.) """
+
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, func, registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.func = func
+        if registry is not None:
+            registry.register(self)
+
+    def render(self):
+        try:
+            value = self.func()
+        except Exception:
+            return []
+        return [f"{self.name} {_format_value(value)}"]
+
+
+def render():
+    return REGISTRY.render()
@@ -0,0 +1,285 @@
+import struct
+import threading
+import time
+from contextlib import contextmanager
+from logs import get_logger
+from protocol import (
+    MSG_DELIVER, MSG_DELIVERY_ACK, MSG_DIRECT, MSG_HELLO,
+    decode_text, encode_frame, encode_text
+)
+from users_database import (
+    ack_outbox, compact_outbox, enqueue_outbox, get_outbox_max_id,
+    get_outbox_pending, get_outbox_recipients_since, get_pool
+)
+
+log = get_logger('outbox')
+
+DELIVERY_FRAME_TYPES = (MSG_HELLO, MSG_DELIVERY_ACK, MSG_DIRECT)
+
+DEFAULT_WINDOW = 500        # неподтвержденных сообщений на сессию (размер пачки)
+ACK_TIMEOUT = 30.0          # секунды до повторной отправки неподтвержденных
+SWEEP_INTERVAL = 1.0
+COMPACT_INTERVAL = 60.0
+ACKED_RETENTION = 300       # секунды хранения подтвержденных строк до удаления
+
+OUTBOX_ID = struct.Struct('!Q')
+
+
+def encode_deliver(outbox_id, sender, text):
+    return encode_frame(MSG_DELIVER, OUTBOX_ID.pack(outbox_id) + f"{sender}\0{text}".encode('utf-8'))
+
+
+def decode_deliver(payload):
+    """ (outbox_id, отправитель, текст) из MSG_DELIVER """
+    (outbox_id,) = OUTBOX_ID.unpack_from(payload)
+    sender, _, text = decode_text(payload[OUTBOX_ID.size:]).partition('\0')
+    return outbox_id, sender, text
+
+
+def encode_delivery_ack(outbox_ids):
+    return encode_frame(MSG_DELIVERY_ACK, struct.pack(f'!{len(outbox_ids)}Q', *outbox_ids))
+
+
+def decode_delivery_ack(payload):
+    count = len(payload) // OUTBOX_ID.size
+    return list(struct.unpack_from(f'!{count}Q', payload))
+
+
+class _Session:
+    """ Представившийся клиент: курсор по очереди и отправленные без подтверждения """
+
+    def __init__(self, peer, username):
+        self.peer = peer
+        self.username = username
+        self.cursor = 0
+        self.inflight = {}  # outbox_id -> время отправки
+        self.stalled = False  # очередь участника была переполнена — повторить отправку
+        self.epoch = 0  # растет, когда очередь перечитывается с начала
+        self.lock = threading.Lock()
+
+
+class DeliveryService:
+    """ Надежная доставка личных сообщений через таблицу outbox.
+
+    Сообщение для пользователя сначала фиксируется в БД, затем
+    отправляется его сессии кадром MSG_DELIVER. Строка считается
+    доставленной только после MSG_DELIVERY_ACK от клиента. После
+    MSG_HELLO (в том числе при переподключении) накопившиеся сообщения
+    досылаются пачками: следующая пачка уходит по мере подтверждений,
+    не больше window неподтвержденных на сессию.
+
+    Пароля у пользователя нет, поэтому имя из MSG_HELLO закрепляется за
+    первым живым соединением: второе приветствие с тем же именем
+    отклоняется, пока первое соединение не закроется, и чужую очередь
+    нельзя ни прочитать, ни подтвердить параллельно с владельцем.
+
+    Фоновый поток повторяет неподтвержденные по таймауту, подхватывает
+    сообщения, поставленные другими процессами (HTTP API), и удаляет
+    старые подтвержденные строки.
+    """
+
+    def __init__(self, db_file, router, window=DEFAULT_WINDOW, ack_timeout=ACK_TIMEOUT,
+                 sweep_interval=SWEEP_INTERVAL, compact_interval=COMPACT_INTERVAL,
+                 retention=ACKED_RETENTION):
+        self.db_file = db_file
+        self.router = router
+        self.window = window
+        self.ack_timeout = ack_timeout
+        self.sweep_interval = sweep_interval
+        self.compact_interval = compact_interval
+        self.retention = retention
+        self.delivered = 0
+        self.redelivered = 0
+        self._sessions = {}  # peer_id -> _Session
+        self._by_username = {}  # username -> _Session
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._last_seen_id = 0
+
+    @contextmanager
+    def _connection(self):
+        pool = get_pool(self.db_file)
+        conn = pool.acquire()
+        try:
+            yield conn
+        finally:
+            pool.release(conn)
+
+    # --- жизненный цикл ---
+
+    def start(self):
+        with self._connection() as conn:
+            self._last_seen_id = get_outbox_max_id(conn)
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=5):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        with self._lock:
+            self._sessions.clear()
+            self._by_username.clear()
+
+    def stats(self):
+        with self._lock:
+            sessions = list(self._sessions.values())
+        return {
+            'sessions': len(sessions),
+            'inflight': sum(len(session.inflight) for session in sessions),
+            'delivered': self.delivered,
+            'redelivered': self.redelivered
+        }
+
+    # --- кадры клиента ---
+
+    def handle_frame(self, peer, msg_type, payload):
+        """ Обрабатывает MSG_HELLO, MSG_DELIVERY_ACK и MSG_DIRECT (блокирующий вызов: БД) """
+        if msg_type == MSG_HELLO:
+            self._hello(peer, decode_text(payload).strip())
+        elif msg_type == MSG_DELIVERY_ACK:
+            self._ack(peer, decode_delivery_ack(payload))
+        elif msg_type == MSG_DIRECT:
+            recipient, _, text = decode_text(payload).partition('\0')
+            # Адрес вида ip:port подключенного участника — прямая доставка без очереди
+            if self.router.send_to(recipient, encode_text(f"{peer.peer_id} (лично): {text}")):
+                return
+            with self._lock:
+                session = self._sessions.get(peer.peer_id)
+            sender = session.username if session is not None else peer.peer_id
+            if self.send(recipient, sender, text) is None:
+                peer.enqueue(encode_text(f"Не удалось поставить сообщение для {recipient} в очередь"))
+
+    def disconnect(self, peer):
+        # Неподтвержденные строки остаются в outbox и уйдут при следующем MSG_HELLO
+        with self._lock:
+            self._forget(self._sessions.pop(peer.peer_id, None))
+
+    def _forget(self, session):
+        """ Освобождает имя пользователя сессии (вызывается под self._lock) """
+        if session is not None and self._by_username.get(session.username) is session:
+            del self._by_username[session.username]
+
+    def _hello(self, peer, username):
+        if not username:
+            peer.enqueue(encode_text("Пустое имя пользователя в приветствии"))
+            return
+        session = _Session(peer, username)
+        with self._lock:
+            owner = self._by_username.get(username)
+            if owner is not None and owner.peer is not peer and not owner.peer.closed:
+                refused = True
+            else:
+                refused = False
+                self._forget(self._sessions.get(peer.peer_id))
+                self._sessions[peer.peer_id] = session
+                self._by_username[username] = session
+        if refused:
+            peer.enqueue(encode_text(f"Пользователь {username} уже подключен с другого адреса"))
+            return
+        self._pump(session)
+
+    def _ack(self, peer, outbox_ids):
+        with self._lock:
+            session = self._sessions.get(peer.peer_id)
+        if session is None or not outbox_ids:
+            return
+        with self._connection() as conn:
+            ack_outbox(conn, session.username, outbox_ids)
+        with session.lock:
+            for outbox_id in outbox_ids:
+                if session.inflight.pop(outbox_id, None) is not None:
+                    self.delivered += 1
+        self._pump(session)
+
+    # --- отправка ---
+
+    def send(self, recipient, sender, text):
+        """ Фиксирует сообщение в outbox и сразу отправляет подключенным сессиям """
+        with self._connection() as conn:
+            outbox_id = enqueue_outbox(conn, recipient, sender, text)
+        if outbox_id is not None:
+            self.notify(recipient)
+        return outbox_id
+
+    def notify(self, recipient):
+        """ Досылает новые сообщения сессии получателя """
+        with self._lock:
+            session = self._by_username.get(recipient)
+        if session is not None:
+            self._pump(session)
+
+    def _pump(self, session):
+        """ Отправляет очередную пачку, пока есть место в окне подтверждений """
+        while True:
+            with session.lock:
+                free = self.window - len(session.inflight)
+                if free <= 0 or session.peer.closed:
+                    return
+                cursor, epoch = session.cursor, session.epoch
+            # Чтение из БД — без блокировки сессии: подтверждения и обход ее не ждут
+            with self._connection() as conn:
+                rows = get_outbox_pending(conn, session.username, cursor, free)
+            with session.lock:
+                if session.epoch != epoch:
+                    # Пока шел запрос, очередь начали перечитывать с начала
+                    continue
+                now = time.monotonic()
+                session.stalled = False
+                free = self.window - len(session.inflight)
+                for outbox_id, sender, text, _ in rows or ():
+                    if outbox_id <= session.cursor:
+                        # Уже отправлено параллельным вызовом
+                        continue
+                    if free <= 0:
+                        break
+                    if not session.peer.enqueue(encode_deliver(outbox_id, sender, text)):
+                        # Очередь отправки переполнена — остальное дошлем позже
+                        session.stalled = True
+                        break
+                    session.inflight[outbox_id] = now
+                    session.cursor = outbox_id
+                    free -= 1
+                return
+
+    # --- фоновые задачи ---
+
+    def _run(self):
+        next_compact = time.monotonic() + self.compact_interval
+        while not self._stop.wait(self.sweep_interval):
+            try:
+                self._sweep()
+                if time.monotonic() >= next_compact:
+                    next_compact = time.monotonic() + self.compact_interval
+                    with self._connection() as conn:
+                        compact_outbox(conn, self.retention)
+            except Exception as e:
+                log.error("Фоновая доставка сообщений: %s", e)
+
+    def _sweep(self):
+        with self._lock:
+            sessions = list(self._sessions.values())
+        if not sessions:
+            return
+        # Сообщения, поставленные в очередь другими процессами
+        with self._connection() as conn:
+            fresh = get_outbox_recipients_since(conn, self._last_seen_id) or []
+        if fresh:
+            self._last_seen_id = max(max_id for _, max_id in fresh)
+        recipients = {recipient for recipient, _ in fresh}
+
+        deadline = time.monotonic() - self.ack_timeout
+        for session in sessions:
+            with session.lock:
+                expired = any(sent_at < deadline for sent_at in session.inflight.values())
+                if expired:
+                    # Перечитываем очередь с начала: подтвержденные строки в нее не попадут
+                    self.redelivered += len(session.inflight)
+                    session.inflight.clear()
+                    session.cursor = 0
+                    session.epoch += 1
+            if expired or session.stalled or session.username in recipients:
+                self._pump(session)
@@ -0,0 +1,58 @@
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from cache import TTLCache
+
+DEFAULT_TIMEOUT = 2.0
+MAX_TIMEOUT = 10.0
+MAX_WORKERS = 64
+RESULT_TTL = 10.0  # секунды, сколько помнить результат проверки
+
+
+def probe(host, port, timeout=DEFAULT_TIMEOUT):
+    """ Проверяет один host:port, возвращает результат в виде словаря """
+    started = time.perf_counter()
+    result = {'host': host, 'port': port, 'is_open': False}
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+            s.settimeout(timeout)
+            result['is_open'] = s.connect_ex((host, port)) == 0
+    except (OSError, ValueError, OverflowError, TypeError) as e:
+        # Неверный хост или порт — ошибка этой цели, а не всей проверки
+        result['error'] = str(e)
+    result['latency_ms'] = round((time.perf_counter() - started) * 1000, 3)
+    return result
+
+
+class PortScanner:
+    """ Параллельная проверка доступности портов на ограниченном пуле потоков
+    с кратковременным кэшированием результатов по каждой цели """
+
+    def __init__(self, max_workers=MAX_WORKERS, result_ttl=RESULT_TTL):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='port-scan')
+        self._cache = TTLCache(max_size=4096, ttl=result_ttl)
+
+    def scan(self, targets, timeout=DEFAULT_TIMEOUT):
+        """ Отдает результаты по мере готовности: сначала из кэша, затем
+        остальные в порядке завершения проверок """
+        futures = {}
+        for host, port in dict.fromkeys(targets):
+            cached = self._cache.get((host, port))
+            if cached is not None:
+                yield dict(cached, cached=True)
+                continue
+            future = self._executor.submit(probe, host, port, timeout)
+            futures[future] = (host, port)
+
+        for future in as_completed(futures):
+            result = future.result()
+            # Ошибки вроде неизвестного хоста не кэшируем — они могут быть временными
+            if 'error' not in result:
+                self._cache.put(futures[future], result)
+            yield dict(result, cached=False)
+
+    def check(self, host, port, timeout=DEFAULT_TIMEOUT):
+        return next(self.scan([(host, port)], timeout))
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,167 @@
+import os
+import struct
+
+# Формат кадра: длина полезной нагрузки (4 байта, big-endian) + тип (1 байт)
+HEADER = struct.Struct('!IB')
+HEADER_SIZE = HEADER.size
+
+# Типы кадров
+MSG_TEXT = 1
+MSG_JOIN = 2     # войти в комнату (нагрузка — имя комнаты)
+MSG_LEAVE = 3    # выйти из комнаты
+MSG_DIRECT = 4   # личное сообщение: "<получатель>\0<текст>"
+MSG_FILE_OFFER = 5  # предложение файла: JSON {sha256, size, name}
+MSG_FILE_CHUNK = 6  # часть файла: sha256 (32 байта) + смещение (8 байт) + данные
+MSG_FILE_ACK = 7    # ответ получателя: JSON {sha256, status, offset, ...}
+MSG_HELLO = 8          # представление клиента: имя пользователя
+MSG_DELIVER = 9        # сообщение из очереди доставки: outbox_id (8 байт) + "<отправитель>\0<текст>"
+MSG_DELIVERY_ACK = 10  # подтверждение: последовательность outbox_id по 8 байт
+MSG_PEER_HELLO = 11    # представление узла mesh-сети: его адрес "host:port"
+MSG_GOSSIP = 12        # список участников: JSON {адрес: heartbeat}
+MSG_MESH = 13          # сообщение mesh-сети: id (16 байт) + TTL (1 байт) + "<узел-источник>\0<адресат>\0<текст>"
+MSG_COMPRESS = 14      # согласование сжатия: предложение клиента / ответ сервера (см. compression.py)
+MSG_UDP_BIND = 15      # привязка UDP-адреса к TCP-сессии: JSON запроса и ответа (см. udp_transport.py)
+
+# Старший бит типа: полезная нагрузка сжата согласованным кодеком соединения
+FLAG_COMPRESSED = 0x80
+
+# Ограничение ядра на число буферов в одном sendmsg
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
+
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+DEFAULT_BUFFER_SIZE = 64 * 1024
+
+
+class FrameError(Exception):
+    """ Нарушение формата кадра (слишком большой кадр и т.п.) """
+
+
+def encode_frame(msg_type, payload):
+    """ Собирает кадр в один буфер (удобно для небольших сообщений) """
+    return HEADER.pack(len(payload), msg_type) + payload
+
+
+def encode_text(message):
+    return encode_frame(MSG_TEXT, message.encode('utf-8'))
+
+
+def decode_text(payload):
+    """ Декодирует текст; payload может быть memoryview из буфера парсера """
+    return str(payload, 'utf-8', errors='replace')
+
+
+def sendmsg_all(sock, buffers):
+    """ Отправляет список буферов одним системным вызовом (writev),
+    досылая остаток при частичной отправке """
+    views = [memoryview(b).cast('B') for b in buffers if len(b)]
+    while views:
+        sent = sock.sendmsg(views[:IOV_MAX])
+        while sent:
+            size = views[0].nbytes
+            if sent >= size:
+                sent -= size
+                views.pop(0)
+            else:
+                views[0] = views[0][sent:]
+                sent = 0
+
+
+def send_frame(sock, msg_type, payload):
+    """ Отправляет кадр без копирования полезной нагрузки в общий буфер """
+    if hasattr(sock, 'sendmsg'):
+        sendmsg_all(sock, (HEADER.pack(len(payload), msg_type), payload))
+    else:
+        sock.sendall(HEADER.pack(len(payload), msg_type))
+        sock.sendall(payload)
+
+
+def send_text(sock, message):
+    send_frame(sock, MSG_TEXT, message.encode('utf-8'))
+
+
+def send_frames(sock, frames):
+    """ Отправляет несколько кадров (msg_type, payload) за один вызов """
+    buffers = []
+    for msg_type, payload in frames:
+        buffers.append(HEADER.pack(len(payload), msg_type))
+        buffers.append(payload)
+    sendmsg_all(sock, buffers)
+
+
+class FrameParser:
+    """ Инкрементальный разбор потока кадров.
+
+    Данные читаются прямо в переиспользуемый bytearray (recv_into),
+    кадры отдаются как memoryview на этот буфер без копирования.
+    Полученный memoryview действителен только до следующего
+    вызова feed()/recv_into().
+    """
+
+    def __init__(self, buffer_size=DEFAULT_BUFFER_SIZE, max_frame_size=MAX_FRAME_SIZE):
+        self._buf = bytearray(buffer_size)
+        self._start = 0  # начало неразобранных данных
+        self._end = 0    # конец записанных данных
+        self.max_frame_size = max_frame_size
+
+    def _pending_frame_size(self):
+        """ Полный размер текущего кадра, если его заголовок уже получен """
+        if self._end - self._start < HEADER_SIZE:
+            return HEADER_SIZE
+        length, _ = HEADER.unpack_from(self._buf, self._start)
+        if length > self.max_frame_size:
+            raise FrameError(f"Кадр слишком большой: {length} байт")
+        return HEADER_SIZE + length
+
+    def _reserve(self, size):
+        """ Гарантирует size свободных байт после конца данных """
+        if len(self._buf) - self._end >= size:
+            return
+        used = self._end - self._start
+        if self._start and len(self._buf) - used >= size:
+            # Сдвигаем хвост в начало, размер буфера не меняется
+            self._buf[:used] = self._buf[self._start:self._end]
+        else:
+            capacity = len(self._buf)
+            while capacity - used < size:
+                capacity *= 2
+            new_buf = bytearray(capacity)
+            new_buf[:used] = self._buf[self._start:self._end]
+            self._buf = new_buf
+        self._start = 0
+        self._end = used
+
+    def feed(self, data):
+        """ Добавляет уже прочитанные данные (например, из asyncio) """
+        size = len(data)
+        self._reserve(size)
+        self._buf[self._end:self._end + size] = data
+        self._end += size
+
+    def recv_into(self, sock, min_free=DEFAULT_BUFFER_SIZE):
+        """ Читает из сокета прямо в буфер; возвращает число байт (0 — EOF).
+
+        Для большого кадра место резервируется сразу под весь кадр,
+        поэтому многомегабайтная нагрузка не переаллоцируется по частям.
+        """
+        missing = self._pending_frame_size() - (self._end - self._start)
+        self._reserve(max(min_free, missing))
+        received = sock.recv_into(memoryview(self._buf)[self._end:])
+        self._end += received
+        return received
+
+    def frames(self):
+        """ Возвращает (msg_type, payload) для каждого полностью полученного кадра """
+        view = memoryview(self._buf)
+        while self._end - self._start >= HEADER_SIZE:
+            frame_size = self._pending_frame_size()
+            if self._end - self._start < frame_size:
+                break
+            msg_type = self._buf[self._start + HEADER_SIZE - 1]
+            payload = view[self._start + HEADER_SIZE:self._start + frame_size]
+            self._start += frame_size
+            yield msg_type, payload
+        if self._start == self._end:
+            self._start = self._end = 0
@@ -0,0 +1,185 @@
+import bisect
+import itertools
+import threading
+import time
+from collections import deque
+from operator import itemgetter
+
+DEFAULT_HISTORY = 10000  # событий в кольцевом буфере для догоняющих подписчиков
+DEFAULT_MAX_BATCH = 500
+
+
+class _Waiter:
+    """ Ожидающий подписчик: фильтр и функция пробуждения """
+
+    __slots__ = ('predicate', 'wake')
+
+    def __init__(self, predicate, wake):
+        self.predicate = predicate
+        self.wake = wake
+
+    def wants(self, events):
+        return self.predicate is None or any(self.predicate(event) for event in events)
+
+
+class MessageBus:
+    """ Внутрипроцессная шина событий о новых сообщениях.
+
+    Вместо очереди на каждого подписчика хранится общий кольцевой буфер
+    событий с возрастающими id; подписчик помнит только свой курсор
+    (последний полученный id). Ожидающие подписчики регистрируются
+    вместе со своим фильтром, и публикация будит только тех, кому
+    подходит хотя бы одно новое событие: подписчик на другого
+    пользователя не просыпается. Отставший догоняет по буферу
+    (SSE Last-Event-ID, курсор long-poll).
+
+    Ждать можно блокирующе (wait) или без потока (watch/unwatch):
+    так stream_server обслуживает тысячи SSE-подписок одним циклом asyncio.
+    """
+
+    def __init__(self, history=DEFAULT_HISTORY):
+        self._events = deque(maxlen=history)  # (id, событие)
+        self._last_id = 0
+        self._floor = 0  # id последнего события, вытесненного из буфера
+        self._lock = threading.Lock()
+        self._waiters = set()
+        self._closed = False
+        self._subscribers = 0
+
+    def last_id(self):
+        return self._last_id
+
+    def subscriber_count(self):
+        return self._subscribers
+
+    def waiter_count(self):
+        return len(self._waiters)
+
+    def publish(self, event):
+        return self.publish_many([event])
+
+    def publish_many(self, events, ids=None):
+        """ Публикует события одной пачкой; возвращает id последнего.
+
+        ids — собственные возрастающие id событий (например, message_id
+        из БД, общий для всех процессов serve.py); по умолчанию шина
+        нумерует события сама. Уже опубликованные id пропускаются.
+        """
+        if not events:
+            return self._last_id
+        with self._lock:
+            if ids is None:
+                ids = range(self._last_id + 1, self._last_id + 1 + len(events))
+            for event_id, event in zip(ids, events):
+                if event_id <= self._last_id:
+                    continue
+                if len(self._events) == self._events.maxlen:
+                    self._floor = self._events[0][0]
+                self._events.append((event_id, event))
+                self._last_id = event_id
+            last_id = self._last_id
+            woken = [waiter for waiter in self._waiters if waiter.wants(events)]
+            self._waiters.difference_update(woken)
+        for waiter in woken:
+            waiter.wake()
+        return last_id
+
+    def seek(self, last_id):
+        """ Начинает нумерацию пустой шины с last_id: более ранние события
+        считаются пропущенными (см. missed в wait) """
+        with self._lock:
+            if not self._events and last_id > self._last_id:
+                self._last_id = self._floor = last_id
+
+    def close(self):
+        """ Будит всех ожидающих; дальнейшие wait() сразу возвращают пустой ответ """
+        with self._lock:
+            self._closed = True
+            woken = list(self._waiters)
+            self._waiters.clear()
+        for waiter in woken:
+            waiter.wake()
+
+    def _since(self, after_id, predicate, limit):
+        """ События новее after_id (вызывается под self._lock).
+
+        Возвращает (события, новый курсор, пропущены ли события): курсор
+        сдвигается и за отфильтрованные события, чтобы не просматривать
+        их повторно.
+        """
+        if after_id >= self._last_id:
+            # Курсор из будущего (например, после перезапуска процесса) сбрасываем
+            return [], min(max(after_id, 0), self._last_id), False
+        missed = after_id < self._floor
+        start = bisect.bisect_right(self._events, after_id, key=itemgetter(0))
+        matched = []
+        cursor = max(after_id, self._floor)
+        for event_id, event in itertools.islice(self._events, start, None):
+            cursor = event_id
+            if predicate is None or predicate(event):
+                matched.append((event_id, event))
+                if len(matched) >= limit:
+                    break
+        return matched, cursor, missed
+
+    def watch(self, after_id, predicate, wake, limit=DEFAULT_MAX_BATCH):
+        """ Неблокирующее ожидание: (события, курсор, missed, ожидающий).
+
+        Если событий нет, регистрирует ожидающего: wake() будет вызван
+        один раз из потока публикации, когда появится подходящее событие
+        или шина закроется; затем снова вызывается watch() с новым курсором.
+        Отказавшийся ждать подписчик снимается через unwatch().
+        """
+        with self._lock:
+            events, cursor, missed = self._since(after_id, predicate, limit)
+            if events or missed or self._closed:
+                return events, cursor, missed, None
+            waiter = _Waiter(predicate, wake)
+            self._waiters.add(waiter)
+            return events, cursor, missed, waiter
+
+    def unwatch(self, waiter):
+        if waiter is not None:
+            with self._lock:
+                self._waiters.discard(waiter)
+
+    def wait(self, after_id, timeout, predicate=None, limit=DEFAULT_MAX_BATCH):
+        """ Ждет события новее after_id не дольше timeout секунд.
+
+        Возвращает (события [(id, событие)], курсор, missed); missed
+        означает, что часть событий уже вытеснена из буфера и клиенту
+        стоит перечитать историю через /api/messages.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            ready = threading.Event()
+            events, cursor, missed, waiter = self.watch(after_id, predicate, ready.set, limit)
+            if waiter is None:
+                return events, cursor, missed
+            after_id = cursor
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not ready.wait(remaining):
+                self.unwatch(waiter)
+                return [], cursor, False
+
+    def closed(self):
+        return self._closed
+
+    def subscribe(self):
+        """ Контекстный менеджер для учета открытых подписок """
+        return _Subscription(self)
+
+
+class _Subscription:
+    def __init__(self, bus):
+        self.bus = bus
+
+    def __enter__(self):
+        with self.bus._lock:
+            self.bus._subscribers += 1
+        return self
+
+    def __exit__(self, *exc):
+        with self.bus._lock:
+            self.bus._subscribers -= 1
+        return False
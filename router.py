@@ -0,0 +1,312 @@
+import socket
+import threading
+from collections import deque
+from logs import get_logger
+from metrics import DEFAULT_SIZE_BUCKETS, Counter, Histogram
+from protocol import (
+    IOV_MAX, MSG_DIRECT, MSG_JOIN, MSG_LEAVE, MSG_TEXT,
+    decode_text, encode_text, sendmsg_all
+)
+
+log = get_logger('router')
+
+DEFAULT_ROOM = 'lobby'
+MAX_PEER_QUEUE_BYTES = 4 * 1024 * 1024
+
+# Метрики TCP-серверов; метка mode — 'threads' или 'async'
+TCP_CONNECTIONS_ACCEPTED = Counter('tcp_connections_accepted_total', 'Принятые TCP-подключения', ('mode',))
+TCP_RECV_BYTES = Histogram('tcp_recv_bytes', 'Размер данных за одно чтение из сокета', ('mode',),
+                           buckets=DEFAULT_SIZE_BUCKETS)
+MESSAGE_HANDLE_SECONDS = Histogram('tcp_message_handle_seconds',
+                                   'Обработка входящего сообщения: маршрутизация и сохранение', ('mode',))
+TCP_DROPPED_FRAMES = Counter('tcp_dropped_frames_total', 'Кадры, выброшенные из-за переполненной очереди получателя')
+
+# Что делать с медленным получателем, чья очередь переполнена
+POLICY_DROP = 'drop'              # выбросить новое сообщение для этого получателя
+POLICY_DISCONNECT = 'disconnect'  # отключить получателя
+
+
+class Peer:
+    """ Подключенный участник с ограниченной очередью исходящих кадров """
+
+    def __init__(self, peer_id, max_queue_bytes=MAX_PEER_QUEUE_BYTES, policy=POLICY_DROP):
+        self.peer_id = peer_id
+        self.max_queue_bytes = max_queue_bytes
+        self.policy = policy
+        self.rooms = set()
+        self.closed = False
+        self.dropped = 0
+        self.bytes_sent = 0
+        self.codec = None  # WireCodec после согласования сжатия
+        self.datagrams = None  # UdpBinding, если клиент подтвердил UDP-адрес
+        self._frames = deque()
+        self._queued_bytes = 0
+        self._cond = threading.Condition()
+
+    def enqueue(self, frame):
+        """ Отправляет кадр по UDP, если он подходит для датаграммы, иначе
+        ставит в очередь TCP; False, если получатель закрыт или переполнен """
+        datagrams = self.datagrams
+        if datagrams is not None and datagrams.send(frame):
+            return True
+        return self.enqueue_stream(frame)
+
+    def enqueue_stream(self, frame):
+        """ Ставит кадр в очередь TCP-соединения """
+        with self._cond:
+            if self.closed:
+                return False
+            if self._queued_bytes + len(frame) > self.max_queue_bytes:
+                self.dropped += 1
+                TCP_DROPPED_FRAMES.inc()
+                overflow = True
+            else:
+                self._frames.append(frame)
+                self._queued_bytes += len(frame)
+                overflow = False
+                self._cond.notify()
+        if overflow:
+            if self.policy == POLICY_DISCONNECT:
+                log.warning("Медленный получатель %s отключен", self.peer_id)
+                self.close()
+            return False
+        self._wakeup()
+        return True
+
+    def queue_bytes(self):
+        return self._queued_bytes
+
+    def _take_all(self, max_frames=IOV_MAX):
+        """ Забирает из очереди до max_frames кадров (вызывается под self._cond) """
+        frames = []
+        while self._frames and len(frames) < max_frames:
+            frames.append(self._frames.popleft())
+        self._queued_bytes -= sum(len(frame) for frame in frames)
+        if self.codec is not None:
+            # Сжатие идет в порядке отправки: контекст потока общий с получателем
+            frames = [self.codec.encode(frame) for frame in frames]
+        return frames
+
+    def _wakeup(self):
+        """ Сообщает транспорту, что в очереди появились данные """
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._frames.clear()
+            self._queued_bytes = 0
+            self._cond.notify_all()
+
+
+class SocketPeer(Peer):
+    """ Участник на блокирующем сокете: очередь разгружает отдельный поток,
+    отправляя все накопленные кадры одним sendmsg (writev) """
+
+    def __init__(self, peer_id, sock, **kwargs):
+        super().__init__(peer_id, **kwargs)
+        self.sock = sock
+
+    def run_sender(self):
+        try:
+            while True:
+                with self._cond:
+                    while not self._frames and not self.closed:
+                        self._cond.wait()
+                    if self.closed:
+                        break
+                    frames = self._take_all()
+                sendmsg_all(self.sock, frames)
+                self.bytes_sent += sum(len(frame) for frame in frames)
+        except OSError as e:
+            log.warning("Ошибка при отправке данных клиенту %s: %s", self.peer_id, e)
+        finally:
+            self.close()
+
+    def close(self):
+        super().close()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+class AsyncPeer(Peer):
+    """ Участник в цикле событий asyncio: очередь сбрасывается в транспорт
+    одним writelines, переполнение буфера транспорта тоже считается очередью """
+
+    def __init__(self, peer_id, writer, loop, **kwargs):
+        super().__init__(peer_id, **kwargs)
+        self.writer = writer
+        self.loop = loop
+        self._flush_scheduled = False
+
+    def queue_bytes(self):
+        return self._queued_bytes + self.writer.transport.get_write_buffer_size()
+
+    def enqueue_stream(self, frame):
+        # Буфер транспорта растет, если клиент не читает — учитываем и его
+        if self.writer.transport.get_write_buffer_size() > self.max_queue_bytes:
+            with self._cond:
+                self.dropped += 1
+            TCP_DROPPED_FRAMES.inc()
+            if self.policy == POLICY_DISCONNECT:
+                log.warning("Медленный получатель %s отключен", self.peer_id)
+                self.close()
+            return False
+        return super().enqueue_stream(frame)
+
+    def _wakeup(self):
+        with self._cond:
+            if self._flush_scheduled:
+                return
+            self._flush_scheduled = True
+        self.loop.call_soon_threadsafe(self._flush)
+
+    def _flush(self):
+        with self._cond:
+            self._flush_scheduled = False
+            frames = self._take_all(max_frames=len(self._frames))
+        if frames and not self.writer.is_closing():
+            self.writer.writelines(frames)
+            self.bytes_sent += sum(len(frame) for frame in frames)
+
+    def close(self):
+        super().close()
+        try:
+            self.loop.call_soon_threadsafe(self.writer.close)
+        except RuntimeError:
+            # Цикл событий уже остановлен
+            pass
+
+
+class MessageRouter:
+    """ Реестр подключенных участников и комнат с рассылкой сообщений """
+
+    def __init__(self):
+        self._peers = {}
+        self._rooms = {}
+        self._lock = threading.Lock()
+
+    def register(self, peer, room=DEFAULT_ROOM):
+        with self._lock:
+            self._peers[peer.peer_id] = peer
+        self.join(peer, room)
+
+    def unregister(self, peer):
+        with self._lock:
+            self._peers.pop(peer.peer_id, None)
+            for room in peer.rooms:
+                members = self._rooms.get(room)
+                if members is not None:
+                    members.discard(peer.peer_id)
+                    if not members:
+                        del self._rooms[room]
+            peer.rooms.clear()
+        peer.close()
+
+    def join(self, peer, room):
+        with self._lock:
+            self._rooms.setdefault(room, set()).add(peer.peer_id)
+            peer.rooms.add(room)
+
+    def leave(self, peer, room):
+        with self._lock:
+            members = self._rooms.get(room)
+            if members is not None:
+                members.discard(peer.peer_id)
+                if not members:
+                    del self._rooms[room]
+            peer.rooms.discard(room)
+
+    def peer_count(self):
+        with self._lock:
+            return len(self._peers)
+
+    def peers(self):
+        with self._lock:
+            return list(self._peers.values())
+
+    def broadcast(self, rooms, frame, exclude=None):
+        """ Рассылает готовый кадр участникам комнат; возвращает число доставок """
+        with self._lock:
+            recipients = set()
+            for room in rooms:
+                recipients.update(self._rooms.get(room, ()))
+            recipients.discard(exclude)
+            targets = [self._peers[peer_id] for peer_id in recipients if peer_id in self._peers]
+        # Постановка в очереди идет вне блокировки: медленный участник
+        # не задерживает рассылку остальным
+        return sum(1 for peer in targets if peer.enqueue(frame))
+
+    def send_to(self, peer_id, frame):
+        with self._lock:
+            peer = self._peers.get(peer_id)
+        return peer is not None and peer.enqueue(frame)
+
+    def broadcast_all(self, frame):
+        return sum(1 for peer in self.peers() if peer.enqueue(frame))
+
+    def handle_frame(self, peer, msg_type, payload):
+        """ Обрабатывает входящий кадр участника; возвращает текст для MSG_TEXT """
+        if msg_type == MSG_TEXT:
+            message = decode_text(payload)
+            rooms = tuple(peer.rooms)
+            self.broadcast(rooms, encode_text(f"{peer.peer_id}: {message}"), exclude=peer.peer_id)
+            return message
+        if msg_type == MSG_JOIN:
+            self.join(peer, decode_text(payload))
+        elif msg_type == MSG_LEAVE:
+            self.leave(peer, decode_text(payload))
+        elif msg_type == MSG_DIRECT:
+            # Полезная нагрузка: "<peer_id получателя>\0<текст>"
+            recipient, _, message = decode_text(payload).partition('\0')
+            if not self.send_to(recipient, encode_text(f"{peer.peer_id} (лично): {message}")):
+                peer.enqueue(encode_text(f"Получатель {recipient} недоступен"))
+        return None
+
+
+class ConnectionStats:
+    """ Счетчики трафика сервера: подключения, принятые байты и кадры.
+    Отправленные байты считают сами участники (Peer.bytes_sent), здесь
+    копятся только итоги уже закрытых соединений. """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.accepted = 0
+        self.active = 0
+        self.bytes_in = 0
+        self.messages_in = 0
+        self.closed_bytes_out = 0
+
+    def opened(self):
+        with self._lock:
+            self.accepted += 1
+            self.active += 1
+
+    def closed(self, peer):
+        with self._lock:
+            self.active -= 1
+            self.closed_bytes_out += peer.bytes_sent
+
+    def received(self, nbytes, messages=0):
+        with self._lock:
+            self.bytes_in += nbytes
+            self.messages_in += messages
+
+    def snapshot(self, peers=()):
+        """ Текущие значения; peers — живые участники для подсчета отправленного """
+        peers = list(peers)
+        with self._lock:
+            return {
+                'active_connections': self.active,
+                'accepted_connections': self.accepted,
+                'bytes_in': self.bytes_in,
+                'bytes_out': self.closed_bytes_out + sum(peer.bytes_sent for peer in peers),
+                'messages_in': self.messages_in,
+                'outbound_queue_bytes': sum(peer.queue_bytes() for peer in peers),
+                'dropped_frames': sum(peer.dropped for peer in peers)
+            }
+
+
+def peer_id_for(addr):
+    return f"{addr[0]}:{addr[1]}"
@@ -0,0 +1,123 @@
+import gzip
+import json
+
+# Необязательные зависимости: без них соответствующий формат просто не предлагается
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+JSON_MIMETYPE = 'application/json'
+MSGPACK_MIMETYPE = 'application/msgpack'
+CBOR_MIMETYPE = 'application/cbor'
+
+MIN_COMPRESS_SIZE = 1024  # меньшие ответы не сжимаем: выигрыш меньше накладных расходов
+GZIP_LEVEL = 5
+ZSTD_LEVEL = 3
+
+
+class RowSet:
+    """ Строки курсора (кортежи или sqlite3.Row) и имена их полей.
+
+    Маршруты отдают строки как есть, а в объекты {поле: значение} их
+    превращает сериализатор непосредственно перед кодированием.
+    """
+
+    __slots__ = ('fields', 'rows')
+
+    def __init__(self, fields, rows):
+        self.fields = tuple(fields)
+        self.rows = rows
+
+    def to_dicts(self):
+        fields = self.fields
+        return [dict(zip(fields, row)) for row in self.rows]
+
+
+def _materialize(document):
+    return {key: value.to_dicts() if isinstance(value, RowSet) else value
+            for key, value in document.items()}
+
+
+class JsonFormat:
+    name = 'json'
+    mimetype = JSON_MIMETYPE
+
+    def dumps(self, value):
+        return json.dumps(value).encode('utf-8')
+
+    def loads(self, data):
+        return json.loads(data)
+
+    def encode_document(self, document):
+        # Один вызов C-кодировщика на весь документ быстрее
+        # покомпонентной сборки строки на Python
+        return self.dumps(_materialize(document))
+
+
+class MsgpackFormat:
+    name = 'msgpack'
+    mimetype = MSGPACK_MIMETYPE
+
+    def dumps(self, value):
+        return msgpack.packb(value, use_bin_type=True)
+
+    def loads(self, data):
+        return msgpack.unpackb(data, raw=False)
+
+    def encode_document(self, document):
+        return self.dumps(_materialize(document))
+
+
+class CborFormat:
+    name = 'cbor'
+    mimetype = CBOR_MIMETYPE
+
+    def dumps(self, value):
+        return cbor2.dumps(value)
+
+    def loads(self, data):
+        return cbor2.loads(data)
+
+    def encode_document(self, document):
+        return self.dumps(_materialize(document))
+
+
+JSON = JsonFormat()
+FORMATS = {JSON_MIMETYPE: JSON}
+if msgpack is not None:
+    FORMATS[MSGPACK_MIMETYPE] = FORMATS['application/x-msgpack'] = MsgpackFormat()
+if cbor2 is not None:
+    FORMATS[CBOR_MIMETYPE] = CborFormat()
+
+
+def negotiate(accept_mimetypes):
+    """ Выбирает формат по заголовку Accept (werkzeug MIMEAccept); по умолчанию JSON """
+    best = accept_mimetypes.best_match(list(FORMATS), default=JSON_MIMETYPE)
+    return FORMATS.get(best, JSON)
+
+
+def available_encodings():
+    return ('zstd', 'gzip') if zstandard is not None else ('gzip',)
+
+
+def compress(body, accept_encodings):
+    """ Сжимает тело, если клиент это принимает; возвращает (тело, Content-Encoding или None) """
+    if len(body) < MIN_COMPRESS_SIZE:
+        return body, None
+    encoding = accept_encodings.best_match(available_encodings())
+    if encoding == 'zstd':
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(body), 'zstd'
+    if encoding == 'gzip':
+        return gzip.compress(body, GZIP_LEVEL, mtime=0), 'gzip'
+    return body, None
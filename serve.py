@@ -0,0 +1,234 @@
+""" Многопроцессный запуск: HTTP API в нескольких рабочих процессах
+и TCP-сервер чата в отдельном процессе.
+
+Мастер один раз создает схему и применяет миграции, открывает
+слушающий сокет HTTP и порождает процессы через fork. Рабочие
+процессы импортируют app уже после fork, поэтому пулы соединений
+SQLite, потоки и кэши у каждого свои; конкурентный доступ к файлу
+БД обеспечивают WAL и busy_timeout (см. CONNECTION_PRAGMAS).
+
+Процесс tcp владеет TCP-сервером и принимает команды /api/*_server
+по unix-сокету; процесс stream обслуживает SSE и long-poll на
+--stream-port без потока на подписчика. Новые сообщения и изменения
+кэшируемых данных процессы узнают из БД (см. cluster.py).
+
+    python serve.py --workers 4 --tcp-port 15001
+"""
+import argparse
+import os
+import signal
+import socket
+import sys
+import tempfile
+import time
+import traceback
+from cluster import CONTROL_SOCKET_ENV, ControlServer
+from users_database import create_connection, create_tables
+
+DEFAULT_HOST = '0.0.0.0'
+DEFAULT_PORT = 5000
+DEFAULT_TCP_PORT = 15001
+DEFAULT_STREAM_PORT = 5001
+DEFAULT_BACKLOG = 1024
+DEFAULT_DB_FILE = 'chat_db.sqlite'
+RESPAWN_DELAY = 1.0    # пауза перед перезапуском процесса, упавшего сразу после старта
+MIN_UPTIME = 5.0
+STOP_TIMEOUT = 10.0
+
+DB_FILE_ENV = 'P2P_DB_FILE'
+DB_INITIALIZED_ENV = 'P2P_DB_INITIALIZED'
+
+
+def init_database(db_file):
+    """ Создает таблицы и применяет миграции до запуска рабочих процессов """
+    conn = create_connection(db_file)
+    if conn is None:
+        raise RuntimeError(f"Не удалось открыть БД {db_file}")
+    try:
+        create_tables(conn)
+    finally:
+        conn.close()
+    os.environ[DB_FILE_ENV] = db_file
+    os.environ[DB_INITIALIZED_ENV] = '1'
+
+
+def create_http_socket(host, port, backlog=DEFAULT_BACKLOG):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    # Сокет общий: соединения принимает тот рабочий процесс, который успел первым
+    sock.set_inheritable(True)
+    return sock
+
+
+def _raise_exit(signum, frame):
+    raise SystemExit(0)
+
+
+def run_http_worker(sock, host, port):
+    from werkzeug.serving import make_server
+    import app as app_module
+
+    server = make_server(host, port, app_module.app, threaded=True, fd=sock.fileno())
+    print(f"[Инфо] HTTP-процесс {os.getpid()} обслуживает {host}:{port}")
+    try:
+        server.serve_forever()
+    except SystemExit:
+        pass
+    finally:
+        server.server_close()
+        app_module.message_feed.stop()
+        app_module.message_bus.close()
+        app_module.message_writer.stop(STOP_TIMEOUT)
+
+
+def run_stream_server(host, port):
+    import app as app_module
+
+    app_module.stream_server.start(host, port)
+    try:
+        app_module.stream_server.wait()
+    except SystemExit:
+        pass
+    finally:
+        app_module.message_feed.stop()
+        app_module.message_bus.close()
+        app_module.stream_server.stop()
+        app_module.message_writer.stop(STOP_TIMEOUT)
+
+
+def run_tcp_server(port, mode, udp=False):
+    # Этот процесс сам владеет TCP-сервером: app создает локальный ServerController
+    control_path = os.environ.pop(CONTROL_SOCKET_ENV)
+    import app as app_module
+
+    controller = app_module.server_controller
+    controller.udp = udp
+    control = ControlServer(controller, control_path).start()
+    try:
+        try:
+            controller.start(port, mode)
+        except OSError as e:
+            # Процесс остается: сервер можно запустить позже через /api/start_server
+            print(f"[Ошибка] TCP-сервер не запущен на порту {port}: {e}")
+        # Остановка сервера через API не завершает процесс — ждем сигнала
+        while True:
+            signal.pause()
+    except SystemExit:
+        pass
+    finally:
+        control.stop()
+        controller.stop()
+        app_module.message_writer.stop(STOP_TIMEOUT)
+
+
+class Supervisor:
+    """ Порождает процессы через fork и перезапускает упавшие """
+
+    def __init__(self):
+        self.children = {}  # pid -> (имя, функция, аргументы, время запуска)
+        self.stopping = False
+
+    def spawn(self, name, target, *args):
+        pid = os.fork()
+        if pid == 0:
+            # Ctrl+C получает вся группа процессов; останавливает детей мастер
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGTERM, _raise_exit)
+            code = 0
+            try:
+                target(*args)
+            except SystemExit as e:
+                code = e.code if isinstance(e.code, int) else 0
+            except BaseException:
+                traceback.print_exc()
+                code = 1
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(code)
+        self.children[pid] = (name, target, args, time.monotonic())
+        return pid
+
+    def stop(self, signum=None, frame=None):
+        if self.stopping:
+            return
+        self.stopping = True
+        self._signal_children(signal.SIGTERM)
+        # Кто не завершился за STOP_TIMEOUT, будет остановлен принудительно
+        signal.signal(signal.SIGALRM, lambda *_: self._signal_children(signal.SIGKILL))
+        signal.alarm(int(STOP_TIMEOUT))
+
+    def _signal_children(self, signum):
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            child = self.children.pop(pid, None)
+            if child is None or self.stopping:
+                continue
+            name, target, args, started_at = child
+            print(f"[Ошибка] Процесс {name} ({pid}) завершился с кодом "
+                  f"{os.waitstatus_to_exitcode(status)}, перезапуск.")
+            if time.monotonic() - started_at < MIN_UPTIME:
+                time.sleep(RESPAWN_DELAY)
+            if not self.stopping:
+                self.spawn(name, target, *args)
+        signal.alarm(0)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Запуск API в нескольких процессах и TCP-сервера")
+    parser.add_argument('--host', default=DEFAULT_HOST)
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help="порт HTTP API")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help="число HTTP-процессов")
+    parser.add_argument('--backlog', type=int, default=DEFAULT_BACKLOG)
+    parser.add_argument('--db', default=os.environ.get(DB_FILE_ENV, DEFAULT_DB_FILE), help="файл SQLite")
+    parser.add_argument('--tcp-port', type=int, default=DEFAULT_TCP_PORT, help="порт TCP-сервера чата")
+    parser.add_argument('--tcp-mode', choices=('threads', 'async'), default='async')
+    parser.add_argument('--no-tcp', action='store_true', help="не запускать TCP-сервер")
+    parser.add_argument('--udp', action='store_true', help="UDP-вход чата на порту TCP-сервера (режим async)")
+    parser.add_argument('--stream-port', type=int, default=DEFAULT_STREAM_PORT,
+                        help="порт SSE и long-poll без потока на подписчика")
+    parser.add_argument('--no-stream', action='store_true', help="не запускать процесс SSE")
+    args = parser.parse_args(argv)
+    if args.udp and args.tcp_mode != 'async':
+        parser.error("--udp требует --tcp-mode async")
+
+    init_database(args.db)
+    sock = create_http_socket(args.host, args.port, args.backlog)
+    # Сокет управления нужен HTTP-процессам и при --no-tcp: тогда /api/*_server отвечают 503
+    control_path = os.path.join(tempfile.gettempdir(), f'p2p-control-{os.getpid()}.sock')
+    os.environ[CONTROL_SOCKET_ENV] = control_path
+    supervisor = Supervisor()
+    if not args.no_tcp:
+        supervisor.spawn('tcp', run_tcp_server, args.tcp_port, args.tcp_mode, args.udp)
+    if not args.no_stream:
+        supervisor.spawn('stream', run_stream_server, args.host, args.stream_port)
+    for index in range(max(1, args.workers)):
+        supervisor.spawn(f'http-{index}', run_http_worker, sock, args.host, args.port)
+    print(f"[Инфо] Мастер {os.getpid()}: HTTP на {args.host}:{args.port}, процессов: {args.workers}"
+          + ("" if args.no_tcp else f", TCP-сервер ({args.tcp_mode}) на порту {args.tcp_port}")
+          + ("" if args.no_stream else f", SSE на порту {args.stream_port}"))
+    try:
+        supervisor.run()
+    finally:
+        sock.close()
+        if os.path.exists(control_path):
+            os.unlink(control_path)
+        print("[Инфо] Все процессы остановлены.")
+
+
+if __name__ == '__main__':
+    main()
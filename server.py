@@ -1,7 +1,26 @@
 import miniupnpc
+import asyncio
 import socket
 import threading
+import time
 import sys
+from protocol import FrameParser, MSG_COMPRESS, MSG_TEXT, MSG_UDP_BIND, decode_text, encode_text, send_text
+from router import (
+    MESSAGE_HANDLE_SECONDS, TCP_CONNECTIONS_ACCEPTED, TCP_RECV_BYTES,
+    ConnectionStats, MessageRouter, SocketPeer, peer_id_for
+)
+import async_server
+from file_transfer import FILE_FRAME_TYPES, STATUS_ERROR, FileReceiver, encode_ack
+from outbox import DELIVERY_FRAME_TYPES, DeliveryService
+from compression import WireCompression, decode_frame, handle_compress_offer
+from udp_transport import UdpChatEndpoint, handle_udp_bind
+from async_server import DEFAULT_BACKLOG, create_listen_socket, serve_until, start_async_server
+from logs import get_logger
+
+log = get_logger('tcp')
+
+SERVER_MODES = ('threads', 'async')
+DEFAULT_STOP_TIMEOUT = 5.0
 
 def is_port_open(host, port):
     try:
@@ -80,13 +99,15 @@ def open_port(external_port, internal_port, protocol='TCP', description='My Port
     return True
 
 def receive_messages(client_socket, addr):
+    parser = FrameParser()
     try:
         while True:
-            data = client_socket.recv(1024)
-            if not data:
+            if not parser.recv_into(client_socket):
                 print(f"[Инфо] Клиент {addr} отключился.")
                 break
-            print(f"\n[Сообщение от {addr}]: {data.decode('utf-8', errors='ignore')}")
+            for msg_type, payload in parser.frames():
+                if msg_type == MSG_TEXT:
+                    print(f"\n[Сообщение от {addr}]: {decode_text(payload)}")
     except Exception as e:
         print(f"[Ошибка] Ошибка при получении данных от {addr}: {e}")
     finally:
@@ -98,40 +119,335 @@ def send_messages(client_socket, addr):
             message = input("Введите ответ клиенту: ")
             if not message:
                 continue
-            client_socket.sendall(message.encode('utf-8'))
+            send_text(client_socket, message)
     except Exception as e:
         print(f"[Ошибка] Ошибка при отправке данных клиенту {addr}: {e}")
     finally:
         client_socket.close()
 
-def handle_client(client_socket, addr):
-    print(f"[Инфо] Подключился клиент: {addr}")
-    
-    recv_thread = threading.Thread(target=receive_messages, args=(client_socket, addr), daemon=True)
-    send_thread = threading.Thread(target=send_messages, args=(client_socket, addr), daemon=True)
-    
-    recv_thread.start()
-    send_thread.start()
-    
-    recv_thread.join()
-    send_thread.join()
+# Общий для процесса реестр подключенных клиентов и комнат
+router = MessageRouter()
+
+def route_messages(peer, client_socket, addr, on_message=None, stats=None, files=None, delivery=None,
+                   compression=None):
+    """ Читает кадры клиента и передает их маршрутизатору; кадры файлов
+    обрабатывает files (FileReceiver), если прием файлов включен, а
+    приветствие, подтверждения и личные сообщения — delivery (DeliveryService).
+    Сжатие согласуется по настройкам compression (WireCompression) """
+    parser = FrameParser()
+    recv_bytes = TCP_RECV_BYTES.labels('threads')
+    handle_seconds = MESSAGE_HANDLE_SECONDS.labels('threads')
+    try:
+        while True:
+            received = parser.recv_into(client_socket)
+            if not received:
+                log.info("Клиент %s отключился", addr)
+                break
+            recv_bytes.observe(received)
+            if stats is not None:
+                stats.received(received)
+            for msg_type, payload in parser.frames():
+                msg_type, payload = decode_frame(peer.codec, msg_type, payload)
+                if msg_type == MSG_COMPRESS:
+                    handle_compress_offer(peer, compression, payload)
+                    continue
+                if msg_type == MSG_UDP_BIND:
+                    # UDP-вход есть только в режиме 'async' — клиент получит отказ
+                    handle_udp_bind(peer, None, addr, payload)
+                    continue
+                if msg_type in FILE_FRAME_TYPES:
+                    handle_file_frame(peer, files, msg_type, payload)
+                    continue
+                if delivery is not None and msg_type in DELIVERY_FRAME_TYPES:
+                    delivery.handle_frame(peer, msg_type, payload)
+                    continue
+                started = time.perf_counter()
+                message = router.handle_frame(peer, msg_type, payload)
+                if message is None:
+                    continue
+                if stats is not None:
+                    stats.received(0, messages=1)
+                log.debug("Сообщение от %s: %s", addr, message)
+                if on_message is not None:
+                    on_message(addr, message)
+                handle_seconds.observe(time.perf_counter() - started)
+    except Exception as e:
+        log.warning("Ошибка при получении данных от %s: %s", addr, e)
+
+def handle_file_frame(peer, files, msg_type, payload):
+    """ Передает кадр файла приемнику и ставит его ответы в очередь клиента """
+    if files is None:
+        replies = [encode_ack(None, STATUS_ERROR, message='file transfer is disabled')]
+    else:
+        replies = files.handle(msg_type, payload)
+    for reply in replies:
+        peer.enqueue(reply)
+
+def handle_client(client_socket, addr, on_message=None, stats=None, media_store=None, delivery=None,
+                  compression=None):
+    log.info("Подключился клиент %s", addr)
 
-def start_server(port):
-    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server.bind(('', port))
-    server.listen(5)
-    print(f"[Инфо] Сервер запущен и слушает порт {port}")
+    peer = SocketPeer(peer_id_for(addr), client_socket)
+    router.register(peer)
+    TCP_CONNECTIONS_ACCEPTED.labels('threads').inc()
+    if stats is not None:
+        stats.opened()
+    # Поток отправки разгружает очередь клиента, поток приема — текущий
+    send_thread = threading.Thread(target=peer.run_sender, daemon=True)
+    send_thread.start()
+    files = FileReceiver(media_store) if media_store is not None else None
+    try:
+        route_messages(peer, client_socket, addr, on_message, stats, files, delivery, compression)
+    finally:
+        if files is not None:
+            files.close()
+        if delivery is not None:
+            delivery.disconnect(peer)
+        router.unregister(peer)
+        send_thread.join()
+        if stats is not None:
+            stats.closed(peer)
+        client_socket.close()
 
+def operator_console():
+    """ Рассылает ответы оператора всем подключенным клиентам """
     try:
         while True:
-            client_socket, addr = server.accept()
-            threading.Thread(target=handle_client, args=(client_socket, addr), daemon=True).start()
+            message = input("Введите ответ клиентам: ")
+            if not message:
+                continue
+            delivered = router.broadcast_all(encode_text(f"server: {message}"))
+            print(f"[Инфо] Доставлено клиентам: {delivered}")
+    except EOFError:
+        pass
+
+class ServerController:
+    """ Жизненный цикл TCP-сервера внутри процесса: запуск, остановка и
+    перезапуск на том же порту, учет соединений и трафика.
+
+    Режим 'threads' — поток приема и по потоку на клиента, 'async' —
+    один цикл событий в отдельном потоке. При остановке слушающий сокет
+    закрывается, клиенты отключаются, а уже принятые сообщения
+    дописываются в БД через message_writer.flush().
+
+    Если задан outbox_db, личные сообщения доставляются через очередь
+    outbox в этой БД (см. DeliveryService) и доходят до получателей,
+    которые подключатся позже.
+
+    udp=True (только режим 'async') открывает на том же номере порта
+    UDP-вход для коротких сообщений (см. UdpChatEndpoint): клиенты
+    привязывают к нему свой UDP-адрес через TCP-сессию.
+
+    Если задан compression_db, клиенты могут согласовать сжатие кадров;
+    словари обучаются на сообщениях этой БД при каждом start().
+    """
+
+    def __init__(self, on_message=None, message_writer=None, backlog=DEFAULT_BACKLOG, media_store=None,
+                 outbox_db=None, udp=False, compression_db=None):
+        self.on_message = on_message
+        self.message_writer = message_writer
+        self.media_store = media_store  # MediaStore для приема файлов; None — прием выключен
+        self.outbox_db = outbox_db
+        self.udp = udp
+        self.compression_db = compression_db
+        self.delivery = None
+        self.compression = None
+        self.backlog = backlog
+        self.port = None
+        self.mode = None
+        self.started_at = None
+        self.stats = ConnectionStats()
+        self._lock = threading.Lock()
+        self._sock = None
+        self._thread = None
+        self._clients = {}  # сокет клиента -> поток обработчика
+        self._loop = None
+        self._stop_event = None
+
+    def is_running(self):
+        thread = self._thread
+        return thread is not None and thread.is_alive()
+
+    def start(self, port, mode='threads', backlog=None):
+        """ Открывает порт и запускает сервер в фоне; ошибки bind/listen
+        (например, занятый порт) выбрасываются сразу """
+        if mode not in SERVER_MODES:
+            raise ValueError(f"Неизвестный режим сервера: {mode}")
+        if self.udp and mode != 'async':
+            raise ValueError("UDP-вход работает только в режиме 'async'")
+        with self._lock:
+            if self.is_running():
+                raise RuntimeError("Сервер уже запущен")
+            backlog = backlog or self.backlog
+            sock = create_listen_socket(port, backlog)
+            self.stats = ConnectionStats()
+            self.port, self.mode, self.backlog = port, mode, backlog
+            self._sock = sock
+            if self.compression_db is not None:
+                self.compression = WireCompression.from_database(self.compression_db)
+            if self.outbox_db is not None:
+                self.delivery = DeliveryService(self.outbox_db, async_server.router if mode == 'async' else router)
+                self.delivery.start()
+            if mode == 'async':
+                started = threading.Event()
+                self._thread = threading.Thread(target=self._run_async, args=(sock, started), daemon=True)
+                self._thread.start()
+                started.wait()
+            else:
+                sock.setblocking(True)
+                self._thread = threading.Thread(target=self._accept_loop, args=(sock,), daemon=True)
+                self._thread.start()
+            self.started_at = time.time()
+        print(f"[Инфо] Сервер ({mode}) запущен и слушает порт {port}, backlog {backlog}")
+
+    def stop(self, timeout=DEFAULT_STOP_TIMEOUT):
+        """ Останавливает прием, отключает клиентов и ждет записи принятых
+        сообщений; возвращает True, если все успело завершиться за timeout """
+        with self._lock:
+            thread, sock = self._thread, self._sock
+            if thread is None:
+                return True
+            deadline = time.monotonic() + timeout
+            if self.mode == 'async':
+                try:
+                    self._loop.call_soon_threadsafe(self._stop_event.set)
+                except (AttributeError, RuntimeError):
+                    # Цикл событий не запустился или уже завершился
+                    pass
+            else:
+                self._close_listener(sock)
+            thread.join(max(0, deadline - time.monotonic()))
+            clean = not thread.is_alive()
+            if self.mode == 'threads':
+                clean = self._disconnect_clients(deadline) and clean
+            sock.close()
+            if self.delivery is not None:
+                self.delivery.stop(max(0, deadline - time.monotonic()))
+                self.delivery = None
+            self._thread = self._sock = None
+            self._loop = self._stop_event = None
+            self.started_at = None
+        if self.message_writer is not None:
+            clean = self.message_writer.flush(max(0, deadline - time.monotonic())) and clean
+        print(f"[Инфо] Сервер на порту {self.port} остановлен.")
+        return clean
+
+    def restart(self, port=None, mode=None, backlog=None, timeout=DEFAULT_STOP_TIMEOUT):
+        port = port or self.port
+        mode = mode or self.mode or 'threads'
+        self.stop(timeout)
+        self.start(port, mode, backlog)
+
+    def notify_delivery(self, recipient):
+        """ Сообщает о новой записи в outbox, если доставка запущена в этом процессе """
+        delivery = self.delivery
+        if delivery is not None:
+            delivery.notify(recipient)
+
+    def wait(self):
+        """ Блокирует до остановки сервера """
+        thread = self._thread
+        while thread is not None and thread.is_alive():
+            thread.join(0.5)
+
+    def status(self):
+        peers = async_server.router.peers() if self.mode == 'async' else router.peers()
+        running = self.is_running()
+        status = {
+            'running': running,
+            'mode': self.mode,
+            'port': self.port,
+            'backlog': self.backlog,
+            'uptime': round(time.time() - self.started_at, 3) if running and self.started_at else 0,
+        }
+        status.update(self.stats.snapshot(peers if running else ()))
+        if self.message_writer is not None:
+            status['writer_queue_depth'] = self.message_writer.queue_depth()
+        if self.delivery is not None:
+            status['delivery'] = self.delivery.stats()
+        if self.compression is not None:
+            status['compression'] = {codec: len(data) for codec, data in self.compression.dictionaries.items()}
+        return status
+
+    # --- режим threads ---
+
+    def _accept_loop(self, sock):
+        while True:
+            try:
+                client_socket, addr = sock.accept()
+            except OSError:
+                # Слушающий сокет закрыт из stop()
+                break
+            thread = threading.Thread(target=self._serve_client, args=(client_socket, addr), daemon=True)
+            self._clients[client_socket] = thread
+            thread.start()
+
+    def _serve_client(self, client_socket, addr):
+        try:
+            handle_client(client_socket, addr, self.on_message, self.stats, self.media_store, self.delivery,
+                          self.compression)
+        finally:
+            self._clients.pop(client_socket, None)
+
+    @staticmethod
+    def _close_listener(sock):
+        # shutdown будит поток, заблокированный в accept(); один close() этого не делает
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def _disconnect_clients(self, deadline):
+        clients = list(self._clients.items())
+        for client_socket, _ in clients:
+            try:
+                client_socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        for _, thread in clients:
+            thread.join(max(0, deadline - time.monotonic()))
+        return not any(thread.is_alive() for _, thread in clients)
+
+    # --- режим async ---
+
+    def _run_async(self, sock, started):
+        async def main():
+            self._loop = asyncio.get_running_loop()
+            self._stop_event = asyncio.Event()
+            udp = None
+            if self.udp:
+                udp = await UdpChatEndpoint(async_server.router, self.on_message).start(self.port)
+            started.set()
+            try:
+                await serve_until(sock, self._stop_event, self.on_message, self.stats,
+                                  media_store=self.media_store, delivery=self.delivery,
+                                  compression=self.compression, udp=udp)
+            finally:
+                if udp is not None:
+                    await udp.close()
+
+        try:
+            asyncio.run(main())
+        except Exception as e:
+            print(f"[Ошибка] Асинхронный сервер завершился с ошибкой: {e}")
+        finally:
+            started.set()
+
+
+def start_server(port, console=False, backlog=DEFAULT_BACKLOG, on_message=None):
+    controller = ServerController(on_message=on_message, backlog=backlog)
+    controller.start(port)
+    if console:
+        threading.Thread(target=operator_console, daemon=True).start()
+
+    try:
+        controller.wait()
     except KeyboardInterrupt:
         print("\n[Инфо] Работа сервера остановлена пользователем.")
     finally:
-        server.close()
+        controller.stop()
 
-def main():
+def main(mode='threads'):
     external_port = 15001
     internal_port = 15001
     protocol = 'TCP'
@@ -140,9 +456,13 @@ def main():
     print("=== Диагностика и открытие порта через UPnP ===")
     if open_port(external_port, internal_port, protocol, description):
         print("[Инфо] Запускаем TCP-сервер...")
-        start_server(internal_port)
+        if mode == 'async':
+            # workers=None: по одному циклу событий на ядро
+            start_async_server(internal_port, workers=None)
+        else:
+            start_server(internal_port, console=True)
     else:
         print("[Ошибка] Не удалось открыть порт, сервер не запущен.")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main('async' if '--async' in sys.argv[1:] else 'threads')
\ No newline at end of file
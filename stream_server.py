@@ -0,0 +1,268 @@
+import asyncio
+import json
+import threading
+from urllib.parse import parse_qs, urlsplit
+from logs import get_logger
+
+log = get_logger('stream')
+
+DEFAULT_PORT = 5001
+DEFAULT_KEEPALIVE = 15      # секунды между комментариями-пингами в SSE
+MAX_POLL_TIMEOUT = 30       # секунды ожидания в long-poll
+MAX_SUBSCRIBERS = 10000
+MAX_REQUEST_SIZE = 8 * 1024
+REQUEST_TIMEOUT = 10        # секунды на получение заголовков запроса
+WRITE_TIMEOUT = 30          # секунды на отправку клиенту, который не читает
+RETRY_MS = 3000
+
+STREAM_PATH = '/api/messages/stream'
+POLL_PATH = '/api/messages/poll'
+
+
+class RequestError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+def parse_request(head):
+    """ (путь, параметры запроса, заголовки) из строки запроса и заголовков HTTP/1.1 """
+    lines = head.decode('latin-1').split('\r\n')
+    try:
+        method, target, _ = lines[0].split(' ', 2)
+    except ValueError:
+        raise RequestError('400 Bad Request', 'Malformed request line')
+    if method != 'GET':
+        raise RequestError('405 Method Not Allowed', 'Only GET is supported')
+    headers = {}
+    for line in lines[1:]:
+        name, sep, value = line.partition(':')
+        if sep:
+            headers[name.strip().lower()] = value.strip()
+    url = urlsplit(target)
+    params = {name: values[-1] for name, values in parse_qs(url.query).items()}
+    return url.path, params, headers
+
+
+def parse_cursor(bus, headers, params):
+    """ Курсор подписки: Last-Event-ID или ?after; без него — с текущего момента """
+    cursor = headers.get('last-event-id') or params.get('after')
+    if cursor is None:
+        return bus.last_id()
+    try:
+        cursor = int(cursor)
+    except ValueError:
+        raise RequestError('400 Bad Request', 'Invalid event id')
+    if cursor < 0:
+        raise RequestError('400 Bad Request', 'Invalid event id')
+    return cursor
+
+
+def username_filter(params):
+    username = params.get('username')
+    if not username:
+        return None
+    return lambda event: event['username'] == username
+
+
+def format_events(events):
+    return ''.join(
+        f"id: {event_id}\nevent: message\ndata: {json.dumps(dict(event, id=event_id))}\n\n"
+        for event_id, event in events
+    )
+
+
+class StreamServer:
+    """ SSE и long-poll новых сообщений без потока на подписчика.
+
+    Все подписки обслуживает один поток с циклом asyncio: подписчик —
+    это корутина с курсором и зарегистрированным в шине ожидающим
+    (MessageBus.watch). Поток публикации не трогает цикл на каждого
+    подписчика: готовые ожидающие копятся в списке, и цикл будится
+    одним call_soon_threadsafe на пачку.
+
+    Те же URL и формат, что у /api/messages/stream и /api/messages/poll
+    во Flask, но на отдельном порту; там каждый поток держит поток Werkzeug.
+    """
+
+    def __init__(self, bus, keepalive=DEFAULT_KEEPALIVE, max_subscribers=MAX_SUBSCRIBERS):
+        self.bus = bus
+        self.keepalive = keepalive
+        self.max_subscribers = max_subscribers
+        self.host = None
+        self.port = None
+        self._subscribers = 0
+        self._loop = None
+        self._stop_event = None
+        self._thread = None
+        self._ready = []
+        self._ready_lock = threading.Lock()
+
+    def subscriber_count(self):
+        return self._subscribers
+
+    def is_running(self):
+        thread = self._thread
+        return thread is not None and thread.is_alive()
+
+    def start(self, host='0.0.0.0', port=DEFAULT_PORT):
+        """ Запускает сервер в фоновом потоке; ошибка bind выбрасывается сразу """
+        started = threading.Event()
+        errors = []
+        self._thread = threading.Thread(target=self._run, args=(host, port, started, errors), daemon=True)
+        self._thread.start()
+        started.wait()
+        if errors:
+            self._thread.join()
+            self._thread = None
+            raise errors[0]
+        log.info("SSE-сервер слушает %s:%s", self.host, self.port)
+        return self
+
+    def stop(self, timeout=5):
+        thread = self._thread
+        if thread is None:
+            return
+        try:
+            self._loop.call_soon_threadsafe(self._stop_event.set)
+        except (AttributeError, RuntimeError):
+            pass
+        thread.join(timeout)
+        self._thread = None
+
+    def wait(self):
+        """ Блокирует до остановки сервера """
+        thread = self._thread
+        while thread is not None and thread.is_alive():
+            thread.join(0.5)
+
+    # --- цикл событий ---
+
+    def _run(self, host, port, started, errors):
+        async def main():
+            self._loop = asyncio.get_running_loop()
+            self._stop_event = asyncio.Event()
+            try:
+                server = await asyncio.start_server(self._handle, host, port, limit=MAX_REQUEST_SIZE)
+            except OSError as e:
+                errors.append(e)
+                return
+            self.host, self.port = server.sockets[0].getsockname()[:2]
+            started.set()
+            await self._stop_event.wait()
+            server.close()
+            # Подписки бесконечны: отменяем их, не дожидаясь клиентов
+            handlers = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+            for task in handlers:
+                task.cancel()
+            await asyncio.gather(*handlers, return_exceptions=True)
+
+        try:
+            asyncio.run(main())
+        except Exception as e:
+            log.error("SSE-сервер завершился с ошибкой: %s", e)
+        finally:
+            started.set()
+
+    def _wake(self, future):
+        """ Вызывается из потока публикации: будим цикл один раз на пачку """
+        with self._ready_lock:
+            self._ready.append(future)
+            if len(self._ready) > 1:
+                return
+        try:
+            self._loop.call_soon_threadsafe(self._flush_ready)
+        except RuntimeError:
+            # Цикл уже остановлен
+            pass
+
+    def _flush_ready(self):
+        with self._ready_lock:
+            ready, self._ready = self._ready, []
+        for future in ready:
+            if not future.done():
+                future.set_result(None)
+
+    async def _next_events(self, cursor, predicate, timeout):
+        """ Как MessageBus.wait, но ожидание — future в цикле, а не поток """
+        deadline = self._loop.time() + timeout
+        while True:
+            future = self._loop.create_future()
+            events, cursor, missed, waiter = self.bus.watch(cursor, predicate, lambda: self._wake(future))
+            if waiter is None:
+                return events, cursor, missed
+            try:
+                await asyncio.wait_for(future, max(0, deadline - self._loop.time()))
+            except asyncio.TimeoutError:
+                self.bus.unwatch(waiter)
+                return [], cursor, False
+
+    async def _handle(self, reader, writer):
+        try:
+            try:
+                head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), REQUEST_TIMEOUT)
+                path, params, headers = parse_request(head)
+                if path == STREAM_PATH:
+                    await self._stream(writer, params, headers)
+                elif path == POLL_PATH:
+                    await self._poll(writer, params, headers)
+                else:
+                    raise RequestError('404 Not Found', 'Not found')
+            except RequestError as e:
+                await self._send_json(writer, e.status, {'status': 'error', 'message': e.message})
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError,
+                ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+    async def _write(self, writer, data):
+        writer.write(data.encode('utf-8'))
+        await asyncio.wait_for(writer.drain(), WRITE_TIMEOUT)
+
+    async def _send_json(self, writer, status, document):
+        body = json.dumps(document)
+        await self._write(writer, f"HTTP/1.1 {status}\r\nContent-Type: application/json\r\n"
+                                  f"Content-Length: {len(body.encode('utf-8'))}\r\nConnection: close\r\n\r\n{body}")
+
+    async def _stream(self, writer, params, headers):
+        cursor = parse_cursor(self.bus, headers, params)
+        if self._subscribers >= self.max_subscribers:
+            raise RequestError('503 Service Unavailable', 'Too many subscribers')
+        predicate = username_filter(params)
+        self._subscribers += 1
+        try:
+            # Подсказка браузеру, через сколько переподключаться после обрыва
+            await self._write(writer, "HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\n"
+                                      "Cache-Control: no-cache\r\nX-Accel-Buffering: no\r\n"
+                                      f"Connection: close\r\n\r\nretry: {RETRY_MS}\n\n")
+            while not self.bus.closed():
+                events, cursor, missed = await self._next_events(cursor, predicate, self.keepalive)
+                if missed:
+                    await self._write(writer, 'event: reset\ndata: {}\n\n')
+                if not events:
+                    # Пинг удерживает соединение и обнаруживает отключившихся клиентов
+                    await self._write(writer, ': keepalive\n\n')
+                    continue
+                await self._write(writer, format_events(events))
+        finally:
+            self._subscribers -= 1
+
+    async def _poll(self, writer, params, headers):
+        cursor = parse_cursor(self.bus, headers, params)
+        try:
+            timeout = min(max(float(params.get('timeout', MAX_POLL_TIMEOUT)), 0), MAX_POLL_TIMEOUT)
+        except ValueError:
+            raise RequestError('400 Bad Request', 'Invalid cursor')
+        self._subscribers += 1
+        try:
+            events, cursor, missed = await self._next_events(cursor, username_filter(params), timeout)
+        finally:
+            self._subscribers -= 1
+        await self._send_json(writer, '200 OK', {
+            'status': 'success',
+            'messages': [dict(event, id=event_id) for event_id, event in events],
+            'next_after': cursor,
+            'missed': missed
+        })
@@ -0,0 +1,41 @@
+import asyncio
+import socket
+
+import pytest
+
+from async_client import AsyncClient, ClientClosedError
+from protocol import MSG_TEXT, FrameParser, decode_text
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def test_connect_retries_after_failed_attempt():
+    async def scenario():
+        port = free_port()
+        client = AsyncClient('127.0.0.1', port, reconnect=False)
+        with pytest.raises(ClientClosedError):
+            await client.connect(timeout=2)
+
+        received = asyncio.Queue()
+
+        async def handle(reader, writer):
+            parser = FrameParser()
+            while data := await reader.read(65536):
+                parser.feed(data)
+                for msg_type, payload in parser.frames():
+                    if msg_type == MSG_TEXT:
+                        received.put_nowait(decode_text(payload))
+            writer.close()
+
+        server = await asyncio.start_server(handle, '127.0.0.1', port)
+        async with server:
+            await client.connect(timeout=2)
+            await client.send('после повторного подключения')
+            assert await asyncio.wait_for(received.get(), 2) == 'после повторного подключения'
+            await client.close()
+
+    asyncio.run(scenario())
@@ -0,0 +1,111 @@
+import os
+import tempfile
+
+import pytest
+
+from cache import TTLCache
+from cluster import CacheSync, ControlError, ControlServer, MessageFeed, RemoteServerController
+from pubsub import MessageBus
+from users_database import create_connection, create_tables, insert_message
+
+
+@pytest.fixture
+def db_file(tmp_path):
+    path = str(tmp_path / 'chat.sqlite')
+    conn = create_connection(path)
+    create_tables(conn)
+    conn.close()
+    return path
+
+
+def test_cache_sync_applies_changes_committed_elsewhere(db_file):
+    profiles = TTLCache()
+    sync = CacheSync(db_file, {'profile': profiles.invalidate}, profiles.clear)
+    sync.sync()
+
+    writer = create_connection(db_file)
+    profile_id = writer.execute("INSERT INTO user_profiles (bio) VALUES ('old')").lastrowid
+    writer.commit()
+    profiles.put(str(profile_id), 'old')
+    sync.sync()
+    assert profiles.get(str(profile_id)) == 'old'
+
+    # Изменение в другом процессе: локальный invalidate не вызывался
+    writer.execute("UPDATE user_profiles SET bio = 'new' WHERE profile_id = ?", (profile_id,))
+    writer.commit()
+    sync.sync()
+    assert profiles.get(str(profile_id)) is None
+    writer.close()
+
+
+def test_message_feed_publishes_database_ids(db_file):
+    bus = MessageBus()
+    conn = create_connection(db_file)
+    insert_message(conn, 'alice', 'до запуска')
+    feed = MessageFeed(db_file, bus)
+    feed.start()
+    try:
+        assert bus.last_id() == 1
+        insert_message(conn, 'bob', 'после запуска')
+        events, cursor, missed = bus.wait(1, 5)
+        assert [(event_id, event['username'], event['text']) for event_id, event in events] == \
+            [(2, 'bob', 'после запуска')]
+        # Курсор старше начала шины: история есть только в БД
+        assert bus.wait(0, 0)[2] is True
+    finally:
+        feed.stop()
+        conn.close()
+
+
+class FakeController:
+    def __init__(self):
+        self.port = self.mode = None
+        self.backlog = 128
+        self.udp = False
+        self.stats = type('Stats', (), {'active': 0})()
+        self.notified = []
+
+    def is_running(self):
+        return self.port is not None
+
+    def start(self, port, mode='threads', backlog=None):
+        if self.port is not None:
+            raise RuntimeError("Сервер уже запущен")
+        self.port, self.mode = port, mode
+
+    def stop(self, timeout=5):
+        self.port = None
+        return True
+
+    def restart(self, port=None, mode=None, backlog=None):
+        self.stop()
+        self.start(port, mode)
+
+    def status(self):
+        return {'running': self.is_running(), 'port': self.port}
+
+    def notify_delivery(self, recipient):
+        self.notified.append(recipient)
+
+
+def test_remote_controller_drives_controller_in_another_process():
+    path = os.path.join(tempfile.mkdtemp(), 'control.sock')
+    controller = FakeController()
+    remote = RemoteServerController(path, stop_timeout=1)
+    with pytest.raises(ControlError):
+        remote.is_running()
+
+    server = ControlServer(controller, path).start()
+    try:
+        remote.start(15001, 'async')
+        assert remote.is_running() and remote.port == 15001 and remote.mode == 'async'
+        with pytest.raises(RuntimeError, match="уже запущен"):
+            remote.start(15001)
+        remote.notify_delivery('alice')
+        assert controller.notified == ['alice']
+        assert remote.stop() is True
+        assert not remote.is_running()
+        assert remote.status() == {'running': False, 'port': None}
+    finally:
+        server.stop()
+    assert not os.path.exists(path)
@@ -0,0 +1,60 @@
+import zlib
+
+import pytest
+
+from compression import (
+    CODEC_ZLIB, CODEC_ZSTD, SYNC_MARKER, ClientCompression, WireCodec, WireCompression,
+    available_codecs, decode_frame
+)
+from protocol import FLAG_COMPRESSED, HEADER, HEADER_SIZE, MSG_TEXT, FrameError, encode_text
+
+CODECS = available_codecs()
+
+
+def negotiate(codec, dictionary=b''):
+    server = WireCompression({codec: dictionary} if dictionary else {}, codecs=(codec,), threshold=8)
+    client = ClientCompression(codecs=(codec,))
+    server_codec, reply = server.accept(client.offer_frame()[HEADER_SIZE:])
+    server_codec.encode(reply)
+    return server_codec, client.accept_reply(reply[HEADER_SIZE:])
+
+
+@pytest.mark.parametrize('codec', CODECS)
+def test_roundtrip_keeps_context(codec):
+    server_codec, client_codec = negotiate(codec, b'hello everyone in the chat room ')
+    for text in ['hello everyone in the chat room, again and again'] * 3 + ['short', 'x' * 5000]:
+        frame = server_codec.encode(encode_text(text))
+        size, msg_type = HEADER.unpack_from(frame)
+        msg_type, payload = decode_frame(client_codec, msg_type, frame[HEADER_SIZE:])
+        assert (msg_type, payload.decode('utf-8')) == (MSG_TEXT, text)
+
+
+def bomb(codec, size):
+    if codec == CODEC_ZSTD:
+        import zstandard
+        compressor = zstandard.ZstdCompressor().compressobj()
+        return compressor.compress(b'\0' * size) + compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+    compressor = zlib.compressobj(9, zlib.DEFLATED, -14)
+    return (compressor.compress(b'\0' * size) + compressor.flush(zlib.Z_SYNC_FLUSH))[:-len(SYNC_MARKER)]
+
+
+@pytest.mark.parametrize('codec', CODECS)
+def test_decompressed_size_is_limited(codec):
+    receiver = WireCodec(codec, active=True, max_frame_size=1024 * 1024)
+    payload = bomb(codec, 50 * 1024 * 1024)
+    assert len(payload) < 100 * 1024
+    with pytest.raises(FrameError):
+        receiver.decode(MSG_TEXT | FLAG_COMPRESSED, payload)
+
+
+@pytest.mark.parametrize('codec', CODECS)
+def test_frame_at_limit_is_accepted(codec):
+    receiver = WireCodec(codec, active=True, max_frame_size=1024 * 1024)
+    msg_type, data = receiver.decode(MSG_TEXT | FLAG_COMPRESSED, bomb(codec, 1024 * 1024))
+    assert len(data) == 1024 * 1024
+
+
+def test_corrupt_payload_is_frame_error():
+    receiver = WireCodec(CODEC_ZLIB, active=True)
+    with pytest.raises(FrameError):
+        receiver.decode(MSG_TEXT | FLAG_COMPRESSED, b'\xff' * 32)
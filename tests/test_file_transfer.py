@@ -0,0 +1,50 @@
+import hashlib
+import json
+
+from file_transfer import (
+    CHUNK_PREFIX, STATUS_ACCEPTED, STATUS_COMPLETE, STATUS_ERROR, FileReceiver, MediaStore, is_digest
+)
+from protocol import HEADER_SIZE, MSG_FILE_CHUNK, MSG_FILE_OFFER
+
+
+def offer(receiver, data):
+    digest = hashlib.sha256(data).hexdigest()
+    [reply] = receiver.handle(MSG_FILE_OFFER, json.dumps({'sha256': digest, 'size': len(data)}).encode())
+    return digest, json.loads(reply[HEADER_SIZE:])
+
+
+def send(receiver, digest, data):
+    [reply] = receiver.handle(MSG_FILE_CHUNK, CHUNK_PREFIX.pack(bytes.fromhex(digest), 0) + data)
+    return json.loads(reply[HEADER_SIZE:])
+
+
+def test_digest_rejects_trailing_newline():
+    digest = hashlib.sha256(b'x').hexdigest()
+    assert is_digest(digest)
+    assert not is_digest(digest + '\n')
+    assert not is_digest(digest.upper())
+
+
+def test_store_quota_counts_files_and_reservations(tmp_path):
+    store = MediaStore(str(tmp_path), max_store_size=100)
+    first = FileReceiver(store)
+    digest, ack = offer(first, b'a' * 60)
+    assert ack['status'] == STATUS_ACCEPTED
+
+    # Место под незавершенный прием уже занято
+    _, ack = offer(FileReceiver(store), b'b' * 60)
+    assert ack == {'sha256': ack['sha256'], 'status': STATUS_ERROR, 'message': 'media storage quota exceeded'}
+
+    assert send(first, digest, b'a' * 60)['status'] == STATUS_COMPLETE
+    assert store.usage() == {'used': 60, 'reserved': 0, 'max': 100}
+    _, ack = offer(FileReceiver(store), b'c' * 40)
+    assert ack['status'] == STATUS_ACCEPTED
+
+
+def test_connection_upload_quota(tmp_path):
+    receiver = FileReceiver(MediaStore(str(tmp_path)), max_upload=100, max_transfers=2)
+    assert offer(receiver, b'a' * 50)[1]['status'] == STATUS_ACCEPTED
+    assert offer(receiver, b'b' * 40)[1]['status'] == STATUS_ACCEPTED
+    assert offer(receiver, b'c' * 5)[1]['message'] == 'too many concurrent transfers'
+    receiver.close()
+    assert offer(receiver, b'd' * 20)[1]['message'] == 'connection upload quota exceeded'
@@ -0,0 +1,115 @@
+import asyncio
+import socket
+import time
+
+import pytest
+
+from mesh import MAX_MEMBERS, READ_SIZE, MeshNode
+from protocol import MSG_MESH, MSG_PEER_HELLO, encode_frame
+
+GOSSIP_INTERVAL = 0.05
+FAIL_TIMEOUT = 0.5
+
+
+def free_ports(count):
+    sockets = [socket.socket() for _ in range(count)]
+    try:
+        for sock in sockets:
+            sock.bind(('127.0.0.1', 0))
+        return [sock.getsockname()[1] for sock in sockets]
+    finally:
+        for sock in sockets:
+            sock.close()
+
+
+async def wait_for(predicate, timeout):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            return False
+        await asyncio.sleep(0.02)
+    return True
+
+
+def make_node(port, seeds=()):
+    return MeshNode(port, seeds=seeds, min_peers=2, max_peers=4, fanout=2,
+                    gossip_interval=GOSSIP_INTERVAL, fail_timeout=FAIL_TIMEOUT)
+
+
+def test_dead_node_is_forgotten():
+    async def scenario():
+        ports = free_ports(8)
+        seed = f"127.0.0.1:{ports[0]}"
+        nodes = [make_node(port, [seed] if index else []) for index, port in enumerate(ports)]
+        for node in nodes:
+            await node.start()
+        try:
+            assert await wait_for(lambda: all(len(node.members) == len(nodes) - 1 for node in nodes), 10)
+            dead = nodes.pop()
+            await dead.stop()
+            gone = lambda: all(dead.addr not in node.members for node in nodes)
+            assert await wait_for(gone, 10 * FAIL_TIMEOUT)
+            # Надгробия истекают через 2×fail_timeout; участник не должен вернуться и после этого
+            await asyncio.sleep(4 * FAIL_TIMEOUT)
+            assert gone()
+            assert all(dead.addr not in node.neighbours for node in nodes)
+        finally:
+            for node in nodes:
+                await node.stop()
+
+    asyncio.run(scenario())
+
+
+def test_stale_digest_does_not_revive_member():
+    node = make_node(1)
+    node.members['10.0.0.1:1'] = [5, time.monotonic() - 2 * FAIL_TIMEOUT]
+    node._gossip_round()
+    assert '10.0.0.1:1' not in node.members
+    node._merge({'10.0.0.1:1': 5})
+    assert '10.0.0.1:1' not in node.members
+    node._merge({'10.0.0.1:1': 6})
+    assert node.members['10.0.0.1:1'][0] == 6
+
+
+def test_malformed_digest():
+    node = make_node(1)
+    with pytest.raises(ValueError):
+        node._merge(['10.0.0.1:1'])
+    node._merge({'10.0.0.1:1': 'x', '10.0.0.2:1': None, '10.0.0.3:1': True, '10.0.0.4:1': -1, 'x' * 100: 1})
+    assert node.members == {}
+
+
+def test_members_are_bounded():
+    node = make_node(1)
+    for start in range(0, MAX_MEMBERS + 200, 200):
+        node._merge({f"10.{index // 65536}.{index // 256 % 256}.{index % 256}:1": 1
+                     for index in range(start, start + 200)})
+    assert len(node.members) == MAX_MEMBERS
+
+
+@pytest.mark.parametrize('frames', [
+    [encode_frame(MSG_PEER_HELLO, b'127.0.0.1:1'), encode_frame(MSG_MESH, b'ab')],
+    [encode_frame(MSG_PEER_HELLO, b'127.0.0.1:1'), encode_frame(MSG_MESH, bytes(17) + b'no separators')],
+    [encode_frame(MSG_PEER_HELLO, b'\xff\xfe\x00')],
+    [encode_frame(MSG_PEER_HELLO, b'x' * 1000)],
+])
+def test_malformed_frames_close_link(frames):
+    async def scenario():
+        errors = []
+        asyncio.get_running_loop().set_exception_handler(lambda loop, context: errors.append(context))
+        port, = free_ports(1)
+        node = await make_node(port).start()
+        try:
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write(b''.join(frames))
+            await writer.drain()
+            # Узел закрывает соединение, не падая с необработанным исключением
+            while await asyncio.wait_for(reader.read(READ_SIZE), 5):
+                pass
+            writer.close()
+            assert await wait_for(lambda: not node.neighbours, 5)
+            assert errors == []
+        finally:
+            await node.stop()
+
+    asyncio.run(scenario())
@@ -0,0 +1,73 @@
+import threading
+
+import pytest
+
+import message_writer
+from message_writer import WRITER_DROPPED, MessageWriter
+from users_database import create_connection, create_tables
+
+
+def make_db(tmp_path):
+    db_file = str(tmp_path / 'chat.sqlite')
+    conn = create_connection(db_file)
+    create_tables(conn)
+    conn.close()
+    return db_file
+
+
+def stored_texts(db_file):
+    conn = create_connection(db_file)
+    try:
+        return [row[0] for row in conn.execute("SELECT message_text FROM messages ORDER BY message_id")]
+    finally:
+        conn.close()
+
+
+def test_bad_message_does_not_drop_batch(tmp_path, monkeypatch):
+    monkeypatch.setattr(message_writer, 'RETRY_DELAY', 0.001)
+    db_file = make_db(tmp_path)
+    committed = []
+    writer = MessageWriter(db_file, max_latency=0.5, on_commit=committed.extend)
+    dropped = WRITER_DROPPED._collect().get((), 0)
+    for text in ('первое', object(), 'третье'):
+        writer.submit('alice', text)
+    writer.start()
+    try:
+        assert writer.flush(5)
+    finally:
+        writer.stop(5)
+    assert stored_texts(db_file) == ['первое', 'третье']
+    assert [text for _, text in committed] == ['первое', 'третье']
+    assert WRITER_DROPPED._collect()[()] == dropped + 1
+
+
+def test_writer_waits_for_database(tmp_path, monkeypatch):
+    monkeypatch.setattr(message_writer, 'RETRY_DELAY', 0.01)
+    db_file = make_db(tmp_path)
+    real_open = message_writer.open_connection
+    available = threading.Event()
+
+    def open_connection(path):
+        if not available.is_set():
+            raise OSError('unavailable')
+        return real_open(path)
+
+    monkeypatch.setattr(message_writer, 'open_connection', open_connection)
+    writer = MessageWriter(db_file)
+    writer.start()
+    try:
+        writer.submit('alice', 'hello')
+        available.set()
+        assert writer.flush(5)
+    finally:
+        writer.stop(5)
+    assert stored_texts(db_file) == ['hello']
+
+
+def test_submit_fails_when_writer_died(tmp_path):
+    writer = MessageWriter(make_db(tmp_path), max_queue_size=1)
+    writer._thread = threading.Thread(target=lambda: None)
+    writer._thread.start()
+    writer._thread.join()
+    with pytest.raises(RuntimeError):
+        writer.submit('alice', 'hello')
@@ -0,0 +1,44 @@
+import sqlite3
+import threading
+
+import pytest
+
+from metrics import Counter, Histogram, _Metric
+from users_database import InstrumentedConnection, statement_label
+
+
+def test_dead_thread_shards_are_retired_on_insert():
+    counter = Counter('test_threads_total', 'test', registry=None)
+    for _ in range(200):
+        thread = threading.Thread(target=counter.inc)
+        thread.start()
+        thread.join()
+    assert len(counter._shards) <= 1
+    assert counter.render() == ['test_threads_total 200']
+
+
+def test_metric_base_is_abstract():
+    with pytest.raises(TypeError):
+        _Metric('test_abstract', 'test', registry=None)
+
+
+def test_statement_labels():
+    assert statement_label("SELECT * FROM posts WHERE post_id = ?") == 'select posts'
+    assert statement_label("INSERT INTO user_profiles (bio) VALUES (?)") == 'insert user_profiles'
+    assert statement_label("UPDATE posts SET title = ?") == 'update posts'
+    assert statement_label("PRAGMA user_version") == 'pragma'
+
+
+def test_connection_times_every_statement(monkeypatch):
+    import users_database
+    histogram = Histogram('test_statement_seconds', 'test', ('statement',), registry=None)
+    monkeypatch.setattr(users_database, 'DB_STATEMENT_SECONDS', histogram)
+    monkeypatch.setattr(users_database, '_statement_timers', {})
+    conn = sqlite3.connect(':memory:', factory=InstrumentedConnection)
+    conn.execute("CREATE TABLE items (value TEXT)")
+    conn.executemany("INSERT INTO items (value) VALUES (?)", [('a',), ('b',)])
+    cursor = conn.cursor()
+    cursor.execute("SELECT value FROM items")
+    assert len(cursor.fetchall()) == 2
+    counts = {key[0]: sum(row[:-1]) for key, row in histogram._collect().items()}
+    assert counts == {'create items': 1, 'insert items': 1, 'select items': 1}
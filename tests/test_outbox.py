@@ -0,0 +1,53 @@
+from outbox import DeliveryService, decode_deliver, encode_delivery_ack
+from protocol import HEADER_SIZE, MSG_DELIVER, MSG_DELIVERY_ACK, MSG_HELLO, FrameParser, decode_text
+from users_database import create_connection, create_tables, enqueue_outbox
+
+
+class FakePeer:
+    def __init__(self, peer_id):
+        self.peer_id = peer_id
+        self.closed = False
+        self.frames = []
+
+    def enqueue(self, frame):
+        parser = FrameParser()
+        parser.feed(frame)
+        self.frames.extend(parser.frames())
+        return True
+
+    def delivered(self):
+        return [decode_deliver(payload) for msg_type, payload in self.frames if msg_type == MSG_DELIVER]
+
+
+def make_service(tmp_path):
+    db_file = str(tmp_path / 'chat.sqlite')
+    conn = create_connection(db_file)
+    create_tables(conn)
+    for i in range(3):
+        enqueue_outbox(conn, 'alice', 'bob', f'письмо {i}')
+    conn.close()
+    return DeliveryService(db_file, router=None, window=2)
+
+
+def test_second_live_session_cannot_claim_username(tmp_path):
+    service = make_service(tmp_path)
+    owner, intruder = FakePeer('10.0.0.1:1'), FakePeer('10.0.0.2:2')
+
+    service.handle_frame(owner, MSG_HELLO, 'alice'.encode())
+    assert [text for _, _, text in owner.delivered()] == ['письмо 0', 'письмо 1']
+
+    service.handle_frame(intruder, MSG_HELLO, 'alice'.encode())
+    assert intruder.delivered() == []
+    assert 'уже подключен' in decode_text(intruder.frames[-1][1])
+    # Подтверждение от непредставившегося соединения игнорируется
+    service.handle_frame(intruder, MSG_DELIVERY_ACK, encode_delivery_ack([1, 2, 3])[HEADER_SIZE:])
+    assert service.stats()['inflight'] == 2
+
+    service.handle_frame(owner, MSG_DELIVERY_ACK, encode_delivery_ack([1, 2])[HEADER_SIZE:])
+    assert [text for _, _, text in owner.delivered()][-1] == 'письмо 2'
+
+    # После отключения владельца имя снова свободно
+    owner.closed = True
+    service.disconnect(owner)
+    service.handle_frame(intruder, MSG_HELLO, 'alice'.encode())
+    assert [text for _, _, text in intruder.delivered()] == ['письмо 2']
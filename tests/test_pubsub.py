@@ -0,0 +1,88 @@
+import json
+import socket
+import threading
+import time
+
+from pubsub import MessageBus
+from stream_server import StreamServer
+
+
+def test_publish_wakes_only_matching_waiters():
+    bus = MessageBus()
+    woken = []
+    _, _, _, alice = bus.watch(0, lambda event: event['username'] == 'alice', lambda: woken.append('alice'))
+    _, _, _, bob = bus.watch(0, lambda event: event['username'] == 'bob', lambda: woken.append('bob'))
+    _, _, _, everyone = bus.watch(0, None, lambda: woken.append('all'))
+
+    bus.publish({'username': 'alice', 'text': 'привет'})
+
+    assert sorted(woken) == ['alice', 'all']
+    assert bus.waiter_count() == 1
+    bus.unwatch(bob)
+    assert bus.waiter_count() == 0
+
+
+def test_wait_returns_events_published_from_another_thread():
+    bus = MessageBus()
+    threading.Timer(0.05, bus.publish_many, args=([{'username': 'u', 'text': str(i)} for i in range(3)],)).start()
+    events, cursor, missed = bus.wait(0, 2)
+    assert [event['text'] for _, event in events] == ['0', '1', '2']
+    assert cursor == 3 and not missed
+    assert bus.waiter_count() == 0
+
+    started = time.monotonic()
+    assert bus.wait(cursor, 0.05) == ([], 3, False)
+    assert time.monotonic() - started < 1
+    assert bus.waiter_count() == 0
+
+
+def read_events(sock, count):
+    events, buffer = [], b''
+    while len(events) < count:
+        buffer += sock.recv(65536)
+        *blocks, buffer = buffer.split(b'\n\n')
+        for block in blocks:
+            fields = dict(line.split(': ', 1) for line in block.decode().split('\n') if ': ' in line)
+            if fields.get('event') == 'message':
+                events.append((int(fields['id']), json.loads(fields['data'])))
+    return events
+
+
+def test_stream_server_serves_many_subscribers_on_one_thread():
+    bus = MessageBus()
+    server = StreamServer(bus, keepalive=5).start('127.0.0.1', 0)
+    threads_before = threading.active_count()
+    clients = []
+    try:
+        for index in range(50):
+            sock = socket.create_connection(('127.0.0.1', server.port), timeout=5)
+            username = 'alice' if index % 2 else 'bob'
+            sock.sendall(f"GET /api/messages/stream?username={username}&after=0 HTTP/1.1\r\n"
+                         f"Host: test\r\n\r\n".encode())
+            clients.append((username, sock))
+        deadline = time.monotonic() + 5
+        while server.subscriber_count() < 50 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert server.subscriber_count() == 50
+        assert threading.active_count() == threads_before
+
+        bus.publish_many([{'username': 'alice', 'text': 'a'}, {'username': 'bob', 'text': 'b'}])
+        for username, sock in clients:
+            [(event_id, event)] = read_events(sock, 1)
+            assert event['username'] == username
+            assert event_id == (1 if username == 'alice' else 2)
+
+        poll = socket.create_connection(('127.0.0.1', server.port), timeout=5)
+        poll.sendall(b"GET /api/messages/poll?after=1&timeout=1 HTTP/1.1\r\nHost: test\r\n\r\n")
+        response = b''
+        while chunk := poll.recv(65536):
+            response += chunk
+        document = json.loads(response.split(b'\r\n\r\n', 1)[1])
+        assert document['next_after'] == 2
+        assert [message['text'] for message in document['messages']] == ['b']
+        poll.close()
+    finally:
+        for _, sock in clients:
+            sock.close()
+        server.stop()
+    assert not server.is_running()
@@ -0,0 +1,125 @@
+import asyncio
+import socket
+import time
+
+import async_server
+from async_client import AsyncClient
+from udp_transport import (
+    CONTROL_PACKET, MESSAGE_HEADER, PACKET_BIND, PACKET_HEADER, VERSION, UdpChatEndpoint, UdpTransport
+)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+async def wait_for(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, "условие не выполнилось"
+        await asyncio.sleep(0.01)
+
+
+def test_transport_delivers_with_loss():
+    async def scenario():
+        received = set()
+        receiver = await UdpTransport.create('127.0.0.1', 0, on_message=lambda addr, text: received.add(text),
+                                             loss=0.2)
+        sender = await UdpTransport.create('127.0.0.1', 0, loss=0.2)
+        for index in range(500):
+            sender.send(receiver.local_addr, str(index))
+        await wait_for(lambda: len(received) == 500)
+        assert await sender.drain(timeout=5)
+        sender.close()
+        receiver.close()
+
+    asyncio.run(scenario())
+
+
+class ChatServer:
+    def __init__(self):
+        self.port = free_port()
+        self.endpoint = UdpChatEndpoint(async_server.router)
+        self.server = None
+
+    async def __aenter__(self):
+        await self.endpoint.start(self.port, '127.0.0.1')
+        self.server = await asyncio.start_server(
+            lambda reader, writer: async_server.handle_connection(reader, writer, None, udp=self.endpoint),
+            '127.0.0.1', self.port)
+        return self
+
+    async def __aexit__(self, *exc):
+        self.server.close()
+        await self.endpoint.close()
+
+
+def test_bound_client_uses_udp_and_falls_back_to_tcp():
+    async def scenario():
+        async with ChatServer() as chat:
+            udp_inbox, tcp_inbox = [], []
+            udp_client = AsyncClient('127.0.0.1', chat.port, on_message=udp_inbox.append, udp=True)
+            tcp_client = AsyncClient('127.0.0.1', chat.port, on_message=tcp_inbox.append)
+            await udp_client.connect(timeout=5)
+            await tcp_client.connect(timeout=5)
+            await wait_for(lambda: udp_client.udp_bound)
+            assert len(chat.endpoint.bindings) == 1
+
+            await udp_client.send('по UDP')
+            await wait_for(lambda: any(text.endswith(': по UDP') for text in tcp_inbox))
+            assert chat.endpoint.udp.stats['received'] == 1
+
+            await tcp_client.send('короткое')
+            await tcp_client.send('длинное ' + 'x' * 5000)
+            await wait_for(lambda: len(udp_inbox) == 2)
+            assert chat.endpoint.udp.stats['sent'] == 1
+
+            await udp_client.close()
+            await wait_for(lambda: not chat.endpoint.bindings)
+            await tcp_client.close()
+
+    asyncio.run(scenario())
+
+
+def test_unbound_and_spoofed_sources_are_ignored():
+    async def scenario():
+        async with ChatServer() as chat:
+            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+                sock.settimeout(0.3)
+                payload = b'spoofed'
+                data = (PACKET_HEADER.pack(VERSION, 1, 1, 1, 0, 1)
+                        + MESSAGE_HEADER.pack(1, len(payload)) + payload)
+                sock.sendto(data, ('127.0.0.1', chat.port))
+                sock.sendto(CONTROL_PACKET.pack(PACKET_BIND, b'\0' * 16), ('127.0.0.1', chat.port))
+                await asyncio.sleep(0.2)
+                # Ни подтверждения, ни проверки адреса на неизвестный токен
+                try:
+                    reply = sock.recv(2048)
+                except socket.timeout:
+                    reply = None
+            assert reply is None
+            assert chat.endpoint.udp.stats['datagrams_rejected'] == 1
+            assert chat.endpoint.udp.channels == {}
+            assert chat.endpoint.bindings == {}
+
+    asyncio.run(scenario())
+
+
+def test_bind_limit():
+    async def scenario():
+        async with ChatServer() as chat:
+            chat.endpoint.max_peers = 1
+            first = AsyncClient('127.0.0.1', chat.port, udp=True)
+            second = AsyncClient('127.0.0.1', chat.port, udp=True)
+            await first.connect(timeout=5)
+            await wait_for(lambda: first.udp_bound)
+            await second.connect(timeout=5)
+            await asyncio.sleep(0.5)
+            assert not second.udp_bound
+            assert len(chat.endpoint.bindings) == 1
+            await first.close()
+            await second.close()
+
+    asyncio.run(scenario())
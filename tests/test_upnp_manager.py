@@ -0,0 +1,90 @@
+import threading
+import time
+
+from upnp_manager import JOB_ERROR, JOB_SUCCESS, PortMappingManager
+
+
+class FakeIGD:
+    """ Поддельный IGD с интерфейсом miniupnpc.UPnP; правила хранятся в памяти """
+
+    def __init__(self, permanent_only=False, devices=1):
+        self.permanent_only = permanent_only
+        self.devices = devices
+        self.discoverdelay = None
+        self.lanaddr = '192.168.1.10'
+        self.rules = {}
+        self.added = []
+        self.lock = threading.Lock()
+
+    def discover(self):
+        return self.devices
+
+    def selectigd(self):
+        if not self.devices:
+            raise Exception('No UPnP device discovered')
+
+    def externalipaddress(self):
+        return '203.0.113.7'
+
+    def getspecificportmapping(self, port, protocol):
+        with self.lock:
+            return self.rules.get((port, protocol))
+
+    def addportmapping(self, port, protocol, lan, internal, description, remote, lease):
+        if lease and self.permanent_only:
+            raise Exception('725 OnlyPermanentLeasesSupported')
+        with self.lock:
+            self.rules[(port, protocol)] = (lan, internal, description, lease)
+            self.added.append((port, protocol, lease))
+        return True
+
+    def deleteportmapping(self, port, protocol):
+        with self.lock:
+            self.rules.pop((port, protocol), None)
+        return True
+
+
+def make_manager(igd, **kwargs):
+    return PortMappingManager(upnp_factory=lambda: igd, discover_delay=10, **kwargs)
+
+
+def test_open_and_stop_removes_mappings():
+    igd = FakeIGD()
+    manager = make_manager(igd)
+    job = manager.wait(manager.submit_open(5000, 5000, 'tcp'), timeout=5)
+    assert job['status'] == JOB_SUCCESS
+    assert job['result']['external_ip'] == '203.0.113.7'
+    assert (5000, 'TCP') in igd.rules
+    manager.stop()
+    assert igd.rules == {}
+    assert manager.mappings() == []
+
+
+def test_lease_is_renewed_before_expiry():
+    igd = FakeIGD()
+    manager = make_manager(igd, lease_duration=1)
+    manager.wait(manager.submit_open(5001, 5001, 'UDP'), timeout=5)
+    deadline = time.monotonic() + 5
+    while len(igd.added) < 3 and time.monotonic() < deadline:
+        time.sleep(0.05)
+    manager.stop()
+    assert igd.added[:3] == [(5001, 'UDP', 1)] * 3
+    assert manager.mappings() == []
+
+
+def test_permanent_only_router_gets_zero_lease():
+    igd = FakeIGD(permanent_only=True)
+    manager = make_manager(igd)
+    job = manager.wait(manager.submit_open(5002, 5002), timeout=5)
+    assert job['status'] == JOB_SUCCESS
+    assert job['result']['lease'] == 0
+    (mapping,) = manager.mappings()
+    assert mapping['renew_at'] is None
+    manager.stop()
+
+
+def test_missing_igd_fails_job():
+    manager = make_manager(FakeIGD(devices=0))
+    job = manager.wait(manager.submit_open(5003, 5003), timeout=5)
+    assert job['status'] == JOB_ERROR
+    manager.stop()
@@ -0,0 +1,720 @@
+""" UDP-транспорт для коротких сообщений чата рядом с TCP-каналом.
+
+Сообщения нумеруются, доставляются сразу по приходу (без ожидания
+пропущенных — нет блокировки начала очереди, как в TCP) и
+подтверждаются выборочно: в каждой датаграмме есть номер, до которого
+все получено, и диапазоны номеров, полученных после прошлого
+подтверждения. Неподтвержденные сообщения повторяются по таймауту
+(RTO по измеренному RTT), повторы отсекаются получателем. В полете
+не больше window сообщений на адрес. Несколько сообщений и
+подтверждения упаковываются в одну датаграмму. Сообщения больше
+max_message и те, что не удалось доставить за max_retries попыток,
+уходят через fallback (обычно TCP).
+
+Датаграмма: заголовок (версия, сессия отправителя, floor — все номера
+ниже больше не будут отправляться, база подтверждения, число
+диапазонов, число сообщений), диапазоны подтверждения (начало, длина),
+затем сообщения (номер, длина, текст UTF-8). Служебные датаграммы
+привязки адреса (PACKET_BIND, PACKET_CHALLENGE) — тип и 16 байт.
+
+Замер на loopback с потерями:
+
+    python udp_transport.py --bench --messages 20000 --loss 0.1
+"""
+import argparse
+import asyncio
+import hmac
+import inspect
+import json
+import os
+import random
+import statistics
+import socket
+import struct
+import time
+from collections import deque
+from protocol import MSG_TEXT, MSG_UDP_BIND, FrameParser, HEADER, decode_text, encode_frame, encode_text
+
+VERSION = 1
+PACKET_HEADER = struct.Struct('!BIIIHH')   # версия, сессия, floor, база подтверждения, диапазонов, сообщений
+ACK_RANGE = struct.Struct('!IH')           # первый номер, длина диапазона
+MESSAGE_HEADER = struct.Struct('!IH')      # номер, длина
+
+MAX_DATAGRAM = 1200          # байт: помещается в MTU без фрагментации
+ACK_RESERVE = 16 * ACK_RANGE.size  # место под подтверждения в датаграмме с данными
+MAX_UDP_MESSAGE = MAX_DATAGRAM - ACK_RESERVE - PACKET_HEADER.size - MESSAGE_HEADER.size
+DEFAULT_WINDOW = 1024        # неподтвержденных сообщений на адрес
+SOCKET_BUFFER = 1024 * 1024
+INITIAL_RTO = 0.2            # секунды
+MIN_RTO = 0.03
+MAX_RTO = 2.0
+MAX_RETRIES = 8
+ACK_DELAY = 0.005            # отложенное подтверждение: ждем попутных данных
+TICK = 0.01                  # период проверки повторов
+IDLE_TIMEOUT = 60.0          # секунды тишины до удаления состояния удаленной стороны
+
+# Привязка UDP-адреса к TCP-сессии (см. UdpChatEndpoint)
+TOKEN_SIZE = 16
+CONTROL_PACKET = struct.Struct(f'!B{TOKEN_SIZE}s')
+PACKET_BIND = 0xB1           # клиент -> сервер: токен, выданный по TCP
+PACKET_CHALLENGE = 0xB2      # сервер -> клиент: строка, которую клиент вернет по TCP
+MAX_UDP_PEERS = 10000        # привязанных адресов на сервер
+BIND_TIMEOUT = 30.0          # секунды жизни токена
+BIND_ATTEMPTS = 10           # датаграмм PACKET_BIND на токен (и проверок адреса)
+BIND_RETRY = 0.5             # секунды между попытками клиента
+SWEEP_INTERVAL = 1.0
+
+
+class _Outgoing:
+    __slots__ = ('payload', 'sent_at', 'retries', 'deadline')
+
+    def __init__(self, payload):
+        self.payload = payload
+        self.sent_at = None
+        self.retries = 0
+        self.deadline = None
+
+
+class _Channel:
+    """ Состояние обмена с одним адресом: исходящие номера и полученные входящие """
+
+    def __init__(self):
+        self.next_seq = 1
+        self.unacked = {}       # номер -> _Outgoing (в порядке номеров), в пределах окна
+        self.backlog = deque()  # (номер, _Outgoing) сверх окна
+        self.queued = []        # номера, ожидающие первой отправки или повтора
+        self.remote_session = None
+        self.recv_base = 1      # все номера ниже получены
+        self.recv_above = set() # полученные номера выше базы
+        self.ack_pending = set()  # полученные номера, о которых еще не сообщили
+        self.srtt = None
+        self.rttvar = 0.0
+        self.rto = INITIAL_RTO
+        self.active_at = time.monotonic()
+
+    def floor(self):
+        for seq in self.unacked:
+            return seq
+        return self.backlog[0][0] if self.backlog else self.next_seq
+
+    def take_ack_ranges(self, limit):
+        """ Забирает до limit диапазонов из ack_pending: [(начало, длина)] """
+        ranges = []
+        for seq in sorted(self.ack_pending):
+            if ranges and seq == ranges[-1][0] + ranges[-1][1] and ranges[-1][1] < 0xFFFF:
+                ranges[-1][1] += 1
+            elif len(ranges) < limit:
+                ranges.append([seq, 1])
+            else:
+                break
+        for start, length in ranges:
+            self.ack_pending.difference_update(range(start, start + length))
+        return ranges
+
+    def received(self, seq):
+        """ True, если номер пришел впервые """
+        if seq < self.recv_base or seq in self.recv_above:
+            return False
+        self.recv_above.add(seq)
+        while self.recv_base in self.recv_above:
+            self.recv_above.discard(self.recv_base)
+            self.recv_base += 1
+        return True
+
+    def advance_floor(self, floor):
+        # Номера ниже floor отправитель больше не пришлет (подтверждены или отброшены)
+        if floor > self.recv_base:
+            self.recv_above = {seq for seq in self.recv_above if seq >= floor}
+            self.recv_base = floor
+            while self.recv_base in self.recv_above:
+                self.recv_above.discard(self.recv_base)
+                self.recv_base += 1
+
+    def observe_rtt(self, sample):
+        # Оценка RTO как в TCP (RFC 6298)
+        if self.srtt is None:
+            self.srtt, self.rttvar = sample, sample / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - sample)
+            self.srtt = 0.875 * self.srtt + 0.125 * sample
+        self.rto = min(MAX_RTO, max(MIN_RTO, self.srtt + 4 * self.rttvar))
+
+
+class UdpTransport(asyncio.DatagramProtocol):
+    """ Надежная доставка коротких сообщений поверх UDP (без порядка).
+
+    on_message(addr, text) вызывается один раз для каждого сообщения.
+    fallback(addr, text) (функция или корутина) получает сообщения,
+    слишком большие для датаграммы или не доставленные за max_retries
+    попыток; без fallback такие сообщения считаются потерянными.
+    admit(addr) решает, принимать ли данные с адреса, для которого еще
+    нет состояния; отвергнутые датаграммы состояния не создают.
+    on_control(addr, kind, body) получает служебные датаграммы привязки.
+    loss — доля датаграмм, выбрасываемых при отправке (для проверок).
+    """
+
+    def __init__(self, on_message=None, fallback=None, loss=0.0, max_message=MAX_UDP_MESSAGE,
+                 max_retries=MAX_RETRIES, batch_delay=0.0, window=DEFAULT_WINDOW, admit=None,
+                 on_control=None):
+        self.on_message = on_message
+        self.fallback = fallback
+        self.admit = admit
+        self.on_control = on_control
+        self.loss = loss
+        self.max_message = min(max_message, MAX_UDP_MESSAGE)
+        self.max_retries = max_retries
+        self.batch_delay = batch_delay
+        self.window = window
+        self.session = random.getrandbits(32)
+        self.transport = None
+        self.channels = {}
+        self.stats = dict.fromkeys(
+            ('sent', 'received', 'duplicates', 'retransmits', 'datagrams_sent', 'datagrams_received',
+             'datagrams_dropped', 'datagrams_rejected', 'fallback', 'lost'), 0)
+        self._flush_handles = {}  # адрес -> (handle, отложенный ли сброс)
+        self._ticker = None
+        self._closed = None
+
+    @classmethod
+    async def create(cls, host='0.0.0.0', port=0, **kwargs):
+        """ Открывает UDP-сокет и возвращает готовый транспорт """
+        loop = asyncio.get_running_loop()
+        _, protocol = await loop.create_datagram_endpoint(lambda: cls(**kwargs), local_addr=(host, port))
+        return protocol
+
+    @property
+    def local_addr(self):
+        return self.transport.get_extra_info('sockname')[:2]
+
+    # --- asyncio.DatagramProtocol ---
+
+    def connection_made(self, transport):
+        self.transport = transport
+        sock = transport.get_extra_info('socket')
+        for option in (socket.SO_RCVBUF, socket.SO_SNDBUF):
+            try:
+                sock.setsockopt(socket.SOL_SOCKET, option, SOCKET_BUFFER)
+            except OSError:
+                pass
+        loop = asyncio.get_running_loop()
+        self._closed = loop.create_future()
+        self._ticker = loop.call_later(TICK, self._tick)
+
+    def connection_lost(self, exc):
+        if self._ticker is not None:
+            self._ticker.cancel()
+        if self._closed is not None and not self._closed.done():
+            self._closed.set_result(None)
+
+    def error_received(self, exc):
+        # ICMP «порт недоступен» и т.п.: сообщения повторятся по таймауту
+        pass
+
+    def datagram_received(self, data, addr):
+        addr = addr[:2]
+        if data[:1] and data[0] in (PACKET_BIND, PACKET_CHALLENGE):
+            if self.on_control is not None and len(data) == CONTROL_PACKET.size:
+                self.on_control(addr, *CONTROL_PACKET.unpack(data))
+            return
+        if addr not in self.channels and self.admit is not None and not self.admit(addr):
+            self.stats['datagrams_rejected'] += 1
+            return
+        try:
+            version, session, floor, ack_base, range_count, count = PACKET_HEADER.unpack_from(data)
+            if version != VERSION:
+                return
+            offset = PACKET_HEADER.size
+            ranges = []
+            for _ in range(range_count):
+                ranges.append(ACK_RANGE.unpack_from(data, offset))
+                offset += ACK_RANGE.size
+            records = []
+            for _ in range(count):
+                seq, size = MESSAGE_HEADER.unpack_from(data, offset)
+                offset += MESSAGE_HEADER.size
+                records.append((seq, data[offset:offset + size]))
+                offset += size
+        except struct.error:
+            return
+        self.stats['datagrams_received'] += 1
+        channel = self._channel(addr)
+        channel.active_at = time.monotonic()
+        if channel.remote_session != session:
+            # Удаленная сторона перезапустилась: нумерация начинается заново
+            channel.remote_session = session
+            channel.recv_base, channel.recv_above = floor, set()
+            channel.ack_pending.clear()
+        channel.advance_floor(floor)
+        self._handle_ack(addr, channel, ack_base, ranges)
+
+        messages = []
+        for seq, payload in records:
+            # Повтор тоже подтверждаем: прошлое подтверждение могло потеряться
+            channel.ack_pending.add(seq)
+            if channel.received(seq):
+                messages.append(str(payload, 'utf-8', errors='replace'))
+            else:
+                self.stats['duplicates'] += 1
+        if records:
+            self._schedule_flush(addr, ACK_DELAY)
+        for text in messages:
+            self.stats['received'] += 1
+            if self.on_message is not None:
+                self._call(self.on_message, addr, text)
+
+    # --- отправка ---
+
+    def send(self, addr, text):
+        """ Ставит сообщение в очередь; возвращает 'udp' или 'tcp' (через fallback) """
+        payload = text.encode('utf-8')
+        if len(payload) > self.max_message:
+            self._fall_back(addr, text)
+            return 'tcp'
+        addr = tuple(addr[:2])
+        channel = self._channel(addr)
+        seq = channel.next_seq
+        channel.next_seq += 1
+        self.stats['sent'] += 1
+        if channel.backlog or len(channel.unacked) >= self.window:
+            # Окно заполнено: отправим по мере подтверждений
+            channel.backlog.append((seq, _Outgoing(payload)))
+            return 'udp'
+        channel.unacked[seq] = _Outgoing(payload)
+        channel.queued.append(seq)
+        # Все send() одной итерации цикла событий уходят общими датаграммами
+        self._schedule_flush(addr, self.batch_delay)
+        return 'udp'
+
+    def pending(self):
+        return sum(len(channel.unacked) + len(channel.backlog) for channel in self.channels.values())
+
+    async def drain(self, timeout=None):
+        """ Ждет подтверждения всех отправленных сообщений """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.pending():
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            await asyncio.sleep(TICK)
+        return True
+
+    def send_control(self, addr, kind, body):
+        if self.transport is not None and not self.transport.is_closing():
+            self.transport.sendto(CONTROL_PACKET.pack(kind, body), tuple(addr[:2]))
+
+    def forget(self, addr):
+        """ Удаляет состояние адреса; неподтвержденные сообщения уходят в fallback """
+        channel = self.channels.pop(tuple(addr[:2]), None)
+        scheduled = self._flush_handles.pop(tuple(addr[:2]), None)
+        if scheduled is not None:
+            scheduled[0].cancel()
+        if channel is not None:
+            for item in [*channel.unacked.values(), *(item for _, item in channel.backlog)]:
+                self._fall_back(addr, item.payload.decode('utf-8'))
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+
+    async def wait_closed(self):
+        if self._closed is not None:
+            await self._closed
+
+    def _channel(self, addr):
+        channel = self.channels.get(addr)
+        if channel is None:
+            channel = self.channels[addr] = _Channel()
+        return channel
+
+    def _schedule_flush(self, addr, delay):
+        scheduled = self._flush_handles.get(addr)
+        if scheduled is not None:
+            handle, delayed = scheduled
+            if delayed and not delay:
+                # Данные не ждут отложенного подтверждения: оно уйдет вместе с ними
+                handle.cancel()
+            else:
+                return
+        loop = asyncio.get_running_loop()
+        if delay:
+            handle = loop.call_later(delay, self._flush, addr)
+        else:
+            handle = loop.call_soon(self._flush, addr)
+        self._flush_handles[addr] = (handle, bool(delay))
+
+    def _flush(self, addr):
+        self._flush_handles.pop(addr, None)
+        channel = self.channels.get(addr)
+        if channel is None or self.transport is None or self.transport.is_closing():
+            return
+        now = time.monotonic()
+        queued, channel.queued = channel.queued, []
+        messages = []
+        size = PACKET_HEADER.size
+        for seq in queued:
+            item = channel.unacked.get(seq)
+            if item is None:
+                continue
+            record = MESSAGE_HEADER.pack(seq, len(item.payload)) + item.payload
+            if messages and size + len(record) > MAX_DATAGRAM - ACK_RESERVE:
+                self._send_datagram(addr, channel, messages, size)
+                messages, size = [], PACKET_HEADER.size
+            messages.append(record)
+            size += len(record)
+            if item.sent_at is None:
+                item.sent_at = now
+            item.deadline = now + channel.rto * (2 ** item.retries)
+        if messages:
+            self._send_datagram(addr, channel, messages, size)
+        while channel.ack_pending:
+            self._send_datagram(addr, channel, [], PACKET_HEADER.size)
+
+    def _send_datagram(self, addr, channel, messages, size):
+        ranges = channel.take_ack_ranges((MAX_DATAGRAM - size) // ACK_RANGE.size)
+        header = PACKET_HEADER.pack(VERSION, self.session, channel.floor(), channel.recv_base,
+                                    len(ranges), len(messages))
+        self.stats['datagrams_sent'] += 1
+        if self.loss and random.random() < self.loss:
+            self.stats['datagrams_dropped'] += 1
+            return
+        self.transport.sendto(b''.join([header, *(ACK_RANGE.pack(*r) for r in ranges), *messages]), addr)
+
+    def _handle_ack(self, addr, channel, ack_base, ranges):
+        if not channel.unacked:
+            return
+        now = time.monotonic()
+        acked = []
+        for seq in channel.unacked:
+            if seq >= ack_base:
+                break
+            acked.append(seq)
+        for start, length in ranges:
+            acked.extend(range(start, start + length))
+        for seq in acked:
+            item = channel.unacked.pop(seq, None)
+            # По повторенным сообщениям RTT не меряем: неясно, на какую отправку ответ (алгоритм Карна)
+            if item is not None and item.retries == 0 and item.sent_at is not None:
+                channel.observe_rtt(now - item.sent_at)
+        admitted = False
+        while channel.backlog and len(channel.unacked) < self.window:
+            seq, item = channel.backlog.popleft()
+            channel.unacked[seq] = item
+            channel.queued.append(seq)
+            admitted = True
+        if admitted:
+            self._schedule_flush(addr, 0)
+
+    def _tick(self):
+        now = time.monotonic()
+        for addr, channel in list(self.channels.items()):
+            expired = [seq for seq, item in channel.unacked.items()
+                       if item.deadline is not None and item.deadline <= now]
+            for seq in expired:
+                item = channel.unacked[seq]
+                item.deadline = None
+                if item.retries >= self.max_retries:
+                    del channel.unacked[seq]
+                    self._fall_back(addr, item.payload.decode('utf-8'))
+                    continue
+                item.retries += 1
+                self.stats['retransmits'] += 1
+                channel.queued.append(seq)
+            if channel.queued:
+                self._flush(addr)
+            elif not channel.unacked and not channel.backlog and now - channel.active_at > IDLE_TIMEOUT:
+                del self.channels[addr]
+        self._ticker = asyncio.get_running_loop().call_later(TICK, self._tick)
+
+    def _fall_back(self, addr, text):
+        if self.fallback is None:
+            self.stats['lost'] += 1
+            return
+        self.stats['fallback'] += 1
+        self._call(self.fallback, tuple(addr[:2]), text)
+
+    @staticmethod
+    def _call(handler, *args):
+        result = handler(*args)
+        if inspect.isawaitable(result):
+            asyncio.ensure_future(result)
+
+
+class UdpBinding:
+    """ Путь датаграмм к TCP-участнику, подтвердившему свой UDP-адрес:
+    короткие текстовые кадры уходят по UDP, остальные — в его TCP-очередь """
+
+    def __init__(self, peer, addr, tcp_addr, transport, loop):
+        self.peer = peer
+        self.addr = addr
+        self.tcp_addr = tcp_addr
+        self.transport = transport
+        self.loop = loop
+
+    def send(self, frame):
+        if self.peer.closed:
+            return False
+        size, msg_type = HEADER.unpack_from(frame)
+        if msg_type != MSG_TEXT or size > self.transport.max_message:
+            return False
+        text = decode_text(memoryview(frame)[HEADER.size:])
+        # Рассылка может идти из других потоков — отправка всегда в цикле событий сервера
+        self.loop.call_soon_threadsafe(self.transport.send, self.addr, text)
+        self.peer.bytes_sent += size
+        return True
+
+
+class _PendingBind:
+    __slots__ = ('peer', 'tcp_addr', 'token', 'deadline', 'attempts', 'challenge', 'addr')
+
+    def __init__(self, peer, tcp_addr, token, deadline):
+        self.peer = peer
+        self.tcp_addr = tcp_addr
+        self.token = token
+        self.deadline = deadline
+        self.attempts = 0
+        self.challenge = None
+        self.addr = None
+
+
+def encode_bind(reply):
+    return encode_frame(MSG_UDP_BIND, json.dumps(reply).encode('utf-8'))
+
+
+def handle_udp_bind(peer, endpoint, tcp_addr, payload):
+    """ MSG_UDP_BIND на стороне сервера; без UDP-входа клиент получает отказ """
+    if endpoint is None:
+        peer.enqueue(encode_bind({'token': None}))
+        return
+    peer.enqueue(encode_bind(endpoint.handle_bind(peer, tcp_addr, payload)))
+
+
+class UdpChatEndpoint:
+    """ UDP-вход TCP-сервера чата на том же номере порта.
+
+    UDP-адрес принимается только после привязки к TCP-сессии:
+
+    1. клиент по TCP шлет MSG_UDP_BIND {} и получает {"token": ...};
+    2. с UDP-адреса клиент шлет токен датаграммой PACKET_BIND;
+    3. сервер отвечает на этот адрес датаграммой PACKET_CHALLENGE того
+       же размера со случайной строкой — усиления трафика нет;
+    4. клиент возвращает строку по TCP: MSG_UDP_BIND {"challenge": ...}
+       и получает {"bound": true}.
+
+    Подделавший чужой адрес строку не увидит, а датаграммы с
+    непривязанных адресов отбрасываются, не создавая состояния.
+    Привязок не больше max_peers, проверок адреса на токен — не больше
+    BIND_ATTEMPTS. Сообщения с привязанного адреса обрабатываются как
+    MSG_TEXT этого TCP-участника и передаются в on_message(адрес TCP,
+    text). Участнику короткие текстовые кадры уходят по UDP; длинные и
+    не доставленные за max_retries попыток — по его TCP-соединению.
+    """
+
+    def __init__(self, router, on_message=None, max_peers=MAX_UDP_PEERS, **kwargs):
+        self.router = router
+        self.on_message = on_message
+        self.max_peers = max_peers
+        self.bindings = {}  # UDP-адрес -> UdpBinding
+        self._pending = {}  # peer_id -> _PendingBind
+        self._tokens = {}   # токен -> peer_id
+        self.udp = UdpTransport(on_message=self._received, fallback=self._fall_back,
+                                admit=self.bindings.__contains__, on_control=self._control, **kwargs)
+        self._sweeper = None
+
+    async def start(self, port, host='0.0.0.0'):
+        loop = asyncio.get_running_loop()
+        await loop.create_datagram_endpoint(lambda: self.udp, local_addr=(host, port))
+        # Таймер, а не задача: serve_until при остановке ждет все задачи цикла
+        self._sweeper = loop.call_later(SWEEP_INTERVAL, self._sweep)
+        print(f"[Инфо] UDP-вход чата слушает порт {port}")
+        return self
+
+    async def close(self):
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+        for binding in list(self.bindings.values()):
+            binding.peer.datagrams = None
+        self.bindings.clear()
+        self._pending.clear()
+        self._tokens.clear()
+        self.udp.close()
+        await self.udp.wait_closed()
+
+    # --- привязка (вызывается в цикле событий сервера) ---
+
+    def handle_bind(self, peer, tcp_addr, payload):
+        """ Запрос токена или ответ на проверку адреса; возвращает ответ клиенту """
+        try:
+            request = json.loads(decode_text(payload)) if len(payload) else {}
+            challenge = request.get('challenge')
+        except (ValueError, AttributeError):
+            return {'bound': False, 'message': 'malformed bind request'}
+        if challenge is None:
+            self._discard_pending(peer.peer_id)
+            token = os.urandom(TOKEN_SIZE)
+            self._pending[peer.peer_id] = _PendingBind(peer, tcp_addr, token, time.monotonic() + BIND_TIMEOUT)
+            self._tokens[token] = peer.peer_id
+            return {'token': token.hex()}
+        pending = self._pending.get(peer.peer_id)
+        if (pending is None or pending.challenge is None or time.monotonic() > pending.deadline
+                or not isinstance(challenge, str) or not hmac.compare_digest(pending.challenge.hex(), challenge)):
+            return {'bound': False, 'message': 'address was not confirmed'}
+        self._discard_pending(peer.peer_id)
+        addr = pending.addr
+        current = self.bindings.get(addr)
+        if current is not None and current.peer is not peer:
+            return {'bound': False, 'message': 'address is bound to another session'}
+        if current is None and len(self.bindings) >= self.max_peers:
+            return {'bound': False, 'message': 'too many UDP peers'}
+        self.unbind(peer)
+        binding = UdpBinding(peer, addr, pending.tcp_addr, self.udp, asyncio.get_running_loop())
+        self.bindings[addr] = binding
+        peer.datagrams = binding
+        return {'bound': True}
+
+    def unbind(self, peer):
+        """ Снимает привязку участника (при отключении TCP-сессии) """
+        self._discard_pending(peer.peer_id)
+        binding = peer.datagrams
+        if binding is None:
+            return
+        peer.datagrams = None
+        if self.bindings.get(binding.addr) is binding:
+            # Неподтвержденные сообщения еще уйдут по TCP, если сессия жива
+            self.udp.forget(binding.addr)
+            del self.bindings[binding.addr]
+
+    def _discard_pending(self, peer_id):
+        pending = self._pending.pop(peer_id, None)
+        if pending is not None:
+            self._tokens.pop(pending.token, None)
+
+    def _control(self, addr, kind, body):
+        if kind != PACKET_BIND:
+            return
+        pending = self._pending.get(self._tokens.get(body))
+        if pending is None or pending.attempts >= BIND_ATTEMPTS or time.monotonic() > pending.deadline:
+            return
+        pending.attempts += 1
+        # Новая строка на каждую попытку: подтверждается последний адрес, с которого пришел токен
+        pending.challenge = os.urandom(TOKEN_SIZE)
+        pending.addr = addr
+        self.udp.send_control(addr, PACKET_CHALLENGE, pending.challenge)
+
+    # --- сообщения ---
+
+    def _received(self, addr, text):
+        binding = self.bindings.get(addr)
+        if binding is None or binding.peer.closed:
+            return
+        peer = binding.peer
+        self.router.broadcast(tuple(peer.rooms), encode_text(f"{peer.peer_id}: {text}"), exclude=peer.peer_id)
+        if self.on_message is not None:
+            # Сохранение в БД блокирующее — в пул потоков, как в async_server
+            asyncio.get_running_loop().run_in_executor(None, self.on_message, binding.tcp_addr, text)
+
+    def _fall_back(self, addr, text):
+        binding = self.bindings.get(addr)
+        if binding is not None:
+            binding.peer.enqueue_stream(encode_text(text))
+
+    def _sweep(self):
+        now = time.monotonic()
+        for peer_id, pending in list(self._pending.items()):
+            if now > pending.deadline or pending.peer.closed:
+                self._discard_pending(peer_id)
+        for binding in list(self.bindings.values()):
+            if binding.peer.closed:
+                self.unbind(binding.peer)
+        self._sweeper = asyncio.get_running_loop().call_later(SWEEP_INTERVAL, self._sweep)
+
+
+# --- замер ---
+
+async def bench(args):
+    from async_client import AsyncClient
+
+    received = {}
+    duplicates = 0
+    latencies = []
+    sent_at = {}
+
+    def on_message(addr, text):
+        nonlocal duplicates
+        index = int(text.split(' ', 1)[0])
+        if index in received:
+            duplicates += 1
+            return
+        received[index] = 'udp' if len(text) <= MAX_UDP_MESSAGE else 'tcp'
+        latencies.append(time.perf_counter() - sent_at[index])
+
+    # Большие сообщения идут по TCP на сервер рядом с UDP-получателем
+    async def handle_tcp(reader, writer):
+        parser = FrameParser()
+        while data := await reader.read(65536):
+            parser.feed(data)
+            for msg_type, payload in parser.frames():
+                if msg_type == MSG_TEXT:
+                    on_message(writer.get_extra_info('peername'), decode_text(payload))
+        writer.close()
+
+    receiver = await UdpTransport.create('127.0.0.1', 0, on_message=on_message, loss=args.loss)
+    host, port = receiver.local_addr
+    tcp_server = await asyncio.start_server(handle_tcp, host, port)
+    tcp_client = AsyncClient(host, port)
+    await tcp_client.connect(timeout=5)
+    sender = await UdpTransport.create('127.0.0.1', 0, loss=args.loss,
+                                       fallback=lambda addr, text: tcp_client.send(text))
+
+    filler = 'x' * args.size
+    large = 'y' * (MAX_UDP_MESSAGE + 1)
+    started = time.perf_counter()
+    for index in range(args.messages):
+        text = f"{index} {large if args.large and index % args.large == 0 else filler}"
+        sent_at[index] = time.perf_counter()
+        sender.send((host, port), text)
+        if index % args.burst == args.burst - 1:
+            # С --rate отправляем равномерно: задержка без очереди на отправку
+            await asyncio.sleep(args.burst / args.rate if args.rate else 0)
+    deadline = time.monotonic() + args.timeout
+    while len(received) < args.messages and time.monotonic() < deadline:
+        await asyncio.sleep(0.01)
+    elapsed = time.perf_counter() - started
+    await sender.drain(timeout=1)
+
+    print(f"Доставлено {len(received)} из {args.messages} за {elapsed:.2f} с "
+          f"({len(received) / elapsed:.0f} сообщений/с), потери датаграмм {args.loss:.0%}")
+    if latencies:
+        latencies.sort()
+        print(f"Задержка: p50 {statistics.median(latencies) * 1000:.2f} мс, "
+              f"p99 {latencies[int(len(latencies) * 0.99) - 1] * 1000:.2f} мс")
+    stats = sender.stats
+    print(f"Отправитель: датаграмм {stats['datagrams_sent']} (выброшено {stats['datagrams_dropped']}), "
+          f"сообщений на датаграмму {stats['sent'] / max(stats['datagrams_sent'], 1):.1f}, "
+          f"повторов {stats['retransmits']}, через TCP {stats['fallback']}, потеряно {stats['lost']}")
+    print(f"Получатель: отсеяно повторов {receiver.stats['duplicates']}, "
+          f"подтверждающих датаграмм {receiver.stats['datagrams_sent']}, повторов в обработчике {duplicates}")
+
+    await tcp_client.close()
+    sender.close()
+    receiver.close()
+    tcp_server.close()
+    await tcp_server.wait_closed()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="UDP-транспорт сообщений чата")
+    parser.add_argument('--bench', action='store_true', help="замер на loopback")
+    parser.add_argument('--messages', type=int, default=10000)
+    parser.add_argument('--size', type=int, default=64, help="длина текста сообщения")
+    parser.add_argument('--loss', type=float, default=0.0, help="доля выбрасываемых датаграмм")
+    parser.add_argument('--large', type=int, default=0, metavar='N', help="каждое N-е сообщение — больше датаграммы")
+    parser.add_argument('--burst', type=int, default=100, help="сообщений между уступками циклу событий")
+    parser.add_argument('--rate', type=float, default=0, help="сообщений в секунду (0 — без ограничения)")
+    parser.add_argument('--timeout', type=float, default=30.0)
+    args = parser.parse_args(argv)
+    if not args.bench:
+        parser.error("укажите --bench")
+    asyncio.run(bench(args))
+
+
+if __name__ == '__main__':
+    main()
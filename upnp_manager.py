@@ -0,0 +1,266 @@
+import itertools
+import queue
+import threading
+import time
+
+DEFAULT_LEASE_DURATION = 3600  # секунды
+RENEW_FRACTION = 0.8           # продлеваем, когда прошло 80% срока аренды
+DISCOVER_DELAY = 200           # мс
+MAX_FINISHED_JOBS = 1000
+
+JOB_PENDING = 'pending'
+JOB_RUNNING = 'running'
+JOB_SUCCESS = 'success'
+JOB_ERROR = 'error'
+
+
+def default_upnp_factory():
+    import miniupnpc
+    return miniupnpc.UPnP()
+
+
+class PortMappingManager:
+    """ Фоновое управление пробросом портов через UPnP.
+
+    IGD обнаруживается один раз и кэшируется; операции выполняются
+    в отдельном потоке как задания со статусом. Правила создаются
+    с ограниченным сроком аренды и продлеваются заранее, при stop()
+    созданные правила удаляются.
+
+    upnp_factory позволяет подставить поддельный IGD с тем же
+    интерфейсом, что у miniupnpc.UPnP (для проверки без роутера).
+    """
+
+    def __init__(self, upnp_factory=default_upnp_factory, lease_duration=DEFAULT_LEASE_DURATION,
+                 discover_delay=DISCOVER_DELAY, reachability_check=None):
+        self.upnp_factory = upnp_factory
+        self.lease_duration = lease_duration
+        self.discover_delay = discover_delay
+        self.reachability_check = reachability_check
+        self._upnp = None
+        self._external_ip = None
+        self._mappings = {}  # (external_port, protocol) -> dict
+        self._jobs = {}
+        self._job_ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._finished = threading.Condition(self._lock)
+        self._queue = queue.Queue()
+        self._thread = None
+
+    # --- публичный интерфейс ---
+
+    def start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+    def stop(self, remove_mappings=True, timeout=10):
+        """ Останавливает поток; по умолчанию удаляет созданные правила """
+        with self._lock:
+            thread = self._thread
+            self._thread = None
+        if thread is None:
+            return
+        self._queue.put(('stop', remove_mappings, None))
+        thread.join(timeout)
+
+    def submit_open(self, external_port, internal_port, protocol='TCP',
+                    description='My Port Forwarding', callback=None):
+        """ Ставит в очередь открытие порта; возвращает id задания """
+        return self._submit('open', {
+            'external_port': int(external_port),
+            'internal_port': int(internal_port),
+            'protocol': protocol.upper(),
+            'description': description,
+        }, callback)
+
+    def submit_close(self, external_port, protocol='TCP'):
+        return self._submit('close', {
+            'external_port': int(external_port),
+            'protocol': protocol.upper(),
+        })
+
+    def job_status(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+    def wait(self, job_id, timeout=None):
+        """ Ждет завершения задания; возвращает его статус """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._finished:
+            while True:
+                job = self._jobs.get(job_id)
+                if job is None or job['status'] in (JOB_SUCCESS, JOB_ERROR):
+                    return dict(job) if job is not None else None
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return dict(job)
+                self._finished.wait(remaining)
+
+    def mappings(self):
+        with self._lock:
+            return [dict(mapping) for mapping in self._mappings.values()]
+
+    # --- поток заданий ---
+
+    def _submit(self, kind, params, callback=None):
+        self.start()
+        with self._lock:
+            job_id = next(self._job_ids)
+            self._jobs[job_id] = dict(params, job_id=job_id, kind=kind, status=JOB_PENDING,
+                                      created_at=time.time(), result=None, error=None)
+            self._trim_jobs()
+        self._queue.put((kind, job_id, callback))
+        return job_id
+
+    def _trim_jobs(self):
+        finished = [job_id for job_id, job in self._jobs.items()
+                    if job['status'] in (JOB_SUCCESS, JOB_ERROR)]
+        for job_id in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+            del self._jobs[job_id]
+
+    def _finish(self, job_id, status, result=None, error=None):
+        with self._finished:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                job.update(status=status, result=result, error=error, finished_at=time.time())
+            self._finished.notify_all()
+
+    def _next_renewal(self):
+        with self._lock:
+            times = [m['renew_at'] for m in self._mappings.values() if m['renew_at'] is not None]
+        return min(times) if times else None
+
+    def _run(self):
+        while True:
+            renew_at = self._next_renewal()
+            timeout = None if renew_at is None else max(0, renew_at - time.monotonic())
+            try:
+                kind, arg, callback = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                self._renew_due()
+                continue
+
+            if kind == 'stop':
+                if arg:
+                    self._remove_all()
+                return
+
+            job_id = arg
+            with self._lock:
+                params = dict(self._jobs[job_id])
+                self._jobs[job_id]['status'] = JOB_RUNNING
+            try:
+                if kind == 'open':
+                    result = self._open(params)
+                else:
+                    result = self._close(params)
+            except Exception as e:
+                # Кэшированный IGD мог устареть — при следующей операции ищем заново
+                self._upnp = None
+                print(f"[Ошибка] UPnP-задание {job_id} ({kind}) не выполнено: {e}")
+                self._finish(job_id, JOB_ERROR, error=str(e))
+                continue
+            if callback is not None:
+                try:
+                    callback(result)
+                except Exception as e:
+                    print(f"[Ошибка] Обработчик UPnP-задания {job_id} завершился с ошибкой: {e}")
+            self._finish(job_id, JOB_SUCCESS, result=result)
+
+    # --- операции с IGD (только в потоке заданий) ---
+
+    def _igd(self):
+        if self._upnp is None:
+            upnp = self.upnp_factory()
+            upnp.discoverdelay = self.discover_delay
+            if upnp.discover() == 0:
+                raise RuntimeError("UPnP-устройства не найдены")
+            upnp.selectigd()
+            self._external_ip = upnp.externalipaddress()
+            self._upnp = upnp
+            print(f"[Инфо] Найден IGD, локальный IP: {upnp.lanaddr}, внешний IP: {self._external_ip}")
+        return self._upnp
+
+    def _add_mapping(self, upnp, mapping):
+        """ Создает или продлевает правило; mapping — собственная копия вызывающего """
+        lease = mapping['lease']
+        try:
+            upnp.addportmapping(mapping['external_port'], mapping['protocol'], upnp.lanaddr,
+                                mapping['internal_port'], mapping['description'], '', lease)
+        except Exception as e:
+            # 725 OnlyPermanentLeasesSupported: роутер принимает только аренду 0
+            if lease == 0 or ('725' not in str(e) and 'OnlyPermanent' not in str(e)):
+                raise
+            mapping['lease'] = lease = 0
+            upnp.addportmapping(mapping['external_port'], mapping['protocol'], upnp.lanaddr,
+                                mapping['internal_port'], mapping['description'], '', 0)
+        mapping['renew_at'] = time.monotonic() + lease * RENEW_FRACTION if lease else None
+
+    def _open(self, params):
+        upnp = self._igd()
+        key = (params['external_port'], params['protocol'])
+        if upnp.getspecificportmapping(*key):
+            upnp.deleteportmapping(*key)
+
+        mapping = {
+            'external_port': params['external_port'],
+            'internal_port': params['internal_port'],
+            'protocol': params['protocol'],
+            'description': params['description'],
+            'lease': self.lease_duration,
+        }
+        self._add_mapping(upnp, mapping)
+        with self._lock:
+            self._mappings[key] = mapping
+
+        result = {
+            'external_ip': self._external_ip,
+            'lan_address': upnp.lanaddr,
+            'external_port': mapping['external_port'],
+            'internal_port': mapping['internal_port'],
+            'protocol': mapping['protocol'],
+            'lease': mapping['lease'],
+        }
+        if self.reachability_check is not None and mapping['protocol'] == 'TCP':
+            result['reachable'] = self.reachability_check(self._external_ip, mapping['external_port'])
+        return result
+
+    def _close(self, params):
+        key = (params['external_port'], params['protocol'])
+        upnp = self._igd()
+        upnp.deleteportmapping(*key)
+        with self._lock:
+            self._mappings.pop(key, None)
+        return {'external_port': key[0], 'protocol': key[1]}
+
+    def _renew_due(self):
+        now = time.monotonic()
+        with self._lock:
+            due = [(key, dict(m)) for key, m in self._mappings.items()
+                   if m['renew_at'] is not None and m['renew_at'] <= now]
+        for key, mapping in due:
+            try:
+                self._add_mapping(self._igd(), mapping)
+            except Exception as e:
+                self._upnp = None
+                # Повторим через минуту, пока аренда еще действует
+                mapping['renew_at'] = now + 60
+                print(f"[Ошибка] Не удалось продлить правило {mapping['external_port']}/{mapping['protocol']}: {e}")
+            with self._lock:
+                current = self._mappings.get(key)
+                # Правило могли закрыть или пересоздать, пока шло продление
+                if current is not None and current['renew_at'] is not None and current['renew_at'] <= now:
+                    current.update(lease=mapping['lease'], renew_at=mapping['renew_at'])
+
+    def _remove_all(self):
+        for mapping in self.mappings():
+            try:
+                self._igd().deleteportmapping(mapping['external_port'], mapping['protocol'])
+                print(f"[Инфо] Правило {mapping['external_port']}/{mapping['protocol']} удалено.")
+            except Exception as e:
+                print(f"[Ошибка] Не удалось удалить правило {mapping['external_port']}/{mapping['protocol']}: {e}")
+        with self._lock:
+            self._mappings.clear()
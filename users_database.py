@@ -1,17 +1,268 @@
+import functools
+import queue
+import re
 import sqlite3
+import threading
+import time
+from collections import OrderedDict
 from sqlite3 import Error
+from logs import get_logger
+from metrics import Histogram
+
+log = get_logger('db')
+
+DB_QUERY_SECONDS = Histogram('db_query_seconds', 'Время выполнения операций с БД', ('query',))
+DB_COMMIT_SECONDS = Histogram('db_commit_seconds', 'Время фиксации транзакций SQLite')
+DB_STATEMENT_SECONDS = Histogram('db_statement_seconds', 'Время выполнения одного SQL-оператора',
+                                 ('statement',))
+
+# Настройки пула соединений
+POOL_MAX_SIZE = 8
+POOL_ACQUIRE_TIMEOUT = 10  # секунды ожидания свободного соединения
+STATEMENT_CACHE_SIZE = 256  # кэш подготовленных запросов на соединение
+USER_ID_CACHE_SIZE = 10000
+
+CONNECTION_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA cache_size=-20000",      # ~20 МБ страничного кэша
+    "PRAGMA mmap_size=268435456",    # 256 МБ отображения файла в память
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA busy_timeout=5000",
+)
+
+_STATEMENT_TABLE_RE = re.compile(
+    r'\b(?:FROM|INTO|UPDATE|TABLE|INDEX|TRIGGER|VIEW)\s+(?:IF\s+(?:NOT\s+)?EXISTS\s+)?"?(\w+)', re.IGNORECASE)
+_statement_timers = {}  # текст запроса -> db_statement_seconds с его меткой
+MAX_STATEMENT_TIMERS = 512
+
+def statement_label(sql):
+    """ Метка оператора для db_statement_seconds: "<команда> <таблица>" """
+    words = sql.split(None, 1)
+    verb = words[0].lower() if words else ''
+    match = _STATEMENT_TABLE_RE.search(sql)
+    return f"{verb} {match.group(1).lower()}" if match else verb
+
+def _statement_timer(sql):
+    timer = _statement_timers.get(sql)
+    if timer is None:
+        timer = DB_STATEMENT_SECONDS.labels(statement_label(sql))
+        # Текст запросов с IN (?, ?, ...) разный — кэш ограничен, меток все равно немного
+        if len(_statement_timers) < MAX_STATEMENT_TIMERS:
+            _statement_timers[sql] = timer
+    return timer
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """ Курсор, замеряющий каждый execute/executemany.
+
+    Для SELECT в замер входит подготовка и получение первой строки;
+    остальные строки SQLite выдает при чтении курсора.
+    """
+
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            _statement_timer(sql).observe(time.perf_counter() - started)
+
+    def executemany(self, sql, seq_of_parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            _statement_timer(sql).observe(time.perf_counter() - started)
+
+class InstrumentedConnection(sqlite3.Connection):
+    """ Соединение, замеряющее каждый SQL-оператор и каждую фиксацию транзакции """
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    # Connection.execute в C не вызывает переопределенный Cursor.execute
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def commit(self):
+        started = time.perf_counter()
+        try:
+            super().commit()
+        finally:
+            DB_COMMIT_SECONDS.observe(time.perf_counter() - started)
+
+def _timed_query(func):
+    """ Учитывает время операции в db_query_seconds с меткой по имени функции """
+    timer = DB_QUERY_SECONDS.labels(func.__name__)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with timer.time():
+            return func(*args, **kwargs)
+    return wrapper
 
 def create_connection(db_file):
     """ Создает соединение с базой данных SQLite """
     conn = None
     try:
-        conn = sqlite3.connect(db_file)
-        print(f"Подключение к SQLite DB {db_file} успешно")
+        conn = sqlite3.connect(db_file, factory=InstrumentedConnection)
+        log.debug("Подключение к SQLite DB %s успешно", db_file)
         return conn
     except Error as e:
-        print(f"Ошибка при подключении к SQLite DB: {e}")
+        log.error("Ошибка при подключении к SQLite DB: %s", e)
     return conn
 
+def open_connection(db_file):
+    """ Соединение с теми же настройками, что и в пуле, но вне его: для
+    потоков, которые держат соединение долго (поток записи, NDJSON),
+    чтобы не занимать место в пуле запросов """
+    conn = sqlite3.connect(
+        db_file,
+        check_same_thread=False,
+        cached_statements=STATEMENT_CACHE_SIZE,
+        factory=InstrumentedConnection
+    )
+    conn.row_factory = sqlite3.Row
+    for pragma in CONNECTION_PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+class ConnectionPool:
+    """ Ограниченный пул настроенных соединений SQLite.
+
+    Соединения создаются лениво (не больше max_size) и переиспользуются
+    между запросами и потоками; release() возвращает соединение в пул
+    вместо закрытия.
+    """
+
+    def __init__(self, db_file, max_size=POOL_MAX_SIZE):
+        self.db_file = db_file
+        self.max_size = max_size
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        return open_connection(self.db_file)
+
+    def acquire(self, timeout=POOL_ACQUIRE_TIMEOUT):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            can_create = self._created < self.max_size
+            if can_create:
+                self._created += 1
+        if can_create:
+            try:
+                return self._connect()
+            except Error:
+                with self._lock:
+                    self._created -= 1
+                raise
+        return self._idle.get(timeout=timeout)
+
+    def release(self, conn):
+        # Незавершенная транзакция не должна достаться следующему запросу
+        if conn.in_transaction:
+            conn.rollback()
+        self._idle.put(conn)
+
+    def close_all(self):
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._lock:
+                self._created -= 1
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def get_pool(db_file):
+    """ Возвращает общий для процесса пул соединений к файлу БД """
+    with _pools_lock:
+        pool = _pools.get(db_file)
+        if pool is None:
+            pool = _pools[db_file] = ConnectionPool(db_file)
+        return pool
+
+class UserIdCache:
+    """ LRU-кэш username -> user_id с ограничением размера и счетчиками """
+
+    def __init__(self, max_size=USER_ID_CACHE_SIZE):
+        self.max_size = max_size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, username):
+        with self._lock:
+            user_id = self._data.get(username)
+            if user_id is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._data.move_to_end(username)
+            return user_id
+
+    def put(self, username, user_id):
+        with self._lock:
+            self._data[username] = user_id
+            self._data.move_to_end(username)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def invalidate(self, username):
+        with self._lock:
+            self._data.pop(username, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self._data),
+                'max_size': self.max_size
+            }
+
+# Кэш общий для процесса и рассчитан на одну БД;
+# при смене файла БД его нужно очистить через user_id_cache.clear()
+user_id_cache = UserIdCache()
+
+def user_id_cache_stats():
+    return user_id_cache.stats()
+
+def _resolve_user_id(cursor, username):
+    """ Возвращает (user_id, from_cache); создает пользователя при необходимости.
+
+    INSERT ... ON CONFLICT DO NOTHING безопасен при гонке создания
+    одного и того же пользователя из нескольких соединений.
+    """
+    user_id = user_id_cache.get(username)
+    if user_id is not None:
+        return user_id, True
+    cursor.execute("""
+    INSERT INTO users (username) VALUES (?)
+    ON CONFLICT (username) DO NOTHING
+    RETURNING user_id
+    """, (username,))
+    result = cursor.fetchone()
+    if result is None:
+        cursor.execute("SELECT user_id FROM users WHERE username = ?", (username,))
+        result = cursor.fetchone()
+    return result[0], False
+
 def create_tables(conn):
     """ Создает таблицы, если они не существуют """
     try:
@@ -59,25 +310,151 @@ def create_tables(conn):
 
         
         conn.commit()
-        print("Таблицы созданы успешно")
+        log.info("Таблицы созданы успешно")
     except Error as e:
-        print(f"Ошибка при создании таблиц: {e}")
+        log.error("Ошибка при создании таблиц: %s", e)
+        return
+
+    migrate(conn)
+
+CACHE_INVALIDATION_HISTORY = 10000
+
+# Миграции схемы: (версия, описание, SQL-запросы).
+# Текущая версия хранится в PRAGMA user_version; новые миграции
+# добавляются только в конец списка с очередным номером.
+MIGRATIONS = [
+    (1, "индексы для выборки сообщений и постов", [
+        # get_user_messages: WHERE user_id = ? ORDER BY timestamp
+        """CREATE INDEX IF NOT EXISTS idx_messages_user_timestamp
+        ON messages (user_id, timestamp)""",
+        # Пагинация сообщений: WHERE user_id = ? ORDER BY message_id
+        # (message_id — это rowid, он уже входит в каждый индекс).
+        # Индекс не покрывающий: message_text и timestamp читаются из
+        # таблицы по rowid, зато тексты сообщений не хранятся дважды
+        """CREATE INDEX IF NOT EXISTS idx_messages_user
+        ON messages (user_id)""",
+        # /api/posts: WHERE profile_id = ? ORDER BY created_at DESC, post_id DESC
+        """CREATE INDEX IF NOT EXISTS idx_posts_profile_created
+        ON posts (profile_id, created_at DESC, post_id DESC)""",
+    ]),
+    (2, "полнотекстовый поиск FTS5 по сообщениям и постам", [
+        # Внешний контент: индекс не дублирует текст, триггеры держат его в актуальном состоянии
+        """CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts
+        USING fts5(message_text, content='messages', content_rowid='message_id')""",
+        """CREATE TRIGGER IF NOT EXISTS messages_fts_ai AFTER INSERT ON messages BEGIN
+            INSERT INTO messages_fts (rowid, message_text) VALUES (new.message_id, new.message_text);
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS messages_fts_ad AFTER DELETE ON messages BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, message_text)
+            VALUES ('delete', old.message_id, old.message_text);
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS messages_fts_au AFTER UPDATE OF message_text ON messages BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, message_text)
+            VALUES ('delete', old.message_id, old.message_text);
+            INSERT INTO messages_fts (rowid, message_text) VALUES (new.message_id, new.message_text);
+        END""",
+        "INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')",
+        """CREATE VIRTUAL TABLE IF NOT EXISTS posts_fts
+        USING fts5(content, content='posts', content_rowid='post_id')""",
+        """CREATE TRIGGER IF NOT EXISTS posts_fts_ai AFTER INSERT ON posts BEGIN
+            INSERT INTO posts_fts (rowid, content) VALUES (new.post_id, new.content);
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS posts_fts_ad AFTER DELETE ON posts BEGIN
+            INSERT INTO posts_fts (posts_fts, rowid, content) VALUES ('delete', old.post_id, old.content);
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS posts_fts_au AFTER UPDATE OF content ON posts BEGIN
+            INSERT INTO posts_fts (posts_fts, rowid, content) VALUES ('delete', old.post_id, old.content);
+            INSERT INTO posts_fts (rowid, content) VALUES (new.post_id, new.content);
+        END""",
+        "INSERT INTO posts_fts (posts_fts) VALUES ('rebuild')",
+    ]),
+    (3, "очередь доставки личных сообщений (outbox)", [
+        # delivered_at выставляется по подтверждению получателя,
+        # подтвержденные строки позже удаляет compact_outbox()
+        """CREATE TABLE IF NOT EXISTS outbox (
+            outbox_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            recipient TEXT NOT NULL,
+            sender TEXT NOT NULL,
+            message_text TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            delivered_at TIMESTAMP
+        )""",
+        # Частичный индекс: только недоставленные, в порядке постановки
+        """CREATE INDEX IF NOT EXISTS idx_outbox_pending
+        ON outbox (recipient, outbox_id) WHERE delivered_at IS NULL""",
+        """CREATE INDEX IF NOT EXISTS idx_outbox_delivered
+        ON outbox (delivered_at) WHERE delivered_at IS NOT NULL""",
+    ]),
+    (4, "журнал инвалидаций кэшей для процессов serve.py", [
+        # Строки пишут триггеры в той же транзакции, что и изменение, —
+        # из любого процесса; журнал держит последние CACHE_INVALIDATION_HISTORY
+        """CREATE TABLE IF NOT EXISTS cache_invalidations (
+            invalidation_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            cache TEXT NOT NULL,
+            cache_key TEXT NOT NULL
+        )""",
+        f"""CREATE TRIGGER IF NOT EXISTS cache_invalidations_trim AFTER INSERT ON cache_invalidations BEGIN
+            DELETE FROM cache_invalidations
+            WHERE invalidation_id <= new.invalidation_id - {CACHE_INVALIDATION_HISTORY};
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS user_profiles_cache_au AFTER UPDATE ON user_profiles BEGIN
+            INSERT INTO cache_invalidations (cache, cache_key) VALUES ('profile', old.profile_id);
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS user_profiles_cache_ad AFTER DELETE ON user_profiles BEGIN
+            INSERT INTO cache_invalidations (cache, cache_key) VALUES ('profile', old.profile_id);
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS posts_cache_ai AFTER INSERT ON posts BEGIN
+            INSERT INTO cache_invalidations (cache, cache_key) VALUES ('profile_posts', new.profile_id);
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS posts_cache_au AFTER UPDATE ON posts BEGIN
+            INSERT INTO cache_invalidations (cache, cache_key) VALUES
+                ('post', old.post_id), ('profile_posts', old.profile_id), ('profile_posts', new.profile_id);
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS posts_cache_ad AFTER DELETE ON posts BEGIN
+            INSERT INTO cache_invalidations (cache, cache_key) VALUES
+                ('post', old.post_id), ('profile_posts', old.profile_id);
+        END""",
+    ]),
+]
+
+def get_schema_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+def migrate(conn):
+    """ Применяет недостающие миграции к существующей БД на месте.
 
+    Каждая миграция выполняется в своей транзакции BEGIN IMMEDIATE:
+    в режиме WAL читатели продолжают работать, а параллельный процесс,
+    уже применивший ту же миграцию, не даст выполнить ее повторно.
+    """
+    for version, description, statements in MIGRATIONS:
+        if get_schema_version(conn) >= version:
+            continue
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            # Версию перечитываем под блокировкой записи
+            if get_schema_version(conn) >= version:
+                conn.rollback()
+                continue
+            for statement in statements:
+                conn.execute(statement)
+            conn.execute(f"PRAGMA user_version = {int(version)}")
+            conn.commit()
+            log.info("Применена миграция %d: %s", version, description)
+        except Error as e:
+            conn.rollback()
+            log.error("Миграция %d не применена: %s", version, e)
+            return False
+    return True
+
+@_timed_query
 def insert_message(conn, username, message):
     """ Вставляет сообщение для пользователя (создает пользователя, если не существует) """
     try:
         cursor = conn.cursor()
         
-        # Проверяем, существует ли пользователь
-        cursor.execute("SELECT user_id FROM users WHERE username = ?", (username,))
-        result = cursor.fetchone()
-        
-        if result:
-            user_id = result[0]
-        else:
-            # Если пользователя нет, создаем его
-            cursor.execute("INSERT INTO users (username) VALUES (?)", (username,))
-            user_id = cursor.lastrowid
+        # Находим пользователя (в кэше или в БД), при необходимости создаем
+        user_id, cached = _resolve_user_id(cursor, username)
         
         # Добавляем сообщение
         cursor.execute("""
@@ -86,12 +463,53 @@ def insert_message(conn, username, message):
         """, (user_id, message))
         
         conn.commit()
-        print(f"Сообщение для пользователя '{username}' успешно добавлено")
+        # Кэшируем только после фиксации: откат мог бы оставить в кэше чужой id
+        if not cached:
+            user_id_cache.put(username, user_id)
+        log.debug("Сообщение для пользователя '%s' успешно добавлено", username)
         return True
     except Error as e:
-        print(f"Ошибка при добавлении сообщения: {e}")
+        log.error("Ошибка при добавлении сообщения: %s", e)
         return False
 
+@_timed_query
+def insert_messages_batch(conn, records):
+    """ Вставляет пачку сообщений одной транзакцией.
+
+    records — [(username, message), ...] или [(username, message, timestamp), ...];
+    timestamp None означает текущее время.
+    """
+    try:
+        cursor = conn.cursor()
+        user_ids = {}
+        resolved = {}  # пользователи, которых нужно положить в кэш после фиксации
+        rows = []
+        for record in records:
+            username, message = record[0], record[1]
+            timestamp = record[2] if len(record) > 2 else None
+            user_id = user_ids.get(username)
+            if user_id is None:
+                user_id, cached = _resolve_user_id(cursor, username)
+                user_ids[username] = user_id
+                if not cached:
+                    resolved[username] = user_id
+            rows.append((user_id, message, timestamp))
+
+        cursor.executemany("""
+        INSERT INTO messages (user_id, message_text, timestamp)
+        VALUES (?, ?, COALESCE(?, CURRENT_TIMESTAMP))
+        """, rows)
+
+        conn.commit()
+        for username, user_id in resolved.items():
+            user_id_cache.put(username, user_id)
+        return True
+    except Error as e:
+        log.error("Ошибка при пакетном добавлении сообщений: %s", e)
+        conn.rollback()
+        return False
+
+@_timed_query
 def get_user_messages(conn, username):
     """ Получает все сообщения пользователя """
     try:
@@ -109,10 +527,332 @@ def get_user_messages(conn, username):
         messages = cursor.fetchall()
         return messages
     except Error as e:
-        print(f"Ошибка при получении сообщений: {e}")
+        log.error("Ошибка при получении сообщений: %s", e)
+        return None
+
+@_timed_query
+def get_user_messages_page(conn, username, after_id=None, before_id=None, limit=100):
+    """ Возвращает страницу сообщений (message_id, message_text, timestamp)
+    по ключу message_id в порядке возрастания.
+
+    after_id — сообщения новее курсора, before_id — ближайшие
+    limit сообщений старше курсора.
+    """
+    try:
+        conditions = ["u.username = ?"]
+        params = [username]
+        if after_id is not None:
+            conditions.append("m.message_id > ?")
+            params.append(after_id)
+        if before_id is not None:
+            conditions.append("m.message_id < ?")
+            params.append(before_id)
+        # Для before_id без after_id берем последние limit строк и разворачиваем
+        descending = before_id is not None and after_id is None
+        params.append(limit)
+
+        cursor = conn.cursor()
+        cursor.execute(f"""
+        SELECT m.message_id, m.message_text, m.timestamp
+        FROM messages m
+        JOIN users u ON m.user_id = u.user_id
+        WHERE {' AND '.join(conditions)}
+        ORDER BY m.message_id {'DESC' if descending else 'ASC'}
+        LIMIT ?
+        """, params)
+        messages = cursor.fetchall()
+        if descending:
+            messages.reverse()
+        return messages
+    except Error as e:
+        log.error("Ошибка при получении сообщений: %s", e)
+        return None
+
+@_timed_query
+def get_messages_since(conn, after_id, limit=500):
+    """ Новые сообщения всех пользователей (message_id, username, message_text, timestamp)
+    с message_id больше after_id, в порядке возрастания """
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+        SELECT m.message_id, u.username, m.message_text, m.timestamp
+        FROM messages m
+        JOIN users u ON m.user_id = u.user_id
+        WHERE m.message_id > ?
+        ORDER BY m.message_id
+        LIMIT ?
+        """, (after_id, limit))
+        return cursor.fetchall()
+    except Error as e:
+        log.error("Ошибка при чтении новых сообщений: %s", e)
+        return None
+
+def get_max_message_id(conn):
+    return conn.execute("SELECT COALESCE(MAX(message_id), 0) FROM messages").fetchone()[0]
+
+def iter_user_messages(conn, username, after_id=None, batch_size=500):
+    """ Построчно отдает сообщения пользователя, не загружая историю целиком """
+    cursor = conn.cursor()
+    cursor.execute("""
+    SELECT m.message_id, m.message_text, m.timestamp
+    FROM messages m
+    JOIN users u ON m.user_id = u.user_id
+    WHERE u.username = ? AND m.message_id > ?
+    ORDER BY m.message_id
+    """, (username, after_id or 0))
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        yield from rows
+
+@_timed_query
+def get_posts_page(conn, profile_id, after_id=None, before_id=None, limit=100):
+    """ Возвращает страницу постов профиля от новых к старым.
+
+    Курсор — post_id; порядок (created_at, post_id) однозначен
+    даже для постов с одинаковым временем создания.
+    after_id — посты новее курсора, before_id — старше курсора.
+    """
+    try:
+        conditions = ["profile_id = ?"]
+        params = [profile_id]
+        if after_id is not None:
+            conditions.append("(created_at, post_id) > (SELECT created_at, post_id FROM posts WHERE post_id = ?)")
+            params.append(after_id)
+        if before_id is not None:
+            conditions.append("(created_at, post_id) < (SELECT created_at, post_id FROM posts WHERE post_id = ?)")
+            params.append(before_id)
+        # Для after_id без before_id берем ближайшие к курсору и разворачиваем
+        ascending = after_id is not None and before_id is None
+        params.append(limit)
+
+        cursor = conn.cursor()
+        cursor.execute(f"""
+        SELECT * FROM posts
+        WHERE {' AND '.join(conditions)}
+        ORDER BY created_at {'ASC' if ascending else 'DESC'}, post_id {'ASC' if ascending else 'DESC'}
+        LIMIT ?
+        """, params)
+        posts = cursor.fetchall()
+        if ascending:
+            posts.reverse()
+        return posts
+    except Error as e:
+        log.error("Ошибка при получении постов: %s", e)
+        return None
+
+def iter_posts_by_profile(conn, profile_id, batch_size=500):
+    """ Построчно отдает все посты профиля от новых к старым """
+    cursor = conn.cursor()
+    cursor.execute("""
+    SELECT * FROM posts
+    WHERE profile_id = ?
+    ORDER BY created_at DESC, post_id DESC
+    """, (profile_id,))
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        yield from rows
+
+def build_fts_query(text):
+    """ Превращает пользовательский ввод в безопасный запрос FTS5:
+    каждое слово берется в кавычки (все слова обязательны),
+    завершающая '*' сохраняется как поиск по префиксу """
+    terms = []
+    for word in text.split():
+        prefix = word.endswith('*')
+        word = word.rstrip('*').replace('"', '""')
+        if word:
+            terms.append(f'"{word}"' + ('*' if prefix else ''))
+    return ' '.join(terms)
+
+# Сколько самых новых совпадений ранжируется по релевантности:
+# для очень частых слов ранг не считается по всей истории
+SEARCH_RANK_WINDOW = 10000
+
+def _fts_filter(table, sort):
+    """ Условие MATCH; для ранжирования по bm25 — только среди последних
+    SEARCH_RANK_WINDOW совпадений. 'recent' окно не ограничивает: выборка
+    по rowid DESC с LIMIT и так не ранжирует всю историю """
+    if sort == 'recent':
+        return f"{table} MATCH :query"
+    return f"""{table} MATCH :query AND {table}.rowid >= COALESCE((
+            SELECT rowid FROM {table} WHERE {table} MATCH :query
+            ORDER BY rowid DESC LIMIT 1 OFFSET :window), 0)"""
+
+@_timed_query
+def get_message_samples(conn, limit=5000):
+    """ Тексты последних limit сообщений — выборка для обучения словаря сжатия """
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT message_text FROM messages ORDER BY message_id DESC LIMIT ?", (limit,))
+        return [row[0] for row in cursor.fetchall()]
+    except Error as e:
+        log.error("Ошибка при чтении сообщений для словаря: %s", e)
+        return []
+
+@_timed_query
+def search_messages(conn, text, limit=20, offset=0, sort='rank'):
+    """ Ищет сообщения; sort='rank' — по релевантности (bm25) среди последних
+    SEARCH_RANK_WINDOW совпадений, 'recent' — сначала новые.
+
+    Возвращает (message_id, username, timestamp, snippet, rank).
+    """
+    query = build_fts_query(text)
+    if not query:
+        return []
+    try:
+        # 'recent' идет по rowid индекса без вычисления ранга всех совпадений
+        order = "messages_fts.rowid DESC" if sort == 'recent' else "rank"
+        cursor = conn.cursor()
+        cursor.execute(f"""
+        SELECT m.message_id, u.username, m.timestamp,
+               snippet(messages_fts, 0, '[', ']', '…', 12), rank
+        FROM messages_fts
+        JOIN messages m ON m.message_id = messages_fts.rowid
+        JOIN users u ON u.user_id = m.user_id
+        WHERE {_fts_filter('messages_fts', sort)}
+        ORDER BY {order}
+        LIMIT :limit OFFSET :offset
+        """, {'query': query, 'window': SEARCH_RANK_WINDOW - 1, 'limit': limit, 'offset': offset})
+        return cursor.fetchall()
+    except Error as e:
+        log.error("Ошибка при поиске сообщений: %s", e)
         return None
 
+@_timed_query
+def search_posts(conn, text, limit=20, offset=0, sort='rank'):
+    """ Ищет посты; возвращает (post_id, profile_id, created_at, snippet, rank) """
+    query = build_fts_query(text)
+    if not query:
+        return []
+    try:
+        order = "posts_fts.rowid DESC" if sort == 'recent' else "rank"
+        cursor = conn.cursor()
+        cursor.execute(f"""
+        SELECT p.post_id, p.profile_id, p.created_at,
+               snippet(posts_fts, 0, '[', ']', '…', 12), rank
+        FROM posts_fts
+        JOIN posts p ON p.post_id = posts_fts.rowid
+        WHERE {_fts_filter('posts_fts', sort)}
+        ORDER BY {order}
+        LIMIT :limit OFFSET :offset
+        """, {'query': query, 'window': SEARCH_RANK_WINDOW - 1, 'limit': limit, 'offset': offset})
+        return cursor.fetchall()
+    except Error as e:
+        log.error("Ошибка при поиске постов: %s", e)
+        return None
+
+
+@_timed_query
+def enqueue_outbox(conn, recipient, sender, message):
+    """ Ставит личное сообщение в очередь доставки; возвращает outbox_id """
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+        INSERT INTO outbox (recipient, sender, message_text) VALUES (?, ?, ?)
+        """, (recipient, sender, message))
+        conn.commit()
+        return cursor.lastrowid
+    except Error as e:
+        log.error("Ошибка при постановке сообщения в очередь доставки: %s", e)
+        conn.rollback()
+        return None
+
+@_timed_query
+def get_outbox_pending(conn, recipient, after_id=0, limit=500):
+    """ Недоставленные сообщения получателя (outbox_id, sender, message_text, created_at)
+    с outbox_id больше after_id, в порядке постановки """
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+        SELECT outbox_id, sender, message_text, created_at
+        FROM outbox
+        WHERE recipient = ? AND delivered_at IS NULL AND outbox_id > ?
+        ORDER BY outbox_id
+        LIMIT ?
+        """, (recipient, after_id, limit))
+        return cursor.fetchall()
+    except Error as e:
+        log.error("Ошибка при чтении очереди доставки: %s", e)
+        return None
+
+@_timed_query
+def ack_outbox(conn, recipient, outbox_ids):
+    """ Отмечает сообщения доставленными; чужие outbox_id игнорируются """
+    try:
+        cursor = conn.cursor()
+        cursor.executemany("""
+        UPDATE outbox SET delivered_at = CURRENT_TIMESTAMP
+        WHERE outbox_id = ? AND recipient = ? AND delivered_at IS NULL
+        """, [(outbox_id, recipient) for outbox_id in outbox_ids])
+        conn.commit()
+        return cursor.rowcount
+    except Error as e:
+        log.error("Ошибка при подтверждении доставки: %s", e)
+        conn.rollback()
+        return None
+
+@_timed_query
+def get_outbox_recipients_since(conn, after_id):
+    """ Получатели, которым после after_id поставлены новые сообщения:
+    [(recipient, максимальный outbox_id)] """
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+        SELECT recipient, MAX(outbox_id) FROM outbox
+        WHERE outbox_id > ? AND delivered_at IS NULL
+        GROUP BY recipient
+        """, (after_id,))
+        return cursor.fetchall()
+    except Error as e:
+        log.error("Ошибка при чтении очереди доставки: %s", e)
+        return None
+
+def get_outbox_max_id(conn):
+    return conn.execute("SELECT COALESCE(MAX(outbox_id), 0) FROM outbox").fetchone()[0]
+
+def get_cache_invalidations(conn, after_id, limit=1000):
+    """ Записи журнала инвалидаций (invalidation_id, cache, cache_key) после after_id """
+    return conn.execute("""
+    SELECT invalidation_id, cache, cache_key FROM cache_invalidations
+    WHERE invalidation_id > ?
+    ORDER BY invalidation_id
+    LIMIT ?
+    """, (after_id, limit)).fetchall()
+
+def get_cache_invalidation_bounds(conn):
+    """ (наименьший, наибольший) invalidation_id в журнале; (0, 0), если он пуст """
+    return conn.execute("""
+    SELECT COALESCE(MIN(invalidation_id), 0), COALESCE(MAX(invalidation_id), 0) FROM cache_invalidations
+    """).fetchone()
+
+@_timed_query
+def compact_outbox(conn, older_than=0, batch_size=1000):
+    """ Удаляет подтвержденные более older_than секунд назад сообщения
+    пачками по batch_size, чтобы не держать долгую блокировку записи """
+    deleted = 0
+    try:
+        while True:
+            cursor = conn.execute("""
+            DELETE FROM outbox WHERE outbox_id IN (
+                SELECT outbox_id FROM outbox
+                WHERE delivered_at IS NOT NULL AND delivered_at <= datetime('now', ?)
+                LIMIT ?
+            )
+            """, (f'-{int(older_than)} seconds', batch_size))
+            conn.commit()
+            deleted += cursor.rowcount
+            if cursor.rowcount < batch_size:
+                return deleted
+    except Error as e:
+        log.error("Ошибка при очистке очереди доставки: %s", e)
+        conn.rollback()
+        return deleted
 
+@_timed_query
 def create_user_profile(conn, bio):
     """ Создает новый профиль пользователя """
     try:
@@ -121,9 +861,10 @@ def create_user_profile(conn, bio):
         conn.commit()
         return cursor.lastrowid
     except sqlite3.Error as e:
-        print(f"Ошибка при создании профиля: {e}")
+        log.error("Ошибка при создании профиля: %s", e)
         return None
 
+@_timed_query
 def get_user_profile(conn, profile_id):
     """ Получает профиль пользователя по ID """
     try:
@@ -131,9 +872,10 @@ def get_user_profile(conn, profile_id):
         cursor.execute("SELECT * FROM user_profiles WHERE profile_id = ?", (profile_id,))
         return cursor.fetchone()
     except sqlite3.Error as e:
-        print(f"Ошибка при получении профиля: {e}")
+        log.error("Ошибка при получении профиля: %s", e)
         return None
 
+@_timed_query
 def update_user_profile(conn, profile_id, new_bio):
     """ Обновляет био профиля пользователя """
     try:
@@ -142,9 +884,10 @@ def update_user_profile(conn, profile_id, new_bio):
         conn.commit()
         return cursor.rowcount
     except sqlite3.Error as e:
-        print(f"Ошибка при обновлении профиля: {e}")
+        log.error("Ошибка при обновлении профиля: %s", e)
         return None
 
+@_timed_query
 def delete_user_profile(conn, profile_id):
     """ Удаляет профиль пользователя """
     try:
@@ -153,9 +896,10 @@ def delete_user_profile(conn, profile_id):
         conn.commit()
         return cursor.rowcount
     except sqlite3.Error as e:
-        print(f"Ошибка при удалении профиля: {e}")
+        log.error("Ошибка при удалении профиля: %s", e)
         return None
 
+@_timed_query
 def create_post(conn, content, photo_url):
     """ Создает новый пост """
     try:
@@ -164,9 +908,10 @@ def create_post(conn, content, photo_url):
         conn.commit()
         return cursor.lastrowid
     except sqlite3.Error as e:
-        print(f"Ошибка при создании поста: {e}")
+        log.error("Ошибка при создании поста: %s", e)
         return None
 
+@_timed_query
 def get_post(conn, post_id):
     """ Получает пост по ID """
     try:
@@ -174,9 +919,10 @@ def get_post(conn, post_id):
         cursor.execute("SELECT * FROM posts WHERE post_id = ?", (post_id,))
         return cursor.fetchone()
     except sqlite3.Error as e:
-        print(f"Ошибка при получении поста: {e}")
+        log.error("Ошибка при получении поста: %s", e)
         return None
 
+@_timed_query
 def update_post(conn, post_id, new_content, new_photo_url):
     """ Обновляет содержимое и фото поста """
     try:
@@ -189,9 +935,10 @@ def update_post(conn, post_id, new_content, new_photo_url):
         conn.commit()
         return cursor.rowcount
     except sqlite3.Error as e:
-        print(f"Ошибка при обновлении поста: {e}")
+        log.error("Ошибка при обновлении поста: %s", e)
         return None
 
+@_timed_query
 def delete_post(conn, post_id):
     """ Удаляет пост по ID """
     try:
@@ -200,7 +947,7 @@ def delete_post(conn, post_id):
         conn.commit()
         return cursor.rowcount
     except sqlite3.Error as e:
-        print(f"Ошибка при удалении поста: {e}")
+        log.error("Ошибка при удалении поста: %s", e)
         return None
 
 